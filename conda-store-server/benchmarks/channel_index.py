@@ -0,0 +1,119 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Benchmark of the indexing of conda channels into the database
+
+Indexes synthetic repodata with a given number of package builds into a
+database, by default a new sqlite database in a temporary directory, then
+indexes it again, which inserts nothing. Reports the time and the peak
+memory allocated by each run:
+
+    python benchmarks/channel_index.py --records 500000
+    python benchmarks/channel_index.py --database-url postgresql+psycopg2://...
+
+On PostgreSQL, the repodata is indexed into two channels, with rows
+inserted with COPY and with executemany, to compare both. The database
+must be empty, it is created with alembic.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import os
+import tempfile
+import time
+import tracemalloc
+
+from conda_store_server import api
+from conda_store_server._internal import channel_index, dbutil, orm
+
+
+def synthetic_repodata(n_records: int, builds_per_package: int = 4):
+    """Repodata of a linux-64 subdir with n_records package builds"""
+    packages = {}
+    for i in range(n_records):
+        name = f"package-{i // (builds_per_package * 8)}"
+        version = f"1.{(i // builds_per_package) % 8}.0"
+        build = f"py3{i % builds_per_package}_0"
+        packages[f"{name}-{version}-{build}.conda"] = {
+            "build": build,
+            "build_number": 0,
+            "depends": [f"package-{i % 1000} >=1.0", "python >=3.10"],
+            "license": "BSD-3-Clause",
+            "md5": hashlib.md5(str(i).encode()).hexdigest(),
+            "name": name,
+            "sha256": hashlib.sha256(str(i).encode()).hexdigest(),
+            "size": 1024 + i,
+            "subdir": "linux-64",
+            "timestamp": 1700000000000 + i,
+            "version": version,
+        }
+    return {"architectures": {"linux-64": {"packages": packages}}}
+
+
+@contextlib.contextmanager
+def bulk_load(method: str):
+    """Inserts rows with method, copy or executemany"""
+    copy_dialects = channel_index.COPY_DIALECTS
+    if method == "executemany":
+        channel_index.COPY_DIALECTS = set()
+    try:
+        yield
+    finally:
+        channel_index.COPY_DIALECTS = copy_dialects
+
+
+def index(session_factory, channel_id: int, repodata):
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    with session_factory() as db:
+        indexer = channel_index.ChannelIndexer(db, channel_id)
+        for subdir, subdir_repodata in repodata["architectures"].items():
+            indexer.index_subdir(subdir, subdir_repodata["packages"].values())
+    elapsed = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return indexer.stats, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=500_000)
+    parser.add_argument("--database-url", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database_url = args.database_url or (
+            f"sqlite:///{os.path.join(tmpdir, 'conda-store.sqlite')}"
+        )
+        dbutil.upgrade(database_url)
+        session_factory = orm.new_session_factory(url=database_url)
+
+        with session_factory() as db:
+            dialect = db.get_bind().dialect.name
+        methods = ["executemany"]
+        if dialect in channel_index.COPY_DIALECTS:
+            methods.insert(0, "copy")
+
+        repodata = synthetic_repodata(args.records)
+        print(f"indexing {args.records} package builds into {dialect}")
+        for method in methods:
+            with session_factory() as db:
+                channel = api.create_conda_channel(db, f"benchmark-{method}")
+                db.commit()
+                channel_id = channel.id
+
+            with bulk_load(method):
+                for run in ["initial", "unchanged"]:
+                    stats, elapsed, peak = index(session_factory, channel_id, repodata)
+                    print(
+                        f"{method:>11} {run:>9}: {elapsed:8.2f} s, "
+                        f"peak {peak / 1024**2:8.1f} MiB, "
+                        f"inserted {stats['packages']} packages and "
+                        f"{stats['package_builds']} package builds"
+                    )
+
+
+if __name__ == "__main__":
+    main()
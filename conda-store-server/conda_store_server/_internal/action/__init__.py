@@ -14,6 +14,7 @@ from conda_store_server._internal.action.download_packages import (  # noqa
 )
 from conda_store_server._internal.action.generate_conda_export import (  # noqa
     action_generate_conda_export,
+    action_generate_conda_prefix_export,
 )
 from conda_store_server._internal.action.generate_conda_pack import (  # noqa
     action_generate_conda_pack,
@@ -29,6 +30,7 @@ from conda_store_server._internal.action.get_conda_prefix_stats import (  # noqa
 )
 from conda_store_server._internal.action.install_lockfile import (  # noqa
     action_install_lockfile,
+    action_install_lockfile_incremental,
 )
 from conda_store_server._internal.action.install_specification import (  # noqa
     action_install_specification,
@@ -2,59 +2,120 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-import hashlib
+import concurrent.futures
+import functools
 import json
 import os
 import pathlib
+import typing
 
 from conda.core.prefix_data import PrefixData
 
 from conda_store_server import api
-from conda_store_server._internal import action
+from conda_store_server._internal import action, utils
 
+HASH_ALGORITHMS = ("md5", "sha256")
 
-def list_conda_prefix_packages(conda_prefix: pathlib.Path):
+
+@functools.lru_cache(maxsize=4096)
+def _cached_file_hashes(path: str, size: int, inode: int) -> typing.Dict[str, str]:
+    # size and inode are part of the cache key so that tarballs replaced in
+    # the package cache are hashed again, the modification time is not, as
+    # it changes when the tarball is merely touched
+    return utils.file_hashes(path, algorithms=HASH_ALGORITHMS)
+
+
+def _repodata_record_hashes(record) -> typing.Dict[str, str]:
+    """Hashes in info/repodata_record.json of the extracted package of a
+    prefix record, see action_fetch_and_extract_conda_packages
     """
-    Returns a list of the packages that exist for a given prefix
+    extracted_package_dir = getattr(record, "extracted_package_dir", None)
+    if not extracted_package_dir:
+        return {}
+    try:
+        with open(
+            os.path.join(extracted_package_dir, "info", "repodata_record.json")
+        ) as f:
+            repodata_record = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {
+        algorithm: repodata_record[algorithm]
+        for algorithm in HASH_ALGORITHMS
+        if repodata_record.get(algorithm)
+    }
+
+
+def package_tarball_hashes(record) -> typing.Dict[str, str]:
+    """Returns the md5 and sha256 of the tarball a prefix record was installed from
+
+    Hashes recorded by conda in the prefix record are used when available,
+    then those of info/repodata_record.json in the package cache. Otherwise
+    the tarball is hashed in a single streaming pass, and the result is
+    cached for the lifetime of the worker process since many builds share
+    the same package cache.
+    """
+    hashes = {
+        algorithm: getattr(record, algorithm)
+        for algorithm in HASH_ALGORITHMS
+        if getattr(record, algorithm, None)
+    }
+    if len(hashes) < len(HASH_ALGORITHMS):
+        hashes = {**_repodata_record_hashes(record), **hashes}
+    if len(hashes) == len(HASH_ALGORITHMS):
+        return hashes
+
+    path = record.package_tarball_full_path
+    stat = os.stat(path)
+    return _cached_file_hashes(path, stat.st_size, stat.st_ino)
 
+
+def _prefix_record_to_package(record) -> typing.Dict:
+    hashes = package_tarball_hashes(record)
+    package = {
+        "build": record.build,
+        "build_number": record.build_number,
+        "constrains": list(record.constrains),
+        "depends": list(record.depends),
+        "license": record.license,
+        "license_family": record.license_family,
+        "md5": hashes["md5"],
+        "sha256": hashes["sha256"],
+        "name": record.name,
+        "size": getattr(record, "size", 0),
+        "subdir": record.subdir,
+        "timestamp": record.timestamp,
+        "version": record.version,
+        "channel_id": record.channel.base_url,
+        "summary": None,
+        "description": None,
+    }
+
+    info_json = os.path.join(record.extracted_package_dir, "info/about.json")
+    if os.path.exists(info_json):
+        info = json.load(open(info_json))
+        package["summary"] = info.get("summary")
+        package["description"] = info.get("description")
+
+    return package
+
+
+def list_conda_prefix_packages(conda_prefix: pathlib.Path, max_workers: int = 1):
     """
-    packages = []
+    Returns a list of the packages that exist for a given prefix
 
+    Records are processed by a pool of up to max_workers threads, which
+    mostly spend their time hashing package tarballs.
+    """
     prefix_data = PrefixData(str(conda_prefix))
     prefix_data.load()
 
-    for record in prefix_data.iter_records():
-        package = {
-            "build": record.build,
-            "build_number": record.build_number,
-            "constrains": list(record.constrains),
-            "depends": list(record.depends),
-            "license": record.license,
-            "license_family": record.license_family,
-            "md5": hashlib.md5(
-                open(record.package_tarball_full_path, "rb").read()
-            ).hexdigest(),
-            "sha256": hashlib.sha256(
-                open(record.package_tarball_full_path, "rb").read()
-            ).hexdigest(),
-            "name": record.name,
-            "size": getattr(record, "size", 0),
-            "subdir": record.subdir,
-            "timestamp": record.timestamp,
-            "version": record.version,
-            "channel_id": record.channel.base_url,
-            "summary": None,
-            "description": None,
-        }
-
-        info_json = os.path.join(record.extracted_package_dir, "info/about.json")
-        if os.path.exists(info_json):
-            info = json.load(open(info_json))
-            package["summary"] = info.get("summary")
-            package["description"] = info.get("description")
-
-        packages.append(package)
-    return packages
+    records = list(prefix_data.iter_records())
+    if max_workers <= 1:
+        return [_prefix_record_to_package(record) for record in records]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_prefix_record_to_package, records))
 
 
 @action.action
@@ -63,13 +124,15 @@ def action_add_conda_prefix_packages(
     db,
     conda_prefix: pathlib.Path,
     build_id: int,
+    max_workers: int = min(4, os.cpu_count() or 1),
 ):
     build = api.get_build(db, build_id=build_id)
-    packages = list_conda_prefix_packages(conda_prefix)
-
-    for package in packages:
-        conda_package_build = api.create_or_ignore_conda_package(db, package)
-        if conda_package_build is None:
-            continue  # pypi package
-        build.package_builds.append(conda_package_build)
-        db.commit()
+    packages = list_conda_prefix_packages(conda_prefix, max_workers=max_workers)
+
+    # Registers all packages with a few set based queries and commits the
+    # packages together with the build associations in one transaction
+    existing_package_build_ids = {_.id for _ in build.package_builds}
+    for conda_package_build in api.create_or_ignore_conda_packages(db, packages):
+        if conda_package_build.id not in existing_package_build_ids:
+            build.package_builds.append(conda_package_build)
+    db.commit()
@@ -47,9 +47,10 @@ def action_add_lockfile_packages(
     solve = api.get_solve(db, solve_id=solve_id)
     packages = list_lockfile_packages(conda_lock_spec)
 
-    for package in packages:
-        conda_package_build = api.create_or_ignore_conda_package(db, package)
-        if conda_package_build is None:
-            continue  # pypi package
-        solve.package_builds.append(conda_package_build)
-        db.commit()
+    # Registers all packages with a few set based queries and commits the
+    # packages together with the solve associations in one transaction
+    existing_package_build_ids = {_.id for _ in solve.package_builds}
+    for conda_package_build in api.create_or_ignore_conda_packages(db, packages):
+        if conda_package_build.id not in existing_package_build_ids:
+            solve.package_builds.append(conda_package_build)
+    db.commit()
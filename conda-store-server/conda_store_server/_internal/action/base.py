@@ -82,6 +82,7 @@ class ActionContext:
             if not redirect_stderr:
                 for line in p.stderr:
                     self.stderr.write(line)
+            utils.wait_process(p)
 
         if p.returncode != 0:
             raise subprocess.CalledProcessError(p.returncode, p.args)
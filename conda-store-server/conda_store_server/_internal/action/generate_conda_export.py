@@ -4,9 +4,23 @@
 
 import json
 import pathlib
+import typing
+
+from conda.base.context import env_name
+from conda.core.prefix_data import PrefixData
+from conda.models.channel import Channel
+from conda.models.enums import PackageType
 
 from conda_store_server._internal import action
 
+CONDA_PACKAGE_TYPES = {None, PackageType.NOARCH_GENERIC, PackageType.NOARCH_PYTHON}
+
+PIP_PACKAGE_TYPES = {
+    PackageType.VIRTUAL_PYTHON_WHEEL,
+    PackageType.VIRTUAL_PYTHON_EGG_MANAGEABLE,
+    PackageType.VIRTUAL_PYTHON_EGG_UNMANAGEABLE,
+}
+
 
 @action.action
 def action_generate_conda_export(
@@ -25,3 +39,49 @@ def action_generate_conda_export(
     if result.stderr:
         context.log.warning(f"conda env export stderr: {result.stderr}")
     return json.loads(result.stdout)
+
+
+@action.action
+def action_generate_conda_prefix_export(
+    context,
+    conda_prefix: pathlib.Path,
+    channels: typing.Optional[typing.List[str]] = None,
+):
+    """Export conda_prefix like `conda env export --json` without a subprocess
+
+    The prefix metadata is read once. channels takes the place of the
+    channels configured for the conda command, usually the channels the
+    environment was solved against. As with conda, the channel of every
+    installed package is included.
+    """
+    prefix_data = PrefixData(str(conda_prefix), True)
+    records = sorted(prefix_data.iter_records(), key=lambda record: record.name)
+
+    conda_records = [r for r in records if r.package_type in CONDA_PACKAGE_TYPES]
+    pip_records = [r for r in records if r.package_type in PIP_PACKAGE_TYPES]
+
+    dependencies = [record.spec for record in conda_records]
+    if pip_records:
+        dependencies.append(
+            {"pip": [f"{record.name}=={record.version}" for record in pip_records]}
+        )
+
+    channels = list(
+        dict.fromkeys(Channel(channel).canonical_name for channel in channels or [])
+    )
+    for record in conda_records:
+        canonical_name = record.channel.canonical_name
+        if canonical_name not in channels:
+            channels.insert(0, canonical_name)
+
+    # Same keys and order as the output of conda env export
+    export = {"name": env_name(str(conda_prefix))}
+    if channels:
+        export["channels"] = channels
+    if dependencies:
+        export["dependencies"] = dependencies
+    variables = prefix_data.get_environment_env_vars()
+    if variables:
+        export["variables"] = variables
+    export["prefix"] = str(conda_prefix)
+    return export
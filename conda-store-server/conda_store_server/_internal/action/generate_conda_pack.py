@@ -2,21 +2,78 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import contextlib
 import pathlib
+import typing
 
 import conda_pack
+import zstandard
+from conda_pack.core import Packer
+from conda_pack.formats import archive
 
 from conda_store_server._internal import action
 
+# Archive formats supported for conda-pack artifacts and their content types
+CONDA_PACK_CONTENT_TYPES = {
+    "tar.gz": "application/gzip",
+    "tar.zst": "application/zstd",
+}
+
 
 @action.action
 def action_generate_conda_pack(
     context,
     conda_prefix: pathlib.Path,
-    output_filename: pathlib.Path,
+    output: typing.BinaryIO,
+    format: str = "tar.gz",
+    n_threads: int = 1,
+    compress_level: int = 4,
 ):
-    conda_pack.pack(
-        prefix=str(conda_prefix),
-        output=str(output_filename),
-        ignore_missing_files=True,
-    )
+    """Write a conda-pack archive of conda_prefix to the file object output
+
+    Unlike conda_pack.pack, which always writes to a temporary file and
+    moves it into place, the archive is written to output while it is
+    compressed. output only has to support write, which allows streaming
+    the archive into a storage backend. Compression uses n_threads
+    threads, -1 uses all cores.
+    """
+    if format not in CONDA_PACK_CONTENT_TYPES:
+        raise ValueError(
+            f"unsupported conda-pack format {format}, "
+            f"expected one of {list(CONDA_PACK_CONTENT_TYPES)}"
+        )
+
+    env = conda_pack.CondaEnv.from_prefix(str(conda_prefix), ignore_missing_files=True)
+    # Like conda_pack.pack, use the time of the last change to the
+    # environment as the modification time of the archive members
+    history = pathlib.Path(conda_prefix) / "conda-meta" / "history"
+    mtime = history.lstat().st_mtime if history.exists() else None
+
+    fileobj = output
+    with contextlib.ExitStack() as stack:
+        if format == "tar.zst":
+            # conda-pack ignores n_threads and compress_level for zstd,
+            # so the tar stream is compressed here instead
+            compressor = zstandard.ZstdCompressor(
+                level=compress_level, threads=n_threads
+            )
+            fileobj = stack.enter_context(
+                compressor.stream_writer(fileobj, closefd=False)
+            )
+            format = "tar"
+
+        with archive(
+            fileobj,
+            None,
+            "",
+            format,
+            compress_level=compress_level,
+            n_threads=n_threads,
+            mtime=mtime,
+        ) as arc:
+            packer = Packer(env.prefix, arc)
+            for file in env.files:
+                packer.add(file)
+            packer.finish()
+
+    context.log.info(f"packed {len(env.files)} files of {conda_prefix}")
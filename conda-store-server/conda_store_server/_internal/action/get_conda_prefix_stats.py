@@ -2,6 +2,7 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import json
 import pathlib
 
 from conda_store_server._internal import action, conda_utils, utils
@@ -13,6 +14,24 @@ def action_get_conda_prefix_stats(context, conda_prefix: pathlib.Path):
     if not conda_utils.is_conda_prefix(conda_prefix):
         raise ValueError("given prefix is not a conda environment")
 
+    usage = utils.disk_usage_stats(conda_prefix)
+
+    # Sizes of packages are derived from the files recorded in conda-meta,
+    # using the sizes collected while walking the prefix
+    package_sizes = {}
+    for filename in (conda_prefix / "conda-meta").glob("*.json"):
+        record = json.loads(filename.read_text())
+        package_sizes[record["name"]] = sum(
+            usage["files"].get(path, 0) for path in record.get("files", [])
+        )
+
+    context.log.info(
+        f"prefix uses {usage['total']} bytes, of which {usage['unique']} bytes "
+        "are not hardlinked from the package cache"
+    )
+
     stats = {}
-    stats["disk_usage"] = int(utils.disk_usage(conda_prefix))
+    stats["disk_usage"] = usage["total"]
+    stats["disk_usage_unique"] = usage["unique"]
+    stats["package_sizes"] = package_sizes
     return stats
@@ -3,11 +3,24 @@
 # license that can be found in the LICENSE file.
 
 import json
+import os
 import pathlib
+import shutil
 import sys
 import typing
 
-from conda_store_server._internal import action
+from conda.core.prefix_data import PrefixData
+from conda.models.enums import NoarchType
+
+from conda_store_server._internal import action, conda_utils
+
+# Path types of files which conda links into a prefix without modification,
+# apart from prefix replacement
+CLONEABLE_PATH_TYPES = {"hardlink", "softlink", "directory", "pyc_file"}
+
+# Linux kernels truncate shebangs longer than this, conda rewrites them to
+# use /usr/bin/env instead when linking
+MAX_SHEBANG_LENGTH = 127
 
 
 @action.action
@@ -34,3 +47,210 @@ def action_install_lockfile(
     ]
 
     context.run_command(command, check=True)
+
+
+def _package_key(url: str) -> typing.Tuple[str, str]:
+    # (subdir, filename) identifies a package build independently of the
+    # channel alias or tokens used in the url
+    subdir, filename = url.rsplit("/", 2)[-2:]
+    return subdir, filename
+
+
+def _python_version(version: typing.Optional[str]) -> typing.Optional[str]:
+    """Major and minor version of python, which noarch: python packages are
+    installed for, e.g. lib/python3.12/site-packages
+    """
+    if version is None:
+        return None
+    return ".".join(version.split(".")[:2])
+
+
+def _is_cloneable(record, conda_prefix: pathlib.Path, python_changed: bool = False):
+    """Whether the files of record can be reused from source_prefix
+
+    Packages with post-link scripts, entry points created at link time or
+    binary prefix replacement have to be linked again by conda. Text files
+    with an embedded prefix are cloned by replacing the prefix. noarch:
+    python packages are linked again when the python version changes, as
+    their files are installed in the site-packages of that version.
+    """
+    if record.paths_data is None:
+        return False
+    if python_changed and record.noarch == NoarchType.python:
+        return False
+
+    for path in record.paths_data.paths:
+        if str(path.path_type) not in CLONEABLE_PATH_TYPES:
+            return False
+        if f".{record.name}-post-link." in path.path:
+            return False
+        if path.prefix_placeholder and str(path.file_mode) != "text":
+            return False
+        if (
+            path.prefix_placeholder
+            and path.path.startswith("bin/")
+            and len(f"#!{conda_prefix}/bin/") > MAX_SHEBANG_LENGTH
+        ):
+            return False
+    return True
+
+
+def _clone_symlink_target(
+    target: str, source_prefix: pathlib.Path, conda_prefix: pathlib.Path
+) -> str:
+    """Target of a cloned symlink, absolute targets within source_prefix
+    being moved to conda_prefix
+    """
+    if not os.path.isabs(target):
+        return target
+
+    for prefix in {str(source_prefix), os.path.realpath(source_prefix)}:
+        if target == prefix or target.startswith(f"{prefix}{os.sep}"):
+            return f"{conda_prefix}{target[len(prefix) :]}"
+    return target
+
+
+def _clone_record(record, source_prefix: pathlib.Path, conda_prefix: pathlib.Path):
+    """Clone the files of record, hardlinking all files without a prefix"""
+    old_prefix = str(source_prefix).encode("utf-8")
+    new_prefix = str(conda_prefix).encode("utf-8")
+
+    for path in record.paths_data.paths:
+        source = source_prefix / path.path
+        destination = conda_prefix / path.path
+
+        if str(path.path_type) == "directory":
+            destination.mkdir(parents=True, exist_ok=True)
+            continue
+
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        if source.is_symlink():
+            target = os.readlink(source)
+            os.symlink(
+                _clone_symlink_target(target, source_prefix, conda_prefix),
+                destination,
+            )
+        elif path.prefix_placeholder:
+            destination.write_bytes(source.read_bytes().replace(old_prefix, new_prefix))
+            shutil.copymode(source, destination)
+        else:
+            os.link(source, destination)
+
+    metadata = f"conda-meta/{record.name}-{record.version}-{record.build}.json"
+    shutil.copy2(source_prefix / metadata, conda_prefix / metadata)
+
+
+@action.action
+def action_install_lockfile_incremental(
+    context,
+    conda_lock_spec: typing.Dict,
+    conda_prefix: pathlib.Path,
+    source_prefix: pathlib.Path,
+) -> bool:
+    """Install a lockfile by cloning unchanged packages from source_prefix
+
+    Packages of source_prefix which are also in the lockfile are cloned via
+    hardlinks, packages which are not in the lockfile are left out and the
+    remaining packages are installed with conda from an explicit file. The
+    result is compared to the lockfile afterwards.
+
+    Returns False, leaving no prefix behind, if the prefix could not be
+    built incrementally, in which case the lockfile should be installed
+    with action_install_lockfile.
+    """
+    platform = conda_utils.conda_platform()
+    packages = [
+        package
+        for package in conda_lock_spec["package"]
+        if package["platform"] == platform
+    ]
+    if any(package["manager"] != "conda" for package in packages):
+        context.log.info("lockfile contains pip packages, skipping incremental build")
+        return False
+
+    if conda_prefix.exists():
+        context.log.info(f"{conda_prefix} already exists, skipping incremental build")
+        return False
+
+    packages = {_package_key(package["url"]): package for package in packages}
+
+    try:
+        conda_prefix.mkdir(parents=True)
+        (conda_prefix / "conda-meta").mkdir()
+        shutil.copy2(
+            source_prefix / "conda-meta" / "history",
+            conda_prefix / "conda-meta" / "history",
+        )
+
+        records = list(PrefixData(str(source_prefix)).iter_records())
+        python_changed = _python_version(
+            next((_.version for _ in records if _.name == "python"), None)
+        ) != _python_version(
+            next(
+                (_["version"] for _ in packages.values() if _["name"] == "python"), None
+            )
+        )
+
+        cloned = set()
+        for record in records:
+            key = (record.subdir, record.fn)
+            package = packages.get(key)
+            if package is None or not _is_cloneable(
+                record, conda_prefix, python_changed
+            ):
+                continue
+
+            md5 = package.get("hash", {}).get("md5")
+            if md5 and record.md5 and md5 != record.md5:
+                continue
+
+            _clone_record(record, source_prefix, conda_prefix)
+            cloned.add(key)
+
+        context.log.info(
+            f"cloned {len(cloned)} of {len(packages)} packages from {source_prefix}"
+        )
+
+        explicit = [
+            f"{package['url']}#{package['hash']['md5']}"
+            if package.get("hash", {}).get("md5")
+            else package["url"]
+            for key, package in packages.items()
+            if key not in cloned
+        ]
+        if explicit:
+            explicit_filename = pathlib.Path.cwd() / "explicit.txt"
+            explicit_filename.write_text("\n".join(["@EXPLICIT", *explicit]) + "\n")
+            context.run_command(
+                [
+                    sys.executable,
+                    "-m",
+                    "conda",
+                    "install",
+                    "--yes",
+                    "--prefix",
+                    str(conda_prefix),
+                    "--file",
+                    str(explicit_filename),
+                ],
+                check=True,
+            )
+
+        installed = {
+            (record.subdir, record.fn)
+            # reload in case a previous attempt populated the cache of
+            # PrefixData for this prefix
+            for record in PrefixData(str(conda_prefix)).reload().iter_records()
+        }
+        if installed != set(packages):
+            raise ValueError(
+                "incrementally built prefix does not match the lockfile: "
+                f"missing={sorted(set(packages) - installed)} "
+                f"unexpected={sorted(installed - set(packages))}"
+            )
+    except Exception as e:
+        context.log.warning(f"incremental build failed, falling back: {e}")
+        shutil.rmtree(conda_prefix, ignore_errors=True)
+        return False
+
+    return True
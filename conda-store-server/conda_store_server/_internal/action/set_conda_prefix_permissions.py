@@ -2,6 +2,7 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import os
 import pathlib
 import stat
 
@@ -15,6 +16,7 @@ def action_set_conda_prefix_permissions(
     permissions: str,
     uid: int,
     gid: int,
+    max_workers: int = min(4, os.cpu_count() or 1),
 ):
     conda_prefix = conda_prefix.resolve()
 
@@ -30,10 +32,9 @@ def action_set_conda_prefix_permissions(
         context.log.info(
             f"modifying permissions of {conda_prefix} to permissions={permissions}"
         )
-        with utils.timer(context.log, f"chmod of {conda_prefix}"):
-            utils.chmod(conda_prefix, permissions)
     else:
         context.log.info(f"no changes for permissions of conda_prefix {conda_prefix}")
+        permissions = None
 
     if (
         uid is not None
@@ -43,7 +44,19 @@ def action_set_conda_prefix_permissions(
         context.log.info(
             f"modifying permissions of conda_prefix {conda_prefix} to uid={uid} and gid={gid}"
         )
-        with utils.timer(context.log, f"chown of {conda_prefix}"):
-            utils.chown(conda_prefix, uid, gid)
     else:
         context.log.info(f"no changes for gid and uid of conda_prefix {conda_prefix}")
+        uid = gid = None
+
+    if permissions is None and uid is None:
+        return
+
+    with utils.timer(context.log, f"chmod and chown of {conda_prefix}"):
+        changed = utils.set_permissions(
+            conda_prefix,
+            permissions=permissions,
+            uid=uid,
+            gid=gid,
+            max_workers=max_workers,
+        )
+    context.log.info(f"modified permissions or owner of {changed} entries")
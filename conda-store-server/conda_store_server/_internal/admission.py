@@ -0,0 +1,76 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Admission control of builds on a worker
+
+Before task_build_conda_environment starts a build, the worker checks that
+it has the resources to complete it:
+
+ - the free disk in CondaStore.store_directory is at least
+   CondaStore.storage_threshold
+ - the conda package cache is smaller than CondaStore.build_pkgs_dir_max_size,
+   its size being computed at most once a minute, see pkgs_cache.packages_size
+ - the available memory is at least CondaStore.build_min_available_memory
+
+Builds which are not admitted are deferred and retried later, possibly by
+another worker, see task_build_conda_environment.
+"""
+
+import os
+import shutil
+import typing
+
+from conda_store_server._internal import conda_utils, pkgs_cache
+
+
+def available_memory() -> typing.Optional[int]:
+    """Memory in bytes available for new processes without swapping
+
+    Returns None if it cannot be determined on this platform.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def check_build_resources(conda_store) -> typing.Optional[str]:
+    """Returns why the worker cannot start a build, None if it can"""
+    storage_threshold = conda_store.config.storage_threshold
+    if storage_threshold:
+        free = shutil.disk_usage(conda_store.config.store_directory).free
+        if free < storage_threshold:
+            return (
+                f"free storage {free} bytes in {conda_store.config.store_directory} "
+                f"is below CondaStore.storage_threshold {storage_threshold} bytes"
+            )
+
+    max_pkgs_dir_size = conda_store.config.build_pkgs_dir_max_size
+    if max_pkgs_dir_size:
+        pkgs_dir = conda_utils.conda_root_package_dir()
+        size = pkgs_cache.packages_size(pkgs_dir) if pkgs_dir.exists() else 0
+        if size > max_pkgs_dir_size:
+            return (
+                f"package cache {pkgs_dir} size {size} bytes exceeds "
+                f"CondaStore.build_pkgs_dir_max_size {max_pkgs_dir_size} bytes"
+            )
+
+    min_memory = conda_store.config.build_min_available_memory
+    if min_memory:
+        memory = available_memory()
+        if memory is not None and memory < min_memory:
+            return (
+                f"available memory {memory} bytes is below "
+                f"CondaStore.build_min_available_memory {min_memory} bytes"
+            )
+
+    return None
@@ -0,0 +1,32 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""add build size unique and package sizes
+
+Revision ID: 2e9c4b7d18a5
+Revises: 7a3f2d91c0b4
+Create Date: 2026-10-17 16:05:33.704152
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "2e9c4b7d18a5"
+down_revision = "7a3f2d91c0b4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("build", sa.Column("size_unique", sa.BigInteger(), nullable=True))
+    op.add_column("build", sa.Column("package_sizes", sa.JSON(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("build", "package_sizes")
+    op.drop_column("build", "size_unique")
@@ -0,0 +1,38 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""add build lease
+
+Revision ID: 5f3a8c1d9e47
+Revises: 9b1d5e3a7c20
+Create Date: 2026-10-17 20:12:37.104829
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "5f3a8c1d9e47"
+down_revision = "9b1d5e3a7c20"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "build_lease",
+        sa.Column("build_id", sa.Integer(), nullable=False),
+        sa.Column("worker_id", sa.Unicode(length=255), nullable=False),
+        sa.Column("acquired_on", sa.DateTime(), nullable=False),
+        sa.Column("expires_on", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["build_id"], ["build.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("build_id"),
+    )
+
+
+def downgrade():
+    op.drop_table("build_lease")
@@ -0,0 +1,36 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""add build lockfile hash
+
+Revision ID: 7a3f2d91c0b4
+Revises: c4a9f1e2b7d3
+Create Date: 2026-10-17 13:48:09.512377
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "7a3f2d91c0b4"
+down_revision = "c4a9f1e2b7d3"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "build", sa.Column("lockfile_hash", sa.Unicode(length=64), nullable=True)
+    )
+    op.create_index(
+        op.f("ix_build_lockfile_hash"), "build", ["lockfile_hash"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_build_lockfile_hash"), table_name="build")
+    op.drop_column("build", "lockfile_hash")
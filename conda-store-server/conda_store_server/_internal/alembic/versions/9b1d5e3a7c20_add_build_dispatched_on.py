@@ -0,0 +1,32 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""add build dispatched_on
+
+Revision ID: 9b1d5e3a7c20
+Revises: 2e9c4b7d18a5
+Create Date: 2026-10-17 18:41:12.518303
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "9b1d5e3a7c20"
+down_revision = "2e9c4b7d18a5"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("build", sa.Column("dispatched_on", sa.DateTime(), nullable=True))
+    # Builds created before the scheduler existed were dispatched on creation
+    op.execute("UPDATE build SET dispatched_on = scheduled_on")
+
+
+def downgrade():
+    op.drop_column("build", "dispatched_on")
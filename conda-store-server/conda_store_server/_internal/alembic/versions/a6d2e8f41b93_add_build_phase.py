@@ -0,0 +1,47 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""add build phase
+
+Revision ID: a6d2e8f41b93
+Revises: 5f3a8c1d9e47
+Create Date: 2026-10-17 21:03:52.771204
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "a6d2e8f41b93"
+down_revision = "5f3a8c1d9e47"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "build_phase",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("build_id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.Unicode(length=255), nullable=False),
+        sa.Column("started_on", sa.DateTime(), nullable=False),
+        sa.Column("wall_time", sa.Float(), nullable=False),
+        sa.Column("cpu_time", sa.Float(), nullable=True),
+        sa.Column("max_rss", sa.BigInteger(), nullable=True),
+        sa.Column("bytes_read", sa.BigInteger(), nullable=True),
+        sa.Column("bytes_written", sa.BigInteger(), nullable=True),
+        sa.ForeignKeyConstraint(["build_id"], ["build.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_build_phase_build_id"), "build_phase", ["build_id"], unique=False
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_build_phase_build_id"), table_name="build_phase")
+    op.drop_table("build_phase")
@@ -0,0 +1,51 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""add solve cache
+
+Revision ID: c4a9f1e2b7d3
+Revises: bf065abf375b
+Create Date: 2026-10-17 10:12:41.318204
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "c4a9f1e2b7d3"
+down_revision = "bf065abf375b"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "solve_cache",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("key", sa.Unicode(length=255), nullable=False),
+        sa.Column("lock_backend", sa.Unicode(length=255), nullable=False),
+        sa.Column("lockfile", sa.JSON(), nullable=False),
+        sa.Column("created_on", sa.DateTime(), nullable=False),
+        sa.Column("hits", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("key"),
+    )
+
+    for column in ["solve_cache_hits", "solve_cache_misses"]:
+        op.add_column(
+            "conda_store_configuration",
+            sa.Column(
+                column, sa.BigInteger(), nullable=False, server_default=sa.text("0")
+            ),
+        )
+
+
+def downgrade():
+    op.drop_column("conda_store_configuration", "solve_cache_misses")
+    op.drop_column("conda_store_configuration", "solve_cache_hits")
+
+    op.drop_table("solve_cache")
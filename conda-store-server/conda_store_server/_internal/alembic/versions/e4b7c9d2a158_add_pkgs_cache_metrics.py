@@ -0,0 +1,44 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""add pkgs cache metrics
+
+Revision ID: e4b7c9d2a158
+Revises: a6d2e8f41b93
+Create Date: 2026-10-17 22:15:09.382641
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "e4b7c9d2a158"
+down_revision = "a6d2e8f41b93"
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    "pkgs_cache_hits",
+    "pkgs_cache_misses",
+    "pkgs_cache_evicted_packages",
+    "pkgs_cache_evicted_bytes",
+]
+
+
+def upgrade():
+    for column in COLUMNS:
+        op.add_column(
+            "conda_store_configuration",
+            sa.Column(
+                column, sa.BigInteger(), nullable=False, server_default=sa.text("0")
+            ),
+        )
+
+
+def downgrade():
+    for column in reversed(COLUMNS):
+        op.drop_column("conda_store_configuration", column)
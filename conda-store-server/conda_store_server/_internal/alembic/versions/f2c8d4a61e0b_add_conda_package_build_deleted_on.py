@@ -0,0 +1,32 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""add conda package build deleted_on
+
+Revision ID: f2c8d4a61e0b
+Revises: e4b7c9d2a158
+Create Date: 2026-10-17 23:41:27.518306
+
+"""
+
+import sqlalchemy as sa
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "f2c8d4a61e0b"
+down_revision = "e4b7c9d2a158"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "conda_package_build", sa.Column("deleted_on", sa.DateTime(), nullable=True)
+    )
+
+
+def downgrade():
+    op.drop_column("conda_package_build", "deleted_on")
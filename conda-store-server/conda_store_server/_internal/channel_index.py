@@ -0,0 +1,461 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Indexing of the packages of a conda channel into the database
+
+For each subdir of a channel, every package build of the repodata
+(`conda_package_build`) is inserted unless a build with the same sha256 is
+already indexed, together with its package (`conda_package`), the name and
+version of the build, if it is new.
+
+Channels like conda-forge have hundreds of thousands of package builds, so
+the records of the repodata are handled in batches of BATCH_SIZE:
+ - the sha256 of the builds already indexed for the subdir are loaded once
+   into a set, without loading the ORM objects
+ - the ids of the packages of a batch are looked up by name, only for the
+   packages which are not in the cache of the ids of the previous batches
+ - the missing packages and then the new builds of the batch are inserted
+   with bulk inserts and committed
+
+On PostgreSQL, the rows are not inserted with executemany but streamed with
+COPY into a temporary staging table, which is merged into the table with
+INSERT ... ON CONFLICT DO NOTHING, see copy_insert.
+
+When the records are read from the repodata cache, builds removed from the
+repodata are tombstoned by setting their deleted_on, and tombstoned builds
+which are back in the repodata are restored, see index_changes: only the
+records which changed since the repodata was last indexed are inserted, and
+only the builds removed since are tombstoned. The first time a subdir is
+indexed from the cache, its records are all its package builds and the
+indexed builds which are missing from them are tombstoned.
+"""
+
+import datetime
+import io
+import json
+import typing
+
+from sqlalchemy import JSON, update
+from sqlalchemy.exc import IntegrityError
+
+from conda_store_server._internal import orm, utils
+
+# Number of repodata records inserted per transaction, and of rows fetched
+# per round trip when loading existing rows
+BATCH_SIZE = 10_000
+
+# Number of package names per IN clause, sqlite3 versions older than 3.32
+# allow at most 999 parameters per statement
+NAME_BATCH_SIZE = 900
+
+# Database dialects whose rows are inserted with COPY, see copy_insert
+COPY_DIALECTS = {"postgresql"}
+
+# Keys which package builds must have to be indexed
+REQUIRED_KEYS = ["build", "build_number", "depends", "md5", "sha256", "size"]
+
+PackageKey = typing.Tuple[str, str]
+
+
+def load_package_build_sha256(
+    db, channel_id: int, subdir: str, deleted: bool = False
+) -> typing.Set[str]:
+    """sha256 of the package builds of a channel subdir already indexed, only
+    of the tombstoned ones if deleted
+    """
+    query = (
+        db.query(orm.CondaPackageBuild.sha256)
+        .join(orm.CondaPackageBuild.package)
+        .filter(orm.CondaPackage.channel_id == channel_id)
+        .filter(orm.CondaPackageBuild.subdir == subdir)
+    )
+    if deleted:
+        query = query.filter(orm.CondaPackageBuild.deleted_on.is_not(None))
+    return {sha256 for (sha256,) in query.yield_per(BATCH_SIZE)}
+
+
+def load_package_build_deleted(
+    db, channel_id: int, subdir: str, sha256: typing.Iterable[str]
+) -> typing.Dict[str, bool]:
+    """Whether the indexed package builds of a channel subdir with the given
+    sha256 are tombstoned
+    """
+    sha256 = sorted(set(sha256))
+    deleted = {}
+    for start in range(0, len(sha256), NAME_BATCH_SIZE):
+        query = db.query(
+            orm.CondaPackageBuild.sha256, orm.CondaPackageBuild.deleted_on
+        ).filter(
+            orm.CondaPackageBuild.channel_id == channel_id,
+            orm.CondaPackageBuild.subdir == subdir,
+            orm.CondaPackageBuild.sha256.in_(sha256[start : start + NAME_BATCH_SIZE]),
+        )
+        for build_sha256, deleted_on in query:
+            deleted[build_sha256] = deleted_on is not None
+    return deleted
+
+
+def load_package_ids(
+    db, channel_id: int, keys: typing.Iterable[PackageKey]
+) -> typing.Dict[PackageKey, int]:
+    """Ids of the packages of a channel with the given (name, version)"""
+    keys = set(keys)
+    names = sorted({name for name, _ in keys})
+    package_ids = {}
+    for start in range(0, len(names), NAME_BATCH_SIZE):
+        query = db.query(
+            orm.CondaPackage.id, orm.CondaPackage.name, orm.CondaPackage.version
+        ).filter(
+            orm.CondaPackage.channel_id == channel_id,
+            orm.CondaPackage.name.in_(names[start : start + NAME_BATCH_SIZE]),
+        )
+        for package_id, name, version in query:
+            if (name, version) in keys:
+                package_ids[(name, version)] = package_id
+    return package_ids
+
+
+def package_mapping(
+    channel_id: int, record: typing.Dict, package_info: typing.Dict
+) -> typing.Dict:
+    info = package_info.get(record["name"], {})
+    return {
+        "channel_id": channel_id,
+        "license": record.get("license"),
+        "license_family": record.get("license_family"),
+        "name": record["name"],
+        "version": record["version"],
+        "summary": info.get("summary"),
+        "description": info.get("description"),
+    }
+
+
+def package_build_mapping(
+    channel_id: int, record: typing.Dict
+) -> typing.Optional[typing.Dict]:
+    """The conda_package_build row of a repodata record, None if the record
+    lacks one of REQUIRED_KEYS
+    """
+    if any(record.get(key) is None for key in REQUIRED_KEYS):
+        return None
+
+    return {
+        "build": record["build"],
+        "build_number": record["build_number"],
+        "channel_id": channel_id,
+        "constrains": record.get("constrains"),
+        "depends": record["depends"] or "",
+        "md5": record["md5"],
+        "sha256": record["sha256"],
+        "size": record["size"],
+        "subdir": record.get("subdir"),
+        "timestamp": record.get("timestamp"),
+    }
+
+
+def set_deleted_on(
+    db,
+    channel_id: int,
+    subdir: str,
+    sha256: typing.Iterable[str],
+    deleted_on: typing.Optional[datetime.datetime],
+) -> int:
+    """Tombstones, or restores if deleted_on is None, package builds, returns
+    the number of package builds tombstoned or restored
+    """
+    if deleted_on is None:
+        changed = orm.CondaPackageBuild.deleted_on.is_not(None)
+    else:
+        changed = orm.CondaPackageBuild.deleted_on.is_(None)
+
+    sha256 = sorted(sha256)
+    updated = 0
+    try:
+        for start in range(0, len(sha256), NAME_BATCH_SIZE):
+            result = db.execute(
+                update(orm.CondaPackageBuild)
+                .where(
+                    orm.CondaPackageBuild.channel_id == channel_id,
+                    orm.CondaPackageBuild.subdir == subdir,
+                    orm.CondaPackageBuild.sha256.in_(
+                        sha256[start : start + NAME_BATCH_SIZE]
+                    ),
+                    changed,
+                )
+                .values(deleted_on=deleted_on)
+            )
+            updated += result.rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return updated
+
+
+def copy_value(value, column) -> str:
+    """Value of column in the text format of COPY"""
+    if isinstance(column.type, JSON):
+        # Like the engine, which persists None as the JSON null
+        value = json.dumps(value, cls=utils.CustomJSONEncoder)
+    elif value is None:
+        return r"\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_insert(db, model, mappings: typing.List[typing.Dict]) -> int:
+    """Inserts mappings into the table of model with COPY, returns the number
+    of rows inserted
+
+    The rows are copied into a temporary staging table, dropped on commit,
+    then merged into the table, skipping the rows which conflict with a
+    unique constraint, e.g. packages inserted concurrently by the task
+    indexing another subdir. Requires a psycopg2 connection.
+    """
+    table = model.__table__
+    columns = [table.c[key] for key in mappings[0]]
+    preparer = db.get_bind().dialect.identifier_preparer
+    table_name = preparer.format_table(table)
+    staging_name = preparer.quote(f"{table.name}_staging")
+    column_names = ", ".join(preparer.format_column(column) for column in columns)
+
+    rows = io.StringIO()
+    for mapping in mappings:
+        rows.write("\t".join(copy_value(mapping[c.key], c) for c in columns))
+        rows.write("\n")
+    rows.seek(0)
+
+    try:
+        with db.connection().connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE TEMPORARY TABLE {staging_name} ON COMMIT DROP AS "
+                f"SELECT {column_names} FROM {table_name} WITH NO DATA"
+            )
+            cursor.copy_expert(f"COPY {staging_name} ({column_names}) FROM STDIN", rows)
+            cursor.execute(
+                f"INSERT INTO {table_name} ({column_names}) "
+                f"SELECT {column_names} FROM {staging_name} ON CONFLICT DO NOTHING"
+            )
+            inserted = cursor.rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return inserted
+
+
+def bulk_insert(db, model, mappings: typing.List[typing.Dict]) -> int:
+    """Inserts mappings into the table of model, returns the number of rows
+    inserted
+    """
+    if not mappings:
+        return 0
+    if db.get_bind().dialect.name in COPY_DIALECTS:
+        return copy_insert(db, model, mappings)
+
+    try:
+        db.bulk_insert_mappings(model, mappings)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(mappings)
+
+
+class ChannelIndexer:
+    """Indexes the repodata records of the subdirs of a channel"""
+
+    def __init__(self, db, channel_id: int, package_info: typing.Dict = None):
+        self.db = db
+        self.channel_id = channel_id
+        # channeldata of the packages by name, for their summary and
+        # description
+        self.package_info = package_info or {}
+        # Ids of the packages of the channel looked up or inserted so far,
+        # packages are shared by the subdirs
+        self.package_ids: typing.Dict[PackageKey, int] = {}
+        self.stats = {
+            "packages": 0,
+            "package_builds": 0,
+            "tombstoned": 0,
+            "restored": 0,
+        }
+
+    def _insert_packages(self, new_packages: typing.Dict[PackageKey, typing.Dict]):
+        try:
+            inserted = bulk_insert(
+                self.db, orm.CondaPackage, list(new_packages.values())
+            )
+        except IntegrityError:
+            # Some of the packages were inserted since they were looked up,
+            # by the task indexing another subdir of the channel
+            self.package_ids.update(
+                load_package_ids(self.db, self.channel_id, new_packages)
+            )
+            new_packages = {
+                key: package
+                for key, package in new_packages.items()
+                if key not in self.package_ids
+            }
+            inserted = bulk_insert(
+                self.db, orm.CondaPackage, list(new_packages.values())
+            )
+
+        self.package_ids.update(
+            load_package_ids(self.db, self.channel_id, new_packages)
+        )
+        self.stats["packages"] += inserted
+
+    def _insert_batch(self, batch: typing.List[typing.Tuple[typing.Dict, typing.Dict]]):
+        """Inserts a batch of (repodata record, conda_package_build row)"""
+        missing_keys = {
+            (record["name"], record["version"])
+            for record, _ in batch
+            if (record["name"], record["version"]) not in self.package_ids
+        }
+        self.package_ids.update(
+            load_package_ids(self.db, self.channel_id, missing_keys)
+        )
+
+        new_packages = {}
+        for record, _ in batch:
+            key = (record["name"], record["version"])
+            if key not in self.package_ids and key not in new_packages:
+                new_packages[key] = package_mapping(
+                    self.channel_id, record, self.package_info
+                )
+        if new_packages:
+            self._insert_packages(new_packages)
+
+        for record, package_build in batch:
+            package_build["package_id"] = self.package_ids[
+                (record["name"], record["version"])
+            ]
+        self.stats["package_builds"] += bulk_insert(
+            self.db,
+            orm.CondaPackageBuild,
+            [package_build for _, package_build in batch],
+        )
+
+    def index_subdir(
+        self,
+        subdir: str,
+        records: typing.Iterable[typing.Dict],
+        tombstone: bool = False,
+    ):
+        """Inserts the records of subdir whose sha256 is not indexed yet
+
+        If tombstone, records are all the package builds of subdir and the
+        indexed package builds missing from them are tombstoned.
+        """
+        indexed_sha256 = load_package_build_sha256(self.db, self.channel_id, subdir)
+        seen_sha256 = set()
+
+        batch = []
+        for record in records:
+            package_build = package_build_mapping(self.channel_id, record)
+            if package_build is None:
+                continue
+            if tombstone:
+                seen_sha256.add(package_build["sha256"])
+            # Also skips duplicates within the repodata
+            if package_build["sha256"] in indexed_sha256:
+                continue
+            indexed_sha256.add(package_build["sha256"])
+
+            batch.append((record, package_build))
+            if len(batch) >= BATCH_SIZE:
+                self._insert_batch(batch)
+                batch = []
+
+        if batch:
+            self._insert_batch(batch)
+
+        if tombstone:
+            deleted_sha256 = load_package_build_sha256(
+                self.db, self.channel_id, subdir, deleted=True
+            )
+            self._set_deleted(
+                subdir,
+                removed_sha256=indexed_sha256 - seen_sha256 - deleted_sha256,
+                restored_sha256=deleted_sha256 & seen_sha256,
+            )
+
+    def index_changes(self, subdir: str, changes):
+        """Indexes the repodata_cache.SubdirChanges of subdir
+
+        The records which changed are inserted, or restored if they were
+        tombstoned, and the builds removed from the repodata are tombstoned.
+        """
+        if changes.complete:
+            self.index_subdir(subdir, changes, tombstone=True)
+            return
+
+        seen_sha256 = set()
+        restored_sha256 = set()
+
+        batch = []
+        for record in changes:
+            package_build = package_build_mapping(self.channel_id, record)
+            if package_build is None or package_build["sha256"] in seen_sha256:
+                continue
+            seen_sha256.add(package_build["sha256"])
+
+            batch.append((record, package_build))
+            if len(batch) >= BATCH_SIZE:
+                restored_sha256.update(self._insert_changes(subdir, batch))
+                batch = []
+
+        if batch:
+            restored_sha256.update(self._insert_changes(subdir, batch))
+
+        self._set_deleted(
+            subdir,
+            # A build may have been moved to another filename
+            removed_sha256=changes.removed_sha256 - seen_sha256,
+            restored_sha256=restored_sha256,
+        )
+
+    def _insert_changes(
+        self, subdir: str, batch: typing.List[typing.Tuple[typing.Dict, typing.Dict]]
+    ) -> typing.Set[str]:
+        """Inserts the records of a batch which are not indexed yet, returns
+        the sha256 of the ones which are tombstoned
+        """
+        deleted = load_package_build_deleted(
+            self.db,
+            self.channel_id,
+            subdir,
+            (package_build["sha256"] for _, package_build in batch),
+        )
+        new_batch = [
+            (record, package_build)
+            for record, package_build in batch
+            if package_build["sha256"] not in deleted
+        ]
+        if new_batch:
+            self._insert_batch(new_batch)
+        return {sha256 for sha256, is_deleted in deleted.items() if is_deleted}
+
+    def _set_deleted(
+        self,
+        subdir: str,
+        removed_sha256: typing.Set[str],
+        restored_sha256: typing.Set[str],
+    ):
+        self.stats["tombstoned"] += set_deleted_on(
+            self.db,
+            self.channel_id,
+            subdir,
+            removed_sha256,
+            datetime.datetime.utcnow(),
+        )
+        self.stats["restored"] += set_deleted_on(
+            self.db, self.channel_id, subdir, restored_sha256, None
+        )
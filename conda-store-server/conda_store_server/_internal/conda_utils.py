@@ -11,13 +11,35 @@ executing conda commands
 import bz2
 import datetime
 import json
+import os
 import pathlib
 import subprocess
 import tempfile
+import threading
+import typing
 
+import ijson
 import requests
 import yaml
 import yarl
+import zstandard
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Retries of the requests to conda channels failing to connect or with a
+# transient error status, waiting HTTP_BACKOFF_FACTOR * 2 ** retry seconds
+# between them unless the server sends a Retry-After header
+HTTP_RETRIES = 5
+HTTP_BACKOFF_FACTOR = 0.5
+HTTP_RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# Connections kept open per host, enough for the concurrent downloads of the
+# subdirs of a channel
+HTTP_POOL_MAXSIZE = 16
+
+_http_session = None
+_http_session_pid = None
+_http_session_lock = threading.Lock()
 
 
 def normalize_channel_name(channel_alias, channel):
@@ -134,10 +156,94 @@ def get_channel_url(channel: str) -> yarl.URL:
     return channel_replacements.get(str(normalized_channel_url), yarl.URL(channel))
 
 
+def http_session() -> requests.Session:
+    """HTTP session of the process used to download from conda channels
+
+    The session pools the connections to the channels, so that they are
+    reused by the requests of all the subdirs, and retries the requests with
+    exponential backoff. It is shared by threads and created again in
+    processes forked after its creation, e.g. celery workers.
+    """
+    global _http_session, _http_session_pid
+
+    with _http_session_lock:
+        if _http_session is None or _http_session_pid != os.getpid():
+            retry = Retry(
+                total=HTTP_RETRIES,
+                backoff_factor=HTTP_BACKOFF_FACTOR,
+                status_forcelist=HTTP_RETRY_STATUSES,
+                # Returns the last response instead of raising, so that
+                # callers raise requests.HTTPError with raise_for_status
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session, _http_session_pid = session, os.getpid()
+        return _http_session
+
+
+def open_decompressed(fileobj: typing.BinaryIO, compression: str) -> typing.BinaryIO:
+    """Binary file object of the decompressed contents of fileobj, which is
+    read incrementally
+    """
+    if compression == "bz2":
+        return bz2.BZ2File(fileobj)
+    elif compression == "zst":
+        return zstandard.ZstdDecompressor().stream_reader(fileobj)
+    return fileobj
+
+
+def iter_repodata_items(
+    fileobj: typing.BinaryIO,
+) -> typing.Iterator[typing.Tuple[str, typing.Dict]]:
+    """Filenames and package records of a repodata.json file object, of both
+    its .tar.bz2 ("packages") and .conda ("packages.conda") packages
+
+    The document is parsed incrementally, so that only one record is held in
+    memory at a time.
+    """
+    # Both maps are read in a single pass, by parsing the records of
+    # "packages.conda" as if they were in "packages"
+    events = (
+        ("packages" if prefix == "packages.conda" else prefix, event, value)
+        for prefix, event, value in ijson.parse(fileobj, use_float=True)
+    )
+    yield from ijson.kvitems(events, "packages")
+
+
+def iter_repodata_records(fileobj: typing.BinaryIO) -> typing.Iterator[typing.Dict]:
+    """Package records of a repodata.json file object, see iter_repodata_items"""
+    for _, record in iter_repodata_items(fileobj):
+        yield record
+
+
+def stream_repodata_records(
+    url: str, headers: typing.Dict[str, str] = None
+) -> typing.Iterator[typing.Dict]:
+    """Package records of the possibly compressed repodata.json at url
+
+    The response is decompressed and parsed while it is downloaded. Yields
+    nothing if the server responds 304 Not Modified.
+    """
+    compression = url.rsplit(".", 1)[-1]
+    with http_session().get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:  # 304 Not Modified since last_update
+            return
+        response.raise_for_status()
+        # Decodes the Content-Encoding, e.g. gzip, of the response
+        response.raw.decode_content = True
+        with open_decompressed(response.raw, compression) as f:
+            yield from iter_repodata_records(f)
+
+
 def download_repodata(
     channel: str,
     last_update: datetime.datetime = None,
     subdirs=None,
+    cache_dir: str = None,
+    max_workers: int = None,
 ):
     """Download repodata for channel only if changed since last update
 
@@ -146,7 +252,23 @@ def download_repodata(
     osx-64, win-32, win-64, zos-z (possibly others).
 
     Check ``conda.base.constants.KNOWN_SUBDIRS`` for the full list.
+
+    The repodata of each architecture is an iterator over its package
+    records, which downloads and parses repodata.json.bz2 while it is
+    consumed, see stream_repodata_records.
+
+    If cache_dir is given, the repodata is kept in an on-disk cache within it
+    and only downloaded if changed since it was cached, by up to max_workers
+    concurrent threads, last_update is not used, see
+    repodata_cache.download_repodata.
     """
+    if cache_dir is not None:
+        from conda_store_server._internal import repodata_cache
+
+        return repodata_cache.download_repodata(
+            channel, cache_dir, subdirs=subdirs, max_workers=max_workers
+        )
+
     subdirs = set(subdirs or [conda_platform(), "noarch"])
 
     channel_url = get_channel_url(channel)
@@ -160,21 +282,18 @@ def download_repodata(
         # be ignored
         headers["If-Modified-Since"] = last_update.strftime("%a, %d %b %Y %H:%M:%S GMT")
 
-    response = requests.get(channel_url / "channeldata.json", headers=headers)
+    response = http_session().get(channel_url / "channeldata.json", headers=headers)
     if response.status_code == 304:  # 304 Not Modified since last_update
         return {"architectures": {}}
     response.raise_for_status()
 
     repodata = response.json()
-    repodata["architectures"] = {}
-    for subdir in subdirs:
-        response = requests.get(
-            channel_url / subdir / "repodata.json.bz2", headers=headers
+    repodata["architectures"] = {
+        subdir: stream_repodata_records(
+            str(channel_url / subdir / "repodata.json.bz2"), headers=headers
         )
-        if response.status_code == 304:  # 304 Not Modified since last_update
-            continue
-        response.raise_for_status()
-        repodata["architectures"][subdir] = json.loads(bz2.decompress(response.content))
+        for subdir in subdirs
+    }
     return repodata
 
 
@@ -18,15 +18,14 @@ from sqlalchemy import (
     Boolean,
     Column,
     DateTime,
+    Float,
     ForeignKey,
     Table,
     Text,
     Unicode,
     UnicodeText,
     UniqueConstraint,
-    and_,
     create_engine,
-    or_,
 )
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import (
@@ -260,9 +259,16 @@ class Build(Base):
     # sensitive data here
     status_info: Mapped[str] = mapped_column(UnicodeText, default=None)
     size: Mapped[int] = mapped_column(BigInteger, default=0)
+    # Bytes of the prefix which are not hardlinked from the package cache
+    size_unique: Mapped[int] = mapped_column(BigInteger, default=None)
+    # Bytes used by each package in the prefix, by package name
+    package_sizes: Mapped[dict] = mapped_column(JSON, default=None)
     scheduled_on: Mapped[datetime.datetime] = mapped_column(
         DateTime, default=datetime.datetime.utcnow
     )
+    # Time the build was handed to the workers by the scheduler, builds
+    # which are QUEUED without it are waiting for capacity, see scheduler.py
+    dispatched_on: Mapped[datetime.datetime] = mapped_column(DateTime, default=None)
     started_on: Mapped[datetime.datetime] = mapped_column(DateTime, default=None)
     ended_on: Mapped[datetime.datetime] = mapped_column(DateTime, default=None)
     deleted_on: Mapped[datetime.datetime] = mapped_column(DateTime, default=None)
@@ -270,6 +276,11 @@ class Build(Base):
     # Only used by build_key_version 3, not necessary for earlier versions
     hash: Mapped[str] = mapped_column(Unicode(32), default=None)
 
+    # Canonical hash of the packages installed into the prefix and the
+    # permissions applied to it. Builds with the same lockfile_hash share
+    # their prefix and conda-pack archive, see build.shared_build_prefix
+    lockfile_hash: Mapped[str] = mapped_column(Unicode(64), default=None, index=True)
+
     @staticmethod
     def _get_build_key_version():
         # Uses local import to make sure BuildKey is initialized
@@ -395,7 +406,10 @@ class Build(Base):
 
     @property
     def conda_pack_key(self):
-        return f"archive/{self.build_key}.tar.gz"
+        return self.get_conda_pack_key("tar.gz")
+
+    def get_conda_pack_key(self, format: str):
+        return f"archive/{self.build_key}.{format}"
 
     @property
     def constructor_installer_key(self):
@@ -441,6 +455,54 @@ class Build(Base):
         return f"<Build (id={self.id} status={self.status} nbr package_builds={len(self.package_builds)})>"
 
 
+class BuildLease(Base):
+    """Lease of a worker on a build it is running
+
+    The worker renews the lease while the build is running, builds whose
+    lease expired are marked as failed by build_cleanup.
+    """
+
+    __tablename__ = "build_lease"
+
+    build_id: Mapped[int] = mapped_column(
+        ForeignKey("build.id", ondelete="CASCADE"), primary_key=True
+    )
+
+    # Identifies the worker process, as hostname:pid
+    worker_id: Mapped[str] = mapped_column(Unicode(255))
+
+    acquired_on: Mapped[datetime.datetime] = mapped_column(
+        DateTime, default=datetime.datetime.utcnow
+    )
+    expires_on: Mapped[datetime.datetime] = mapped_column(DateTime)
+
+
+class BuildPhase(Base):
+    """Wall time and resource usage of a phase of a build
+
+    Resource usage covers the worker process and the child processes it
+    reaped during the phase, it is None on platforms without getrusage.
+    """
+
+    __tablename__ = "build_phase"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+
+    build_id: Mapped[int] = mapped_column(
+        ForeignKey("build.id", ondelete="CASCADE"), index=True
+    )
+
+    name: Mapped[str] = mapped_column(Unicode(255))
+    started_on: Mapped[datetime.datetime] = mapped_column(DateTime)
+    # Seconds
+    wall_time: Mapped[float] = mapped_column(Float)
+    cpu_time: Mapped[float] = mapped_column(Float, nullable=True)
+    # Bytes
+    max_rss: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    bytes_read: Mapped[int] = mapped_column(BigInteger, nullable=True)
+    bytes_written: Mapped[int] = mapped_column(BigInteger, nullable=True)
+
+
 class BuildArtifact(Base):
     """Artifacts of a given build"""
 
@@ -495,226 +557,49 @@ class CondaChannel(Base):
     name: Mapped[str] = mapped_column(Unicode(255), unique=True, nullable=False)
     last_update: Mapped[datetime.datetime] = mapped_column(DateTime)
 
-    def update_packages(self, db, subdirs=None):
+    def update_packages(self, db, subdirs=None, cache_dir=None, max_workers=None):
         logger.info(f"update packages {self.name} ")
 
         logger.info("Downloading repodata ...  ")
         repodata = conda_utils.download_repodata(
-            self.name, self.last_update, subdirs=subdirs
+            self.name,
+            self.last_update,
+            subdirs=subdirs,
+            cache_dir=cache_dir,
+            max_workers=max_workers,
         )
-        logger.info("repodata downloaded ")
-
-        # Hint : you can store the file locally for later debug
-        # with open(f"~/{self.name.split('/')[-1]}_{datetime.datetime.now()}.json", "w") as f:
-        #    f.write(json.dumps(repodata, indent=4, sort_keys=True))
+        logger.info("channeldata downloaded, repodata is streamed per architecture")
 
         if not repodata:
             # nothing to update
             return
 
+        # Uses local imports to avoid a circular import with orm
+        from conda_store_server._internal import repodata_cache
+        from conda_store_server._internal.channel_index import ChannelIndexer
+
+        indexer = ChannelIndexer(db, self.id, package_info=repodata.get("packages"))
         for architecture in repodata["architectures"]:
             logger.info(f"architecture  : {architecture} ")
-
-            """
-            Context :
-               For each architecture, we need to add all the packages (`conda_package`),
-               and all their builds (`conda_package_build`), with their relationship.
-               As of May 2022, based on the default channels `main` and `conda-forge`,
-               there are 136K packages and 367K conda_package_build
-
-            Trick :
-               To insert these data fast, we need to get rid of the overhead induced
-               by the ORM layer, and use session.bulk_insert_mappings.
-
-            Caveat :
-               bulk insertion is handy, but we need to avoid breaking integrity constraint,
-               This implies that we need to bulk_insert only new data, filtering out
-               the data already in the DB
-
-            Algorithm :
-               First step :  we insert all the new conda_package rows
-               Second step : we insert all the new conda_package_builds rows
-
-               These steps are detailled below.
-            """
-
-            # package_data contains all the data for the iterated architecture.
-            # Each dict represents a conda_package_build and also contains
-            # thge data of the conda_package
-            packages_data = list(
-                repodata["architectures"][architecture]["packages"].values()
-            )
-
-            # First, we retrieve all the pairs "package name - pacakge version"
-            # in the DB. This represents all the existing packages.
-            existing_packages_keys = [
-                f"{_[0]}-{_[1]}-{self.id}"
-                for _ in db.query(CondaPackage.name, CondaPackage.version)
-                .filter(CondaPackage.channel_id == self.id)
-                .all()
-            ]
-
-            # Then, we filter packages_data to keep only the new packages.
-
-            # `packages` associates a key representing the package like "{name}-{version}-{channel_id}"
-            # to a dict representing a new package to insert.
-            # By using a dict with such key, we avoid potential duplicates from within the repodata.
-            packages = {}
-
-            for p_build in packages_data:
-                package_key = f"{p_build['name']}-{p_build['version']}-{self.id}"
-
-                # Filtering out : if the key already exists in existing_packages_keys,
-                # then the package is already if DB, we don't add it.
-                if (
-                    package_key not in packages
-                    and package_key not in existing_packages_keys
-                ):
-                    new_package_dict = {
-                        "channel_id": self.id,
-                        "license": p_build.get("license"),
-                        "license_family": p_build.get("license_family"),
-                        "name": p_build["name"],
-                        "version": p_build["version"],
-                        "summary": repodata.get("packages", {})
-                        .get(p_build["name"], {})
-                        .get("summary"),
-                        "description": repodata.get("packages", {})
-                        .get(p_build["name"], {})
-                        .get("description"),
-                    }
-
-                    packages[package_key] = new_package_dict
-
-            logger.info(f"packages to insert : {len(packages)} ")
-
-            try:
-                db.bulk_insert_mappings(CondaPackage, packages.values())
-                db.commit()
-            except Exception as e:
-                print(f"{e}")
-                db.rollback()
-                raise e
-
-            logger.info("insert packages done")
-
-            logger.info("retrieving existing sha256  : ")
-            existing_sha256 = {
-                _[0]
-                for _ in db.query(CondaPackageBuild.sha256)
-                .join(CondaPackageBuild.package)
-                .filter(CondaPackage.channel_id == self.id)
-                .filter(CondaPackageBuild.subdir == architecture)
-                .all()
-            }
-            logger.info("retrieved existing sha256  : ")
-            logger.info(f"package data before filtering  : {len(packages_data)} ")
-
-            # We store the package builds in a dict indexed by their sha256
-            # Later, we keep only the values.
-            # That way, any duplicated sha256 from the repodata is erased
-            # Also, we exclude pacakge_builds for which the sha256 is already in the DB
-            packages_builds = {}
-            for pb in packages_data:
-                if pb["sha256"] not in existing_sha256:
-                    packages_builds[pb["sha256"]] = pb
-
-            packages_builds = packages_builds.values()
-            logger.info(f"package builds after filtering : {len(packages_builds)} ")
-
-            # This associates a tuple like "(name,version)" representing a package
-            # to all its builds
-            package_builds = {}
-            logger.info("Creating CondaPackageBuild objects")
-            for p_build in packages_builds:
-                has_null = False
-                non_null_keys = [
-                    "build",
-                    "build_number",
-                    "depends",
-                    "md5",
-                    "sha256",
-                    "size",
-                ]
-                for k in non_null_keys:
-                    if p_build[k] is None:
-                        has_null = True
-                        break
-                if has_null:
-                    continue
-
-                if p_build["depends"] == []:
-                    p_build["depends"] = ""
-
-                package_key = (p_build["name"], p_build["version"])
-
-                new_package_build_dict = {
-                    "build": p_build["build"],
-                    "build_number": p_build["build_number"],
-                    "channel_id": self.id,
-                    "constrains": p_build.get("constrains"),
-                    "depends": p_build["depends"],
-                    "md5": p_build["md5"],
-                    "sha256": p_build["sha256"],
-                    "size": p_build["size"],
-                    "subdir": p_build.get("subdir"),
-                    "timestamp": p_build.get("timestamp"),
-                }
-
-                if package_key not in package_builds:
-                    package_builds[package_key] = []
-
-                package_builds[package_key].append(new_package_build_dict)
-            logger.info("CondaPackageBuild objects created")
-
-            # sqlite3 has a max expression depth of 1000
-            batch_size = 990
-            all_package_keys = list(package_builds.keys())
-            for i in range(0, len(all_package_keys), batch_size):
-                logger.info(f"handling subset at index {i} (batch size {batch_size})")
-                subset_keys = all_package_keys[i : i + batch_size]
-
-                # retrieve the parent packages for the subset
-                logger.info("retrieve the parent packages for the subset ")
-                statements = []
-                for p_name, p_version in subset_keys:
-                    statements.append(
-                        and_(
-                            CondaPackage.name == p_name,
-                            CondaPackage.version == p_version,
-                            CondaPackage.channel_id == self.id,
-                        )
-                    )
-                all_parent_packages = (
-                    db.query(CondaPackage).filter(or_(*statements)).all()
+            if cache_dir is None:
+                indexer.index_subdir(
+                    architecture, repodata["architectures"][architecture]
                 )
-                all_parent_packages = {
-                    (_.name, _.version): _ for _ in all_parent_packages
-                }
-                logger.info(f"parent packages retrieved : {len(all_parent_packages)} ")
-
-                for p_name, p_version in subset_keys:
-                    for p_build_dict in package_builds[(p_name, p_version)]:
-                        p_build_dict["package_id"] = all_parent_packages[
-                            (p_name, p_version)
-                        ].id
-
-                logger.info("ready to bulk save")
-
-            try:
-                flatten = []
-                for p_name, p_version in package_builds:
-                    flatten += package_builds[(p_name, p_version)]
-
-                db.bulk_insert_mappings(CondaPackageBuild, flatten)
-                db.commit()
-                logger.info("bulk saved")
-            except Exception as e:
-                logger.error(f"{e}")
-
-                raise e
-
-            logger.info(f"DONE for architecture  : {architecture}")
+            else:
+                # The changes of the cached repodata of the subdir since it was
+                # last indexed, including the builds removed from the channel
+                indexer.index_changes(
+                    architecture, repodata["architectures"][architecture]
+                )
+                # index_changes committed the package builds, the cached
+                # repodata is only skipped from now on
+                repodata_cache.mark_indexed(self.name, cache_dir, architecture)
+            logger.info(
+                f"DONE for architecture  : {architecture}, inserted "
+                f"{indexer.stats['packages']} packages and "
+                f"{indexer.stats['package_builds']} package builds, tombstoned "
+                f"{indexer.stats['tombstoned']} package builds so far"
+            )
 
         self.last_update = datetime.datetime.utcnow()
         db.commit()
@@ -790,6 +675,8 @@ class CondaPackageBuild(Base):
     size: Mapped[int] = mapped_column(BigInteger)
     subdir: Mapped[str] = mapped_column(Unicode(64))
     timestamp: Mapped[int] = mapped_column(BigInteger)
+    # Set when the package build is removed from the repodata of its channel
+    deleted_on: Mapped[datetime.datetime] = mapped_column(DateTime, nullable=True)
 
     def __repr__(self):
         return f"<CondaPackageBuild (id={self.id} build={self.build} size={self.size} sha256={self.sha256})>"
@@ -804,6 +691,14 @@ class CondaStoreConfiguration(Base):
     free_storage: Mapped[int] = mapped_column(BigInteger, default=0)
     total_storage: Mapped[int] = mapped_column(BigInteger, default=0)
 
+    solve_cache_hits: Mapped[int] = mapped_column(BigInteger, default=0)
+    solve_cache_misses: Mapped[int] = mapped_column(BigInteger, default=0)
+
+    pkgs_cache_hits: Mapped[int] = mapped_column(BigInteger, default=0)
+    pkgs_cache_misses: Mapped[int] = mapped_column(BigInteger, default=0)
+    pkgs_cache_evicted_packages: Mapped[int] = mapped_column(BigInteger, default=0)
+    pkgs_cache_evicted_bytes: Mapped[int] = mapped_column(BigInteger, default=0)
+
     @classmethod
     def configuration(cls, db):
         query = db.query(cls).filter(cls.id == 1)
@@ -822,6 +717,32 @@ class CondaStoreConfiguration(Base):
         configuration.total_storage = disk_usage.total
         db.commit()
 
+    @classmethod
+    def increment_solve_cache_metrics(cls, db, hit: bool):
+        # Ensure the row exists, then increment in SQL so that concurrent
+        # workers do not overwrite each other's counts
+        cls.configuration(db)
+        column = cls.solve_cache_hits if hit else cls.solve_cache_misses
+        db.query(cls).filter(cls.id == 1).update({column: column + 1})
+        db.commit()
+
+    @classmethod
+    def increment_pkgs_cache_metrics(
+        cls, db, hits=0, misses=0, evicted_packages=0, evicted_bytes=0
+    ):
+        cls.configuration(db)
+        db.query(cls).filter(cls.id == 1).update(
+            {
+                cls.pkgs_cache_hits: cls.pkgs_cache_hits + hits,
+                cls.pkgs_cache_misses: cls.pkgs_cache_misses + misses,
+                cls.pkgs_cache_evicted_packages: cls.pkgs_cache_evicted_packages
+                + evicted_packages,
+                cls.pkgs_cache_evicted_bytes: cls.pkgs_cache_evicted_bytes
+                + evicted_bytes,
+            }
+        )
+        db.commit()
+
 
 class KeyValueStore(Base):
     """KeyValueStore use to store arbitrary prefix, key, values"""
@@ -835,6 +756,26 @@ class KeyValueStore(Base):
     value: Mapped[dict] = mapped_column(JSON)
 
 
+class SolveCache(Base):
+    """Lockfile produced by a lock plugin for a given solve cache key
+
+    The key is derived from the specification, the platforms and the state
+    of the channels at the time of the solve, see
+    conda_store_server._internal.solve_cache
+    """
+
+    __tablename__ = "solve_cache"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    key: Mapped[str] = mapped_column(Unicode(255), unique=True)
+    lock_backend: Mapped[str] = mapped_column(Unicode(255))
+    lockfile: Mapped[dict] = mapped_column(JSON)
+    created_on: Mapped[datetime.datetime] = mapped_column(
+        DateTime, default=datetime.datetime.utcnow
+    )
+    hits: Mapped[int] = mapped_column(BigInteger, default=0)
+
+
 def new_session_factory(
     url="sqlite:///:memory:", reset=False, **kwargs
 ) -> sessionmaker:
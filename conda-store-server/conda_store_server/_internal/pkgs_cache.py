@@ -0,0 +1,202 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Least recently used eviction of the conda package cache
+
+Every build downloads and extracts its packages into the package cache of
+the worker, see action_fetch_and_extract_conda_packages, which marks each
+package it uses by touching its marker file, <name>.used in the package
+cache. The modification times of the tarball and extracted directory, which
+conda and the hash cache of add_conda_prefix_packages rely on, are left
+untouched, and are only the last use of packages without a marker.
+task_evict_pkgs_cache then removes the least recently used packages until
+the cache fits in CondaStore.pkgs_cache_max_size.
+
+A package is never evicted while
+ - one of its files is hardlinked into a prefix, as removing it would not
+   free any space
+ - it was used in the last EVICTION_GRACE seconds, e.g. by a build which
+   downloaded it and did not link it into its prefix yet
+ - another process holds its lock, e.g. because it is downloading it
+"""
+
+import os
+import pathlib
+import shutil
+import stat
+import time
+import typing
+
+import filelock
+
+PACKAGE_EXTENSIONS = (".tar.bz2", ".conda")
+
+USED_MARKER_EXTENSION = ".used"
+
+EVICTION_GRACE = 60 * 60  # 1 hour
+
+# Delay in seconds during which the size of a package cache returned by
+# packages_size is reused, see admission.check_build_resources
+SIZE_MAX_AGE = 60
+
+# Last size of each package cache computed by this process, as a tuple
+# (time.monotonic(), size) by path
+_sizes: typing.Dict[str, typing.Tuple[float, int]] = {}
+
+
+def _strip_extension(filename: str) -> typing.Optional[str]:
+    for extension in PACKAGE_EXTENSIONS:
+        if filename.endswith(extension):
+            return filename[: -len(extension)]
+    return None
+
+
+def mark_used(pkgs_dir: pathlib.Path, filename: str):
+    """Marks the package filename in pkgs_dir as just used"""
+    name = _strip_extension(filename)
+    (pkgs_dir / f"{name}{USED_MARKER_EXTENSION}").touch()
+
+
+def _remove_marker(pkgs_dir: pathlib.Path, name: str):
+    try:
+        os.remove(pkgs_dir / f"{name}{USED_MARKER_EXTENSION}")
+    except FileNotFoundError:
+        pass
+
+
+def _directory_usage(path: str) -> typing.Tuple[int, bool]:
+    """Size of the files in path and whether any of them is hardlinked"""
+    size = 0
+    is_linked = False
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            file_stat = os.lstat(os.path.join(dirpath, filename))
+            size += file_stat.st_size
+            if stat.S_ISREG(file_stat.st_mode) and file_stat.st_nlink > 1:
+                is_linked = True
+    return size, is_linked
+
+
+def list_packages(pkgs_dir: pathlib.Path) -> typing.List[typing.Dict]:
+    """Packages in pkgs_dir with their size, last use and whether they are
+    hardlinked into a prefix
+
+    The markers of packages which are no longer in pkgs_dir are removed.
+    """
+    packages = {}
+    markers = {}
+    with os.scandir(pkgs_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith(USED_MARKER_EXTENSION):
+                name = entry.name[: -len(USED_MARKER_EXTENSION)]
+                markers[name] = entry.stat(follow_symlinks=False).st_mtime
+                continue
+
+            if entry.is_file(follow_symlinks=False):
+                name = _strip_extension(entry.name)
+                if name is None:
+                    continue
+                entry_stat = entry.stat(follow_symlinks=False)
+                size, is_linked = entry_stat.st_size, False
+            elif entry.is_dir(follow_symlinks=False) and os.path.isdir(
+                os.path.join(entry.path, "info")
+            ):
+                name = entry.name
+                entry_stat = entry.stat(follow_symlinks=False)
+                size, is_linked = _directory_usage(entry.path)
+            else:
+                continue
+
+            package = packages.setdefault(
+                name,
+                {
+                    "name": name,
+                    "paths": [],
+                    "size": 0,
+                    "last_used": 0,
+                    "is_linked": False,
+                },
+            )
+            package["paths"].append(entry.path)
+            package["size"] += size
+            package["last_used"] = max(package["last_used"], entry_stat.st_mtime)
+            package["is_linked"] = package["is_linked"] or is_linked
+
+    for name, last_used in markers.items():
+        if name in packages:
+            packages[name]["last_used"] = max(packages[name]["last_used"], last_used)
+        else:
+            # The package was removed from the cache, e.g. by conda clean
+            _remove_marker(pkgs_dir, name)
+
+    return list(packages.values())
+
+
+def packages_size(pkgs_dir: pathlib.Path, max_age: float = SIZE_MAX_AGE) -> int:
+    """Size in bytes of the packages in pkgs_dir
+
+    The size computed by this process, or after an eviction, in the last
+    max_age seconds is reused rather than walking the package cache again.
+    """
+    cached = _sizes.get(str(pkgs_dir))
+    if cached is not None and time.monotonic() - cached[0] < max_age:
+        return cached[1]
+
+    size = sum(package["size"] for package in list_packages(pkgs_dir))
+    _sizes[str(pkgs_dir)] = (time.monotonic(), size)
+    return size
+
+
+def evict_packages(
+    pkgs_dir: pathlib.Path, max_size: int, log=None
+) -> typing.Dict[str, int]:
+    """Removes least recently used packages until pkgs_dir fits in max_size
+
+    Returns the number of evicted packages and bytes and the size of the
+    package cache after eviction.
+    """
+    packages = list_packages(pkgs_dir)
+    size = sum(package["size"] for package in packages)
+    result = {"evicted_packages": 0, "evicted_bytes": 0}
+
+    now = time.time()
+    for package in sorted(packages, key=lambda package: package["last_used"]):
+        if size <= max_size:
+            break
+        if package["is_linked"] or now - package["last_used"] < EVICTION_GRACE:
+            continue
+
+        # The same locks as action_fetch_and_extract_conda_packages, for
+        # all formats since the extracted directory is shared
+        locks = [
+            filelock.FileLock(str(pkgs_dir / f"{package['name']}{extension}.lock"))
+            for extension in PACKAGE_EXTENSIONS
+        ]
+        try:
+            for lock in locks:
+                lock.acquire(timeout=0)
+        except filelock.Timeout:
+            continue
+        else:
+            # The tarball is removed last, which tells downloads that the
+            # package has to be fetched again
+            for path in sorted(package["paths"], key=os.path.isfile):
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            _remove_marker(pkgs_dir, package["name"])
+        finally:
+            for lock in locks:
+                lock.release()
+
+        if log is not None:
+            log.info(f"evicted package {package['name']} of {package['size']} bytes")
+        size -= package["size"]
+        result["evicted_packages"] += 1
+        result["evicted_bytes"] += package["size"]
+
+    result["size"] = size
+    _sizes[str(pkgs_dir)] = (time.monotonic(), size)
+    return result
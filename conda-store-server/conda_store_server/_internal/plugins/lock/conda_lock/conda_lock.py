@@ -5,10 +5,13 @@
 import json
 import os
 import pathlib
+import subprocess
+import sys
 import typing
 
 import yaml
 from conda_lock.conda_lock import run_lock
+from conda_lock.lockfile import parse_conda_lock_file, write_conda_lock_file
 
 from conda_store_server._internal import conda_utils, schema, utils
 from conda_store_server.plugins.hookspec import hookimpl
@@ -24,6 +27,76 @@ class CondaLock(lock.LockPlugin):
     def _conda_flags(self, conda_store) -> str:
         return conda_store.config.conda_flags
 
+    def _parallel_platforms(self, conda_store) -> bool:
+        return conda_store.config.conda_lock_parallel_platforms
+
+    def _lock_platforms_in_parallel(
+        self,
+        context: PluginContext,
+        environment_filename: pathlib.Path,
+        lockfile_filename: pathlib.Path,
+        platforms: typing.List[str],
+        conda_command: str,
+        cuda_version: typing.Optional[str],
+    ):
+        """Solves each platform in a separate conda-lock process and merges
+        the lockfiles into lockfile_filename
+
+        Separate processes are used since run_lock is not thread-safe and
+        celery workers cannot fork multiprocessing pools.
+        """
+        processes = []
+        for platform in platforms:
+            platform_lockfile = lockfile_filename.with_suffix(f".{platform}.yaml")
+            command = [
+                sys.executable,
+                "-m",
+                "conda_lock",
+                "lock",
+                "--file",
+                str(environment_filename),
+                "--platform",
+                platform,
+                "--lockfile",
+                str(platform_lockfile),
+                "--conda",
+                conda_command,
+            ]
+            if cuda_version is not None:
+                command += ["--with-cuda", cuda_version]
+
+            context.log.info(f"Running command: {' '.join(command)}")
+            # The output goes to a file rather than a pipe, so that a
+            # process never blocks on a full pipe while another one is read
+            output = lockfile_filename.with_suffix(f".{platform}.log").open("w+")
+            processes.append(
+                (
+                    platform,
+                    platform_lockfile,
+                    output,
+                    subprocess.Popen(
+                        command, stdout=output, stderr=subprocess.STDOUT, text=True
+                    ),
+                )
+            )
+
+        errors = []
+        for platform, _, output, process in processes:
+            returncode = utils.wait_process(process)
+            output.seek(0)
+            for line in output:
+                context.stdout.write(f"{platform}: {line}")
+            output.close()
+            if returncode != 0:
+                errors.append(subprocess.CalledProcessError(returncode, process.args))
+        if errors:
+            raise errors[0]
+
+        lockfile = None
+        for _, platform_lockfile, _, _ in processes:
+            lockfile = parse_conda_lock_file(platform_lockfile).merge(lockfile)
+        write_conda_lock_file(lockfile, lockfile_filename, metadata_choices=None)
+
     @utils.run_in_tempdir
     def lock_environment(
         self,
@@ -72,13 +145,23 @@ class CondaLock(lock.LockPlugin):
             print(f"{conda_flags_name}={conda_flags}")
             os.environ[conda_flags_name] = conda_flags
 
-            run_lock(
-                environment_files=[environment_filename],
-                platforms=platforms,
-                lockfile_path=lockfile_filename,
-                conda_exe=conda_command,
-                with_cuda=cuda_version,
-            )
+            if self._parallel_platforms(context.conda_store) and len(platforms) > 1:
+                self._lock_platforms_in_parallel(
+                    context,
+                    environment_filename,
+                    lockfile_filename,
+                    platforms,
+                    conda_command,
+                    cuda_version,
+                )
+            else:
+                run_lock(
+                    environment_files=[environment_filename],
+                    platforms=platforms,
+                    lockfile_path=lockfile_filename,
+                    conda_exe=conda_command,
+                    with_cuda=cuda_version,
+                )
         finally:
             os.environ.pop(conda_flags_name, None)
 
@@ -0,0 +1,422 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""On-disk cache of the repodata of conda channels
+
+The channeldata.json of each channel and the repodata.json of each of its
+subdirs are kept decompressed in a cache directory, together with a
+state.json file holding the validators of the last response (ETag and
+Last-Modified), the blake2b-256 hash of the repodata.json served by the
+channel, the position reached in its repodata.jlap file and whether the
+cached repodata was indexed.
+
+A subdir is updated, in order of preference, by:
+ - fetching the lines appended to repodata.jlap since the last update, with
+   a Range request, and applying the JSON patches leading from the cached
+   repodata to the latest one
+ - a conditional request of repodata.json.zst, falling back to
+   repodata.json.bz2, which is streamed and decompressed to the cache
+
+Subdirs whose repodata is unchanged are not indexed again, once their
+indexing was committed, see mark_indexed. The repodata last indexed is kept
+as repodata.indexed.json, so that only the package records which changed
+since are indexed, see SubdirChanges.
+
+See https://github.com/conda-incubator/ceps/blob/main/cep-0016.md for the
+format of repodata.jlap.
+"""
+
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+import time
+import typing
+
+import jsonpatch
+import requests
+import yarl
+
+from conda_store_server._internal import conda_utils
+
+logger = logging.getLogger("repodata_cache")
+
+# Compressions of repodata.json in order of preference
+COMPRESSIONS = ["zst", "bz2"]
+
+# Delay in seconds before checking again whether a channel provides a file
+# which was not found, e.g. repodata.jlap or repodata.json.zst
+UNAVAILABLE_RECHECK_INTERVAL = 24 * 60 * 60
+
+# Initialization vector of a repodata.jlap file which is not trimmed
+JLAP_NULL_IV = "0" * 64
+
+CHUNK_SIZE = 2**20
+
+
+class JlapError(Exception):
+    """repodata.jlap can not be used to update the cached repodata"""
+
+
+def channel_cache_directory(cache_dir: str, channel_url: yarl.URL) -> pathlib.Path:
+    """Cache directory of a channel, named after its url"""
+    url = str(channel_url).rstrip("/")
+    name = re.sub(r"[^a-zA-Z0-9._-]+", "_", url.split("://", 1)[-1]).strip("_")
+    digest = hashlib.sha256(url.encode("utf-8")).hexdigest()[:8]
+    return pathlib.Path(cache_dir) / f"{name}-{digest}"
+
+
+class CachedDocument:
+    """A JSON document of a channel cached at path, with its state"""
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.state_path = path.with_name(f"{path.stem}.state.json")
+        self.indexed_path = path.with_name(f"{path.stem}.indexed.json")
+        self.state = {}
+        if self.path.exists() and self.state_path.exists():
+            with self.state_path.open() as f:
+                self.state = json.load(f)
+
+    def save_state(self):
+        with self._atomic_open(self.state_path, "w") as f:
+            json.dump(self.state, f)
+
+    def conditional_headers(self, url: str) -> typing.Dict[str, str]:
+        """Validators of the cached response of url"""
+        if self.state.get("url") != url:
+            return {}
+        headers = {}
+        if self.state.get("etag"):
+            headers["If-None-Match"] = self.state["etag"]
+        if self.state.get("last_modified"):
+            headers["If-Modified-Since"] = self.state["last_modified"]
+        return headers
+
+    def is_unavailable(self, name: str) -> bool:
+        checked_on = self.state.get("unavailable", {}).get(name)
+        return (
+            checked_on is not None
+            and time.time() - checked_on < UNAVAILABLE_RECHECK_INTERVAL
+        )
+
+    def set_unavailable(self, name: str):
+        self.state.setdefault("unavailable", {})[name] = time.time()
+
+    def write(self, fileobj: typing.BinaryIO) -> str:
+        """Replaces the document with the contents of fileobj, returns their
+        blake2b-256 hash
+        """
+        digest = hashlib.blake2b(digest_size=32)
+        with self._atomic_open(self.path, "wb") as f:
+            while chunk := fileobj.read(CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+        return digest.hexdigest()
+
+    def load(self) -> typing.Dict:
+        with self.path.open("rb") as f:
+            return json.load(f)
+
+    def dump(self, document: typing.Dict):
+        with self._atomic_open(self.path, "w") as f:
+            json.dump(document, f)
+
+    def keep_indexed(self):
+        """Keeps the document as it is, as the last indexed document
+
+        The document is hard linked rather than copied, it is only ever
+        replaced, never modified in place.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            self.indexed_path.unlink()
+        try:
+            os.link(self.path, self.indexed_path)
+        except OSError:
+            # The filesystem does not support hard links
+            shutil.copyfile(self.path, self.indexed_path)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _atomic_open(path: pathlib.Path, mode: str):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+        try:
+            with os.fdopen(fd, mode) as f:
+                yield f
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+def download(document: CachedDocument, url: str, compression: str = None) -> bool:
+    """Conditionally downloads url to the cached document, returns whether it
+    changed. Raises requests.HTTPError if the response is an error.
+    """
+    with conda_utils.http_session().get(
+        url, headers=document.conditional_headers(url), stream=True
+    ) as response:
+        if response.status_code == 304:
+            # Keeps what was learned about the channel, e.g. unavailable files
+            document.save_state()
+            return False
+        response.raise_for_status()
+
+        # Decodes the Content-Encoding, e.g. gzip, of the response
+        response.raw.decode_content = True
+        with conda_utils.open_decompressed(response.raw, compression) as f:
+            blake2_256_hash = document.write(f)
+
+    document.state = {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "blake2_256": blake2_256_hash,
+        "unavailable": document.state.get("unavailable", {}),
+        "indexed": False,
+    }
+    document.save_state()
+    return True
+
+
+def download_subdir(document: CachedDocument, subdir_url: yarl.URL) -> bool:
+    """Downloads the whole repodata.json of a subdir, compressed, to the
+    cached document, returns whether it changed
+    """
+    for compression in COMPRESSIONS:
+        if document.is_unavailable(compression):
+            continue
+
+        try:
+            return download(
+                document, str(subdir_url / f"repodata.json.{compression}"), compression
+            )
+        except requests.HTTPError as e:
+            if e.response.status_code != 404 or compression == COMPRESSIONS[-1]:
+                raise
+            document.set_unavailable(compression)
+
+
+def fetch_jlap(url: str, position: int = 0) -> typing.Tuple[bytes, int]:
+    """Contents of repodata.jlap from position, and the position of these
+    contents, which is 0 if the server ignored the Range request
+    """
+    headers = {"Range": f"bytes={position}-"} if position else {}
+    response = conda_utils.http_session().get(url, headers=headers)
+    if response.status_code == 416:  # Range Not Satisfiable, jlap was trimmed
+        raise JlapError(f"{url} is shorter than the cached position {position}")
+    response.raise_for_status()
+    if response.status_code != 206:
+        position = 0
+    return response.content, position
+
+
+def parse_jlap(
+    content: bytes, position: int, iv: str
+) -> typing.Tuple[typing.List[typing.Dict], typing.Dict, typing.Dict]:
+    """Patches and metadata of repodata.jlap contents starting at position
+
+    Every line of a jlap file is chained with a keyed blake2b-256 hash,
+    starting from the initialization vector, its first line when reading from
+    the start of the file, the last line being the hash of the previous lines.
+    Returns the patches, the metadata, i.e. the latest repodata hash, and the
+    position and iv from which the next update is read: the metadata line and
+    the hash line are replaced when lines are appended to the file.
+    """
+    lines = content.split(b"\n")
+    if position == 0:
+        iv, lines = lines[0].decode("ascii"), lines[1:]
+        position = len(content.split(b"\n", 1)[0]) + 1
+    if lines and lines[-1] == b"":
+        lines = lines[:-1]
+    if len(lines) < 2:
+        raise JlapError("repodata.jlap has no metadata or checksum line")
+
+    *patch_lines, metadata_line, checksum_line = lines
+    digest = bytes.fromhex(iv)
+    for line in patch_lines:
+        digest = _chain(line, digest)
+    next_iv = digest.hex()
+    digest = _chain(metadata_line, digest)
+    if digest.hex() != checksum_line.decode("ascii").strip():
+        raise JlapError("repodata.jlap checksum does not match its contents")
+
+    next_position = position + sum(len(line) + 1 for line in patch_lines)
+    patches = [json.loads(line) for line in patch_lines]
+    return patches, json.loads(metadata_line), {"iv": next_iv, "pos": next_position}
+
+
+def _chain(line: bytes, digest: bytes) -> bytes:
+    return hashlib.blake2b(line, digest_size=32, key=digest).digest()
+
+
+def find_patches(
+    patches: typing.List[typing.Dict], have: str, want: str
+) -> typing.List[typing.Dict]:
+    """Patches leading from the repodata hashed have to want, in the order
+    they are applied
+    """
+    chain = []
+    for patch in reversed(patches):
+        if have == want:
+            break
+        if patch["to"] == want:
+            chain.append(patch)
+            want = patch["from"]
+    if have != want:
+        raise JlapError(f"repodata.jlap has no patches from {have}")
+    return list(reversed(chain))
+
+
+def update_jlap(document: CachedDocument, subdir_url: yarl.URL) -> bool:
+    """Updates the cached repodata with the patches of repodata.jlap, returns
+    whether it changed. Raises JlapError if the patches can not be applied.
+    """
+    url = str(subdir_url / "repodata.jlap")
+    jlap = document.state.get("jlap", {})
+    try:
+        content, position = fetch_jlap(url, jlap.get("pos", 0))
+        patches, metadata, jlap = parse_jlap(
+            content, position, jlap.get("iv", JLAP_NULL_IV)
+        )
+    except JlapError:
+        if not jlap.get("pos"):
+            raise
+        # Reads the whole file again, it was trimmed or rewritten
+        content, position = fetch_jlap(url)
+        patches, metadata, jlap = parse_jlap(content, position, JLAP_NULL_IV)
+
+    have, want = document.state["blake2_256"], metadata["latest"]
+    changed = have != want
+    if changed:
+        repodata = document.load()
+        for patch in find_patches(patches, have, want):
+            jsonpatch.apply_patch(repodata, patch["patch"], in_place=True)
+        document.dump(repodata)
+        # The hash of the repodata served by the channel, which is patched
+        # next time, rather than the hash of the document dumped
+        document.state["blake2_256"] = want
+        document.state["indexed"] = False
+
+    document.state["jlap"] = jlap
+    document.save_state()
+    return changed
+
+
+def update_subdir(document: CachedDocument, subdir_url: yarl.URL) -> bool:
+    """Updates the cached repodata of a subdir, returns whether it changed"""
+    if document.state.get("blake2_256") and not document.is_unavailable("jlap"):
+        try:
+            return update_jlap(document, subdir_url)
+        except requests.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+            document.set_unavailable("jlap")
+        except (JlapError, jsonpatch.JsonPatchException, ValueError) as e:
+            logger.warning(f"unable to update {subdir_url} with repodata.jlap: {e}")
+    return download_subdir(document, subdir_url)
+
+
+class SubdirChanges:
+    """Package records of the cached repodata of a subdir which changed since
+    it was last indexed
+
+    If the repodata was never indexed, complete is True and all its records
+    are iterated. Otherwise it is compared with the last indexed repodata,
+    only the records which were added or whose sha256 changed are iterated,
+    and once they are, removed_sha256 holds the sha256 of the records which
+    were removed or replaced.
+    """
+
+    def __init__(self, document: CachedDocument):
+        self.document = document
+        self.complete = not document.indexed_path.exists()
+        self.removed_sha256: typing.Set[str] = set()
+
+    def __iter__(self) -> typing.Iterator[typing.Dict]:
+        if self.complete:
+            with self.document.path.open("rb") as f:
+                yield from conda_utils.iter_repodata_records(f)
+            return
+
+        # Only the sha256 of the indexed records are held in memory
+        with self.document.indexed_path.open("rb") as f:
+            indexed = {
+                filename: record.get("sha256")
+                for filename, record in conda_utils.iter_repodata_items(f)
+            }
+        with self.document.path.open("rb") as f:
+            for filename, record in conda_utils.iter_repodata_items(f):
+                sha256 = indexed.pop(filename, None)
+                if sha256 is not None and sha256 == record.get("sha256"):
+                    continue
+                if sha256 is not None:
+                    self.removed_sha256.add(sha256)
+                yield record
+        self.removed_sha256.update(
+            sha256 for sha256 in indexed.values() if sha256 is not None
+        )
+
+
+def download_repodata(
+    channel: str, cache_dir: str, subdirs=None, max_workers: int = None
+):
+    """Updates the cached repodata of channel, see conda_utils.download_repodata
+
+    channeldata.json and the repodata of each subdir are only downloaded if
+    they changed, by up to max_workers concurrent threads. The repodata of
+    the architectures whose repodata is unchanged and indexed are omitted,
+    the repodata of the others are the SubdirChanges of their package
+    records, read from the cache. mark_indexed is called once they are
+    indexed.
+    """
+    subdirs = sorted(set(subdirs or [conda_utils.conda_platform(), "noarch"]))
+    channel_url = conda_utils.get_channel_url(channel)
+    directory = channel_cache_directory(cache_dir, channel_url)
+
+    channeldata = CachedDocument(directory / "channeldata.json")
+    documents = {
+        subdir: CachedDocument(directory / subdir / "repodata.json")
+        for subdir in subdirs
+    }
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        channeldata_future = executor.submit(
+            download, channeldata, str(channel_url / "channeldata.json")
+        )
+        futures = {
+            subdir: executor.submit(update_subdir, document, channel_url / subdir)
+            for subdir, document in documents.items()
+        }
+        # Raises the error of a failed download, if any
+        channeldata_future.result()
+        changed = {subdir: future.result() for subdir, future in futures.items()}
+
+    repodata = channeldata.load()
+    repodata["architectures"] = {}
+    for subdir, document in documents.items():
+        # Caches written before the indexed flag existed were indexed
+        if changed[subdir] or not document.state.get("indexed", True):
+            repodata["architectures"][subdir] = SubdirChanges(document)
+        else:
+            logger.info(f"repodata of {channel_url / subdir} is unchanged")
+    return repodata
+
+
+def mark_indexed(channel: str, cache_dir: str, subdir: str):
+    """Records that the cached repodata of subdir was indexed and committed,
+    so that it is not indexed again until it changes
+    """
+    directory = channel_cache_directory(cache_dir, conda_utils.get_channel_url(channel))
+    document = CachedDocument(directory / subdir / "repodata.json")
+    if document.state:
+        document.keep_indexed()
+        document.state["indexed"] = True
+        document.save_state()
@@ -0,0 +1,207 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Fair-share scheduling of builds across namespaces
+
+Builds are not handed to celery when they are created. They stay QUEUED
+without a dispatched_on time until the scheduler dispatches them, which
+happens whenever a build is created, an environment build finishes and
+periodically via task_schedule_builds.
+
+Without CondaStore.max_concurrent_builds and
+CondaStore.namespace_max_concurrent_builds every build is dispatched
+immediately. Otherwise builds of a namespace are dispatched in order of
+submission, and the next build is taken from the namespace with the fewest
+dispatched builds relative to its weight in CondaStore.namespace_build_weights.
+A namespace submitting hundreds of builds therefore cannot starve the
+others.
+"""
+
+import collections
+import contextlib
+import datetime
+import math
+import os
+import typing
+
+from filelock import FileLock, Timeout
+from sqlalchemy.orm import Session
+
+from conda_store_server import api
+from conda_store_server._internal import orm, schema
+
+# Bounds the time spent waiting for a concurrent scheduler, which is
+# retried by task_schedule_builds
+SCHEDULER_LOCK_TIMEOUT = 30
+
+
+def _has_limits(conda_store) -> bool:
+    return bool(
+        conda_store.config.max_concurrent_builds
+        or conda_store.config.namespace_max_concurrent_builds
+    )
+
+
+def dispatch_order(
+    conda_store,
+    pending_builds: typing.List[orm.Build],
+    dispatched_builds: typing.Dict[str, int],
+    enforce_limits: bool = True,
+) -> typing.Iterator[orm.Build]:
+    """Yields pending builds in the order in which they are dispatched
+
+    dispatched_builds is the number of unfinished dispatched builds by
+    namespace name. With enforce_limits, stops once the configured limits
+    are reached.
+    """
+    max_builds = conda_store.config.max_concurrent_builds
+    max_namespace_builds = conda_store.config.namespace_max_concurrent_builds
+    weights = conda_store.config.namespace_build_weights
+
+    dispatched = collections.Counter(dispatched_builds)
+    total = sum(dispatched.values())
+
+    queues = {}
+    for build in pending_builds:
+        queues.setdefault(build.environment.namespace.name, collections.deque()).append(
+            build
+        )
+
+    while queues:
+        if enforce_limits and max_builds and total >= max_builds:
+            return
+
+        candidates = [
+            namespace
+            for namespace in queues
+            if not (
+                enforce_limits
+                and max_namespace_builds
+                and dispatched[namespace] >= max_namespace_builds
+            )
+        ]
+        if not candidates:
+            return
+
+        namespace = min(
+            candidates,
+            key=lambda namespace: (
+                dispatched[namespace] / weights.get(namespace, 1),
+                queues[namespace][0].id,
+            ),
+        )
+        build = queues[namespace].popleft()
+        if not queues[namespace]:
+            del queues[namespace]
+
+        dispatched[namespace] += 1
+        total += 1
+        yield build
+
+
+@contextlib.contextmanager
+def scheduler_lock(conda_store):
+    """Serializes schedulers across the server and workers
+
+    Yields whether the lock was acquired.
+    """
+    if conda_store.config.redis_url is not None:
+        lock = conda_store.redis.lock(
+            "conda-store-scheduler",
+            timeout=SCHEDULER_LOCK_TIMEOUT,
+            blocking_timeout=SCHEDULER_LOCK_TIMEOUT,
+        )
+        is_locked = lock.acquire()
+    else:
+        lock = FileLock(
+            os.path.join(conda_store.config.store_directory, ".scheduler.lock")
+        )
+        try:
+            is_locked = lock.acquire(timeout=SCHEDULER_LOCK_TIMEOUT)
+        except Timeout:
+            is_locked = False
+
+    try:
+        yield is_locked
+    finally:
+        if is_locked:
+            lock.release()
+
+
+def schedule_builds(db: Session, conda_store) -> typing.List[int]:
+    """Dispatches pending builds to the workers as the limits allow
+
+    Returns the ids of the dispatched builds.
+    """
+    # Claiming a build is atomic, so the lock is only required to not
+    # exceed the limits
+    with (
+        scheduler_lock(conda_store)
+        if _has_limits(conda_store)
+        else contextlib.nullcontext(True)
+    ) as is_locked:
+        if not is_locked:
+            conda_store.log.warning("timed out waiting for concurrent scheduler")
+            return []
+
+        build_ids = []
+        for build in list(
+            dispatch_order(
+                conda_store,
+                api.list_pending_builds(db).all(),
+                api.count_dispatched_builds(db),
+            )
+        ):
+            if not api.claim_pending_build(db, build.id):
+                continue
+
+            try:
+                conda_store.dispatch_build(db, build)
+            except Exception:
+                # Leaves the build to the next scheduler run
+                build.dispatched_on = None
+                db.commit()
+                raise
+            build_ids.append(build.id)
+
+        return build_ids
+
+
+def queue_status(
+    db: Session, conda_store, build: orm.Build
+) -> typing.Tuple[typing.Optional[int], typing.Optional[datetime.datetime]]:
+    """Returns the position of a pending build in the queue and an ETA
+
+    The position starts at 1 for the build which is dispatched next. The
+    ETA assumes pending builds take as long as recently completed builds,
+    it is None if no build has completed yet. Both are None for builds
+    which are not pending.
+    """
+    if build.status != schema.BuildStatus.QUEUED or build.dispatched_on is not None:
+        return None, None
+
+    order = dispatch_order(
+        conda_store,
+        api.list_pending_builds(db).all(),
+        api.count_dispatched_builds(db),
+        enforce_limits=False,
+    )
+    position = next(
+        (i for i, pending_build in enumerate(order, 1) if pending_build.id == build.id),
+        None,
+    )
+    if position is None:
+        return None, None
+
+    duration = api.get_average_build_duration(db)
+    if duration is None:
+        return position, None
+
+    slots = (
+        conda_store.config.max_concurrent_builds
+        or conda_store.config.namespace_max_concurrent_builds
+        or 1
+    )
+    eta = datetime.datetime.utcnow() + duration * math.ceil(position / slots)
+    return position, eta
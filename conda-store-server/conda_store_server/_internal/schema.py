@@ -128,6 +128,17 @@ class BuildArtifact(BaseModel):
     model_config = ConfigDict(from_attributes=True, use_enum_values=True)
 
 
+class BuildPhase(BaseModel):
+    name: str
+    started_on: datetime.datetime
+    wall_time: float
+    cpu_time: Optional[float] = None
+    max_rss: Optional[int] = None
+    bytes_read: Optional[int] = None
+    bytes_written: Optional[int] = None
+    model_config = ConfigDict(from_attributes=True)
+
+
 class Build(BaseModel):
     id: int
     environment_id: int
@@ -136,10 +147,17 @@ class Build(BaseModel):
     status: BuildStatus
     status_info: Optional[str] = None
     size: int
+    size_unique: Optional[int] = None
+    package_sizes: Optional[Dict[str, int]] = None
     scheduled_on: datetime.datetime
     started_on: Optional[datetime.datetime] = None
     ended_on: Optional[datetime.datetime] = None
     build_artifacts: Optional[List[BuildArtifact]] = None
+    # Only set for builds waiting in the scheduler, see scheduler.queue_status
+    queue_position: Optional[int] = None
+    queue_eta: Optional[datetime.datetime] = None
+    # Only set for single builds, see worker.build_phase
+    phases: Optional[List[BuildPhase]] = None
     model_config = ConfigDict(from_attributes=True, use_enum_values=True)
 
 
@@ -13,7 +13,7 @@ from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request
 from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 
 from conda_store_server import __version__, api
-from conda_store_server._internal import orm, schema
+from conda_store_server._internal import orm, scheduler, schema
 from conda_store_server._internal.environment import filter_environments
 from conda_store_server._internal.server import dependencies
 from conda_store_server.conda_store import CondaStore
@@ -214,11 +214,20 @@ async def api_get_usage(
         )
 
         data = {}
-        for namespace, num_environments, num_builds, storage in namespace_usage_metrics:
+        for (
+            namespace,
+            num_environments,
+            num_builds,
+            storage,
+            storage_unique,
+        ) in namespace_usage_metrics:
             data[namespace] = {
                 "num_environments": num_environments,
                 "num_builds": num_builds,
                 "storage": storage,
+                # storage not shared via hardlinks with the package cache,
+                # only known for builds which recorded it
+                "storage_unique": storage_unique,
             }
 
         return {
@@ -983,7 +992,7 @@ async def api_list_builds(
             orm_builds,
             paginated_args,
             schema.Build,
-            exclude={"specification", "packages", "build_artifacts"},
+            exclude={"specification", "packages", "build_artifacts", "package_sizes"},
             allowed_sort_bys={
                 "id": orm.Build.id,
                 "started_on": orm.Build.started_on,
@@ -1013,9 +1022,18 @@ async def api_get_build(
             require=True,
         )
 
+        data = schema.Build.model_validate(build).model_dump(exclude={"packages"})
+        data["queue_position"], data["queue_eta"] = scheduler.queue_status(
+            db, conda_store, build
+        )
+        data["phases"] = [
+            schema.BuildPhase.model_validate(phase).model_dump()
+            for phase in api.list_build_phases(db, build_id)
+        ]
+
         return {
             "status": "ok",
-            "data": schema.Build.model_validate(build).model_dump(exclude={"packages"}),
+            "data": data,
         }
 
 
@@ -1077,6 +1095,30 @@ async def api_put_build_cancel(
             require=True,
         )
 
+        # Builds waiting in the scheduler have no tasks to revoke
+        if api.cancel_pending_build(
+            db,
+            build_id,
+            status_info="build canceled from the REST API before being dispatched",
+        ):
+            return {
+                "status": "ok",
+                "message": f"build {build_id} canceled",
+            }
+
+        # Dispatched builds which no worker holds a lease on are not
+        # running, e.g. they still wait in the broker, so no worker has to
+        # be stopped. Workers do not start canceled builds
+        if api.cancel_unleased_build(
+            db,
+            build_id,
+            status_info="build canceled from the REST API before being started",
+        ):
+            return {
+                "status": "ok",
+                "message": f"build {build_id} canceled",
+            }
+
         if conda_store.celery_app.control.inspect().ping() is None:
             raise HTTPException(
                 status_code=409,
@@ -1097,6 +1139,8 @@ async def api_put_build_cancel(
             terminate=True,
             signal="SIGTERM",
         )
+        # Marks the build as no longer running on its worker
+        api.revoke_build_lease(db, build_id)
 
         from conda_store_server._internal.worker import tasks
 
@@ -1206,6 +1250,11 @@ async def api_get_build_logs(
             require=True,
         )
 
+        if conda_store.storage.is_appending(build.log_key):
+            # The log of a running build is partly stored in parts which the
+            # url does not include
+            return PlainTextResponse(conda_store.storage.get(build.log_key))
+
         return RedirectResponse(conda_store.storage.get_url(build.log_key))
 
 
@@ -1369,7 +1418,16 @@ async def api_get_build_archive(
             require=True,
         )
 
-        return RedirectResponse(conda_store.storage.get_url(build.conda_pack_key))
+        # The archive may be shared with a build with an identical lockfile,
+        # see CondaStore.build_deduplication
+        build_artifact = api.list_build_artifacts(
+            db,
+            build_id=build.id,
+            included_artifact_types=[schema.BuildArtifactType.CONDA_PACK],
+        ).first()
+        key = build.conda_pack_key if build_artifact is None else build_artifact.key
+
+        return RedirectResponse(conda_store.storage.get_url(key))
 
 
 @router_api.get("/build/{build_id}/docker/", deprecated=True)
@@ -10,6 +10,29 @@ from conda_store_server._internal.server import dependencies
 
 router_metrics = APIRouter(tags=["metrics"])
 
+_SECONDS_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600]
+_BYTES_BUCKETS = [2**i for i in range(26, 36)]  # 64 MiB to 32 GiB
+
+# Histograms of build phases by metric name, with the orm.BuildPhase
+# column they are computed from and their bucket upper bounds
+BUILD_PHASE_HISTOGRAMS = {
+    "build_phase_wall_seconds": ("wall_time", _SECONDS_BUCKETS),
+    "build_phase_cpu_seconds": ("cpu_time", _SECONDS_BUCKETS),
+    "build_phase_max_rss_bytes": ("max_rss", _BYTES_BUCKETS),
+    "build_phase_read_bytes": ("bytes_read", _BYTES_BUCKETS),
+    "build_phase_written_bytes": ("bytes_written", _BYTES_BUCKETS),
+}
+
+
+def _histogram_lines(name, histogram):
+    yield f"# TYPE conda_store_{name} histogram"
+    for phase, values in sorted(histogram.items()):
+        for le, count in values["buckets"]:
+            yield f'conda_store_{name}_bucket{{phase="{phase}",le="{le}"}} {count}'
+        yield f'conda_store_{name}_bucket{{phase="{phase}",le="+Inf"}} {values["count"]}'
+        yield f'conda_store_{name}_sum{{phase="{phase}"}} {values["sum"]}'
+        yield f'conda_store_{name}_count{{phase="{phase}"}} {values["count"]}'
+
 
 @router_metrics.get("/metrics", response_class=PlainTextResponse)
 async def prometheus_metrics(
@@ -17,7 +40,14 @@ async def prometheus_metrics(
 ):
     with conda_store.get_db() as db:
         metrics = api.get_metrics(db)
-        return "\n".join(f"conda_store_{key} {value}" for key, value in metrics.items())
+        lines = [f"conda_store_{key} {value}" for key, value in metrics.items()]
+        for name, (column, buckets) in BUILD_PHASE_HISTOGRAMS.items():
+            lines.extend(
+                _histogram_lines(
+                    name, api.get_build_phase_histogram(db, column, buckets)
+                )
+            )
+        return "\n".join(lines)
 
 
 @router_metrics.get("/celery")
@@ -0,0 +1,180 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Content addressed cache for the results of lock plugins
+
+Solving is by far the most expensive step of a build that does not have to
+download packages, yet identical specifications are frequently solved again,
+e.g. when the same environment is submitted to different namespaces. The
+lockfile produced by a lock plugin only depends on the requested packages,
+the platforms, the solver configuration and the contents of the channels, so
+it is cached under a key derived from all of them. Indexed channels
+contribute their CondaChannel.last_update to the key, which invalidates
+cached solves whenever a channel is updated. Entries expire after
+CondaStore.solve_cache_ttl seconds, which also bounds how long a solve
+against a channel that is not indexed by conda-store is reused.
+
+Concurrent identical solves are deduplicated: the first worker to miss the
+cache holds a lock for the key while solving, the others wait for it and
+then read the result from the cache.
+"""
+
+import contextlib
+import datetime
+import os
+import typing
+
+from filelock import FileLock, Timeout
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from conda_store_server import api
+from conda_store_server._internal import conda_utils, orm, schema, utils
+from conda_store_server.plugins.plugin_context import PluginContext
+from conda_store_server.plugins.types.lock import LockPlugin
+
+
+def solve_cache_key(
+    db: Session,
+    conda_store,
+    lock_backend: str,
+    spec: schema.CondaSpecification,
+    platforms: typing.List[str],
+) -> str:
+    """Returns the cache key of solving spec for platforms with lock_backend"""
+    settings = conda_store.get_settings()
+
+    channels = [
+        conda_utils.normalize_channel_name(settings.conda_channel_alias, channel)
+        for channel in spec.channels
+    ]
+    last_updates = {
+        name: last_update.isoformat()
+        for name, last_update in db.query(
+            orm.CondaChannel.name, orm.CondaChannel.last_update
+        ).filter(
+            orm.CondaChannel.name.in_(channels),
+            orm.CondaChannel.last_update.is_not(None),
+        )
+    }
+
+    return utils.datastructure_hash(
+        {
+            "lock_backend": lock_backend,
+            # name, description and prefix do not influence the solve
+            "specification": spec.model_dump(include={"dependencies", "variables"}),
+            "platforms": platforms,
+            # Channel order determines channel priority. datastructure_hash
+            # sorts lists, but keeps the relative order of dicts in a list
+            "channels": [
+                {"name": channel, "last_update": last_updates.get(channel)}
+                for channel in channels
+            ],
+            "conda_command": settings.conda_command,
+            "conda_flags": conda_store.config.conda_flags,
+        }
+    )
+
+
+def get_cached_lockfile(
+    db: Session, conda_store, key: str
+) -> typing.Optional[typing.Dict]:
+    """Returns the cached lockfile for key, if it exists and did not expire"""
+    entry = api.get_solve_cache_entry(db, key)
+    if entry is None:
+        return None
+
+    age = datetime.datetime.utcnow() - entry.created_on
+    if age.total_seconds() > conda_store.config.solve_cache_ttl:
+        return None
+
+    entry.hits += 1
+    db.commit()
+    return entry.lockfile
+
+
+def set_cached_lockfile(
+    db: Session, conda_store, key: str, lock_backend: str, lockfile: typing.Dict
+):
+    """Stores lockfile under key and discards expired entries"""
+    expired = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=conda_store.config.solve_cache_ttl
+    )
+    api.delete_solve_cache_entries(db, created_before=expired)
+    api.create_solve_cache_entry(db, key, lock_backend, lockfile)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another worker stored the same solve after failing to wait for
+        # the lock, both lockfiles are equivalent
+        db.rollback()
+
+
+@contextlib.contextmanager
+def single_flight(conda_store, key: str):
+    """Holds a lock for key across workers while the context is active
+
+    Yields whether the lock was acquired. Waiting is bounded by
+    CondaStore.conda_max_solve_time, after which callers solve without
+    holding the lock rather than failing the build.
+    """
+    timeout = conda_store.config.conda_max_solve_time
+
+    if conda_store.config.redis_url is not None:
+        lock = conda_store.redis.lock(
+            f"solve-cache-{key}", timeout=timeout, blocking_timeout=timeout
+        )
+        is_locked = lock.acquire()
+    else:
+        lock_directory = os.path.join(conda_store.config.store_directory, ".solve")
+        os.makedirs(lock_directory, exist_ok=True)
+        lock = FileLock(os.path.join(lock_directory, f"{key}.lock"))
+        try:
+            is_locked = lock.acquire(timeout=timeout)
+        except Timeout:
+            is_locked = False
+
+    try:
+        yield is_locked
+    finally:
+        if is_locked:
+            lock.release()
+
+
+def lock_environment(
+    db: Session,
+    conda_store,
+    lock_backend: str,
+    locker: LockPlugin,
+    context: PluginContext,
+    spec: schema.CondaSpecification,
+    platforms: typing.List[str],
+) -> typing.Dict:
+    """Solves spec with locker, reusing a previous identical solve if possible"""
+    if not conda_store.config.solve_cache_enabled:
+        return locker.lock_environment(context=context, spec=spec, platforms=platforms)
+
+    key = solve_cache_key(db, conda_store, lock_backend, spec, platforms)
+
+    lockfile = get_cached_lockfile(db, conda_store, key)
+    if lockfile is None:
+        with single_flight(conda_store, key) as is_locked:
+            if not is_locked:
+                context.log.warning(
+                    f"timed out waiting for concurrent solve with key {key}"
+                )
+
+            # An identical solve may have completed while waiting for the lock
+            lockfile = get_cached_lockfile(db, conda_store, key)
+            if lockfile is None:
+                orm.CondaStoreConfiguration.increment_solve_cache_metrics(db, hit=False)
+                lockfile = locker.lock_environment(
+                    context=context, spec=spec, platforms=platforms
+                )
+                set_cached_lockfile(db, conda_store, key, lock_backend, lockfile)
+                return lockfile
+
+    orm.CondaStoreConfiguration.increment_solve_cache_metrics(db, hit=True)
+    context.log.info(f"reusing cached solve with key {key}")
+    return lockfile
@@ -2,13 +2,16 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import concurrent.futures
 import contextlib
+import contextvars
 import functools
 import hashlib
 import json
 import os
 import pathlib
 import re
+import stat
 import subprocess
 import sys
 import tempfile
@@ -29,23 +32,84 @@ def symlink(source, target):
         os.symlink(source, target)
 
 
-def chmod(directory, permissions):
-    if re.fullmatch("[0-7]{3}", permissions) is None:
-        raise ValueError(
-            f"chmod permissions={permissions} not 3 integer values between 0-7"
-        )
-
-    subprocess.check_output(["chmod", "-R", str(permissions), directory])
+def set_permissions(
+    directory,
+    permissions: str = None,
+    uid: int = None,
+    gid: int = None,
+    max_workers: int = 1,
+) -> int:
+    """Recursively set the permissions and owner of directory
 
+    Equivalent to `chmod -R permissions directory` followed by `chown -R
+    uid:gid directory`, except that entries are only modified if their mode
+    or owner differs, which avoids a syscall for each of the tens of
+    thousands of files in a typical prefix. Symbolic links are never
+    followed and only have their owner changed. Top level directories are
+    walked concurrently when max_workers > 1.
 
-def chown(directory, uid, gid):
-    if re.fullmatch(r"\d+", str(uid)) is None:
-        raise ValueError(f"chown uid={uid} not integer value")
-
-    if re.fullmatch(r"\d+", str(gid)) is None:
-        raise ValueError(f"chown gid={gid} not integer value")
+    Returns the number of entries which were modified.
+    """
+    mode = None
+    if permissions is not None:
+        if re.fullmatch("[0-7]{3}", str(permissions)) is None:
+            raise ValueError(
+                f"chmod permissions={permissions} not 3 integer values between 0-7"
+            )
+        mode = int(str(permissions), 8)
+
+    owner = None
+    if uid is not None and gid is not None:
+        if re.fullmatch(r"\d+", str(uid)) is None:
+            raise ValueError(f"chown uid={uid} not integer value")
+        if re.fullmatch(r"\d+", str(gid)) is None:
+            raise ValueError(f"chown gid={gid} not integer value")
+        owner = (int(uid), int(gid))
+
+    def _set(path, stat_info, is_symlink: bool) -> int:
+        changed = False
+        if (
+            mode is not None
+            and not is_symlink
+            and stat.S_IMODE(stat_info.st_mode) != mode
+        ):
+            os.chmod(path, mode)
+            changed = True
+        if owner is not None and (stat_info.st_uid, stat_info.st_gid) != owner:
+            os.chown(path, *owner, follow_symlinks=False)
+            changed = True
+        return int(changed)
+
+    def _walk(path) -> int:
+        changed = 0
+        with os.scandir(path) as it:
+            for entry in it:
+                is_symlink = entry.is_symlink()
+                changed += _set(
+                    entry.path, entry.stat(follow_symlinks=False), is_symlink
+                )
+                # like chmod -R, directories are modified before descending
+                if not is_symlink and entry.is_dir(follow_symlinks=False):
+                    changed += _walk(entry.path)
+        return changed
+
+    changed = _set(directory, os.lstat(directory), os.path.islink(directory))
+
+    directories = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            is_symlink = entry.is_symlink()
+            changed += _set(entry.path, entry.stat(follow_symlinks=False), is_symlink)
+            if not is_symlink and entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+
+    if max_workers > 1 and len(directories) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            changed += sum(executor.map(_walk, directories))
+    else:
+        changed += sum(_walk(path) for path in directories)
 
-    subprocess.check_output(["chown", "-R", f"{uid}:{gid}", directory])
+    return changed
 
 
 @contextlib.contextmanager
@@ -83,6 +147,50 @@ def du(path):
     return nbytes
 
 
+def disk_usage_stats(path) -> dict:
+    """Disk usage of path in a single os.scandir pass
+
+    Returns a dict with
+      - total: bytes used by path, counting hardlinked files once like du -sb
+      - unique: bytes of files which are not hardlinked from outside of path,
+        e.g. from the conda package cache, plus directories and symlinks
+      - files: apparent size of each file by its path relative to path
+    """
+    inodes = {}
+    files = {}
+    other = 0
+
+    def _walk(directory, relative_directory):
+        nonlocal other
+        with os.scandir(directory) as it:
+            for entry in it:
+                stat_info = entry.stat(follow_symlinks=False)
+                relative_path = f"{relative_directory}{entry.name}"
+                if entry.is_dir(follow_symlinks=False):
+                    other += stat_info.st_size
+                    _walk(entry.path, f"{relative_path}/")
+                elif entry.is_symlink() or not stat_info.st_ino:
+                    # st_ino is not available for DirEntry.stat on Windows
+                    other += stat_info.st_size
+                    files[relative_path] = stat_info.st_size
+                else:
+                    key = (stat_info.st_dev, stat_info.st_ino)
+                    size, nlink, count = inodes.get(
+                        key, (stat_info.st_size, stat_info.st_nlink, 0)
+                    )
+                    inodes[key] = (size, nlink, count + 1)
+                    files[relative_path] = stat_info.st_size
+
+    other += os.lstat(path).st_size
+    _walk(path, "")
+
+    total = other + sum(size for size, _, _ in inodes.values())
+    unique = other + sum(
+        size for size, nlink, count in inodes.values() if count >= nlink
+    )
+    return {"total": total, "unique": unique, "files": files}
+
+
 def disk_usage(path: pathlib.Path):
     if sys.platform == "darwin":
         cmd = ["du", "-sAB1", str(path)]
@@ -98,6 +206,28 @@ def disk_usage(path: pathlib.Path):
     return output
 
 
+# Resource usage of the child processes reaped by wait_process is appended
+# to the list in this variable, see worker.build_phase
+child_rusage = contextvars.ContextVar("child_rusage", default=None)
+
+
+def wait_process(proc: subprocess.Popen) -> int:
+    """Waits for proc like Popen.wait and records its resource usage"""
+    if not hasattr(os, "wait4") or proc.returncode is not None:
+        return proc.wait()
+
+    try:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    except ChildProcessError:
+        return proc.wait()
+
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    collected = child_rusage.get()
+    if collected is not None:
+        collected.append(rusage)
+    return proc.returncode
+
+
 @contextlib.contextmanager
 def timer(logger, prefix):
     start_time = time.time()
@@ -140,6 +270,22 @@ def datastructure_hash(v):
     return hashlib.sha256(json_blob.encode("utf-8")).hexdigest()
 
 
+def file_hashes(
+    path, algorithms=("md5", "sha256"), chunk_size: int = 1024 * 1024
+) -> dict:
+    """Compute several hashes of a file in a single chunked pass
+
+    Unlike reading the whole file into memory once per algorithm, this only
+    holds chunk_size bytes in memory at any time.
+    """
+    hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            for hasher in hashers.values():
+                hasher.update(chunk)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+
 def callable_or_value(v, *args, **kwargs):
     if callable(v):
         return v(*args, **kwargs)
@@ -2,22 +2,31 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-import collections
 import datetime
 import json
+import os
 import pathlib
-import re
 import subprocess
 import tempfile
 import traceback
 import typing
 
 import yaml
-from filelock import FileLock
 from sqlalchemy.orm import Session
 
 from conda_store_server import api
-from conda_store_server._internal import action, conda_utils, orm, schema, utils
+from conda_store_server._internal import (
+    action,
+    conda_utils,
+    orm,
+    schema,
+    solve_cache,
+    utils,
+)
+from conda_store_server._internal.action.generate_conda_pack import (
+    CONDA_PACK_CONTENT_TYPES,
+)
+from conda_store_server._internal.worker import build_log, build_phase, prefetch
 from conda_store_server.exception import BuildPathError
 from conda_store_server.plugins import plugin_context
 
@@ -45,39 +54,30 @@ class LoggedStream:
 
 
 def append_to_logs(db: Session, conda_store, build, logs: typing.Union[str, bytes]):
-    # For instance, with local storage, this involves reading from and writing
-    # to a file. Locking here prevents a race condition when multiple tasks
-    # attempt to write to a shared resource, which is the log
-    with FileLock(f"{build.build_path(conda_store)}.log.lock"):
-        try:
-            current_logs = conda_store.storage.get(build.log_key)
-        except Exception:
-            current_logs = b""
-
-        if current_logs is None:
-            current_logs = b""
-
-        if isinstance(logs, str):
-            logs = logs.encode("utf-8")
-        elif logs is None:
-            logs = b""
+    writer = build_log.get_build_log_writer(build)
+    if writer is not None:
+        writer.write(logs)
+        return
 
-        conda_store.storage.set(
-            db,
-            build.id,
-            build.log_key,
-            current_logs + logs,
-            content_type="text/plain",
-            artifact_type=schema.BuildArtifactType.LOGS,
-        )
+    # No writer is open for this build in this process, e.g. when called
+    # during build cleanup, so write through a short-lived one
+    with build_log.open_build_log(db, conda_store, build) as writer:
+        writer.write(logs)
 
 
 def set_build_started(db: Session, build: orm.Build):
     build.status = schema.BuildStatus.BUILDING
+    # Clears the reason of previous deferrals
+    build.status_info = None
     build.started_on = datetime.datetime.utcnow()
     db.commit()
 
 
+def set_build_deferred(db: Session, build: orm.Build, reason: str):
+    build.status_info = f"deferred: {reason}"
+    db.commit()
+
+
 def set_build_failed(
     db: Session, build: orm.Build, status_info: typing.Optional[str] = None
 ):
@@ -100,10 +100,16 @@ def set_build_completed(db: Session, conda_store, build: orm.Build):
     build.status = schema.BuildStatus.COMPLETED
     build.ended_on = datetime.datetime.utcnow()
 
+    # Builds sharing the prefix of another build reference the shared
+    # directory, which is used to count references on deletion
+    conda_prefix = build.build_path(conda_store)
+    if conda_prefix.is_symlink():
+        conda_prefix = pathlib.Path(os.readlink(conda_prefix))
+
     directory_build_artifact = orm.BuildArtifact(
         build_id=build.id,
         artifact_type=schema.BuildArtifactType.DIRECTORY,
-        key=str(build.build_path(conda_store)),
+        key=str(conda_prefix),
     )
     db.add(directory_build_artifact)
 
@@ -119,65 +125,128 @@ def build_cleanup(
     reason: str = None,
     is_canceled: bool = False,
 ):
-    """Walk through all builds in BUILDING state and check that they are actively running
+    """Mark builds in BUILDING state which no longer run on a worker
 
     Build can get stuck in the building state due to worker
     spontaineously dying due to memory errors, killing container, etc.
+    A build is no longer running when its worker stopped renewing the
+    lease on it, see conda_store_server._internal.worker.lease.
     """
     status = "CANCELED" if is_canceled else "FAILED"
     reason = (
         reason
         or f"""
 Build marked as {status} on cleanup due to being stuck in BUILDING state
-and not present on workers. This happens for several reasons: build is
-canceled, a worker crash from out of memory errors, worker was killed,
-or error in conda-store
+and its worker no longer renewing its lease. This happens for several
+reasons: build is canceled, a worker crash from out of memory errors,
+worker was killed, or error in conda-store
 """
     )
 
-    inspect = conda_store.celery_app.control.inspect()
-    active_tasks = inspect.active()
-    if active_tasks is None:
+    if build_ids:
+        # The builds were explicitly stopped, e.g. canceled, so a build
+        # without a lease is not waiting for its worker to acquire one
+        builds = api.list_expired_builds(db, datetime.timedelta(0)).filter(
+            orm.Build.id.in_([int(_) for _ in build_ids])
+        )
+    else:
+        grace = datetime.timedelta(seconds=conda_store.config.build_lease_timeout)
+        builds = api.list_expired_builds(db, grace)
+
+    for build in builds.all():
         conda_store.log.warning(
-            "build cleanup failed: celery broker does not support inspect"
+            f"marking build {build.id} as {status} since stuck in BUILDING state and its lease expired"
         )
-        return
+        append_to_logs(
+            db,
+            conda_store,
+            build,
+            reason,
+        )
+        if is_canceled:
+            set_build_canceled(db, build)
+        else:
+            set_build_failed(db, build)
+        api.release_build_lease(db, build.id)
 
-    build_active_tasks = collections.defaultdict(list)
-    for worker_name, tasks in active_tasks.items():
-        for task in tasks:
-            match = re.fullmatch(r"build-(\d+)-(.*)", str(task["id"]))
-            if match:
-                build_id, name = match.groups()
-                build_active_tasks[build_id].append(task["name"])
 
-    if build_ids:
-        builds = [api.get_build(db, build_id) for build_id in build_ids]
-    else:
-        builds = api.list_builds(db, status=schema.BuildStatus.BUILDING)
-
-    for build in builds:
-        if (
-            build.status == schema.BuildStatus.BUILDING
-            and str(build.id) not in build_active_tasks
-            and (
-                build.started_on
-                < (datetime.datetime.utcnow() - datetime.timedelta(seconds=5))
-            )
-        ):
-            conda_store.log.warning(
-                f"marking build {build.id} as {status} since stuck in BUILDING state and not present on workers"
-            )
-            append_to_logs(
-                db,
-                conda_store,
-                build,
-                reason,
-            )
-            if is_canceled:
-                set_build_canceled(db, build)
-            else:
-                set_build_failed(db, build)
+def lockfile_hash(conda_lock_spec: typing.Dict, settings: schema.Settings) -> str:
+    """Canonical hash of the prefix a lockfile is installed into
+
+    Only the packages for the current platform and the permissions applied
+    to the prefix are taken into account, metadata such as the time the
+    lockfile was generated or the channels it was solved against is ignored.
+    """
+    platform = conda_utils.conda_platform()
+    return utils.datastructure_hash(
+        {
+            "package": [
+                {
+                    "manager": package["manager"],
+                    "name": package["name"],
+                    "version": package["version"],
+                    "url": package["url"],
+                }
+                for package in conda_lock_spec["package"]
+                if package["platform"] == platform
+            ],
+            "permissions": settings.default_permissions,
+            "uid": settings.default_uid,
+            "gid": settings.default_gid,
+        }
+    )
+
+
+def shared_build_prefix(
+    db: Session, conda_store, build: orm.Build
+) -> typing.Optional[pathlib.Path]:
+    """Returns the prefix of a completed build with the same lockfile_hash as
+    build, if any
+    """
+    if not conda_store.config.build_deduplication:
+        return None
+
+    build_artifact = api.get_shared_build_artifact(
+        db, build, schema.BuildArtifactType.DIRECTORY
+    )
+    if build_artifact is None:
+        return None
+
+    shared_prefix = pathlib.Path(build_artifact.key)
+    if not conda_utils.is_conda_prefix(shared_prefix):
+        return None
+
+    return shared_prefix
+
+
+def previous_build_prefix(conda_store, build) -> typing.Optional[pathlib.Path]:
+    """Returns the prefix of the current build of the environment of build if
+    it can be used as the source of an incremental build
+    """
+    if not conda_store.config.conda_incremental_builds:
+        return None
+
+    previous_build = build.environment.current_build
+    if (
+        previous_build is None
+        or previous_build.id == build.id
+        or previous_build.status != schema.BuildStatus.COMPLETED
+    ):
+        return None
+
+    try:
+        source_prefix = previous_build.build_path(conda_store)
+    except BuildPathError:
+        return None
+
+    if not conda_utils.is_conda_prefix(source_prefix):
+        return None
+
+    # Files embed the path of the shared prefix, not the path of the symlink
+    if source_prefix.is_symlink():
+        source_prefix = pathlib.Path(os.readlink(source_prefix))
+
+    return source_prefix
 
 
 def build_conda_environment(db: Session, conda_store, build):
@@ -185,6 +254,15 @@ def build_conda_environment(db: Session, conda_store, build):
     symlink the build to a named environment
 
     """
+    # Logs are buffered by the writer and appended to storage on phase
+    # boundaries, see build_log.BuildLogWriter
+    with build_log.open_build_log(db, conda_store, build) as log:
+        _build_conda_environment(db, conda_store, build, log)
+
+
+def _build_conda_environment(
+    db: Session, conda_store, build, log: build_log.BuildLogWriter
+):
     try:
         set_build_started(db, build)
         # Note: even append_to_logs can fail due to filename size limit, so
@@ -211,108 +289,174 @@ def build_conda_environment(db: Session, conda_store, build):
         is_lockfile = build.specification.is_lockfile
 
         with utils.timer(conda_store.log, f"building conda_prefix={conda_prefix}"):
-            if is_lockfile:
-                context = action.action_save_lockfile(
-                    specification=schema.LockfileSpecification.model_validate(
-                        build.specification.spec
-                    ),
-                    stdout=LoggedStream(
+            with (
+                prefetch.prefetch_packages(
+                    conda_store, build, log=log
+                ) as keep_prefetched,
+                build_phase.build_phase(db, conda_store, build, "solve"),
+            ):
+                if is_lockfile:
+                    context = action.action_save_lockfile(
+                        specification=schema.LockfileSpecification.model_validate(
+                            build.specification.spec
+                        ),
+                        stdout=LoggedStream(
+                            db=db,
+                            conda_store=conda_store,
+                            build=build,
+                            prefix="action_save_lockfile: ",
+                        ),
+                    )
+                    conda_lock_spec = context.result
+                else:
+                    lock_backend, locker = conda_store.lock_plugin()
+                    conda_lock_spec = solve_cache.lock_environment(
                         db=db,
                         conda_store=conda_store,
-                        build=build,
-                        prefix="action_save_lockfile: ",
-                    ),
+                        lock_backend=lock_backend,
+                        locker=locker,
+                        spec=schema.CondaSpecification.model_validate(
+                            build.specification.spec
+                        ),
+                        platforms=settings.conda_solve_platforms,
+                        context=plugin_context.PluginContext(
+                            conda_store=conda_store,
+                            stdout=LoggedStream(
+                                db=db,
+                                conda_store=conda_store,
+                                build=build,
+                                prefix=f"plugin-{lock_backend}: ",
+                            ),
+                        ),
+                    )
+
+                conda_store.storage.set(
+                    db,
+                    build.id,
+                    build.conda_lock_key,
+                    json.dumps(
+                        conda_lock_spec, indent=4, cls=utils.CustomJSONEncoder
+                    ).encode("utf-8"),
+                    content_type="application/json",
+                    artifact_type=schema.BuildArtifactType.LOCKFILE,
+                )
+                log.flush()
+
+                build.lockfile_hash = lockfile_hash(conda_lock_spec, settings)
+                db.commit()
+
+                keep_prefetched(
+                    package["url"] for package in conda_lock_spec["package"]
+                )
+
+            shared_prefix = None
+            if not conda_prefix.exists():
+                shared_prefix = shared_build_prefix(db, conda_store, build)
+
+            if shared_prefix is not None:
+                append_to_logs(
+                    db,
+                    conda_store,
+                    build,
+                    f"reusing prefix {shared_prefix} of a build with an identical lockfile\n",
                 )
-                conda_lock_spec = context.result
+                utils.symlink(shared_prefix, conda_prefix)
             else:
-                lock_backend, locker = conda_store.lock_plugin()
-                conda_lock_spec = locker.lock_environment(
-                    spec=schema.CondaSpecification.model_validate(
-                        build.specification.spec
-                    ),
-                    platforms=settings.conda_solve_platforms,
-                    context=plugin_context.PluginContext(
-                        conda_store=conda_store,
+                with build_phase.build_phase(db, conda_store, build, "download"):
+                    context = action.action_fetch_and_extract_conda_packages(
+                        conda_lock_spec=conda_lock_spec,
+                        pkgs_dir=conda_utils.conda_root_package_dir(),
+                        max_workers=conda_store.config.conda_download_max_workers,
                         stdout=LoggedStream(
                             db=db,
                             conda_store=conda_store,
                             build=build,
-                            prefix=f"plugin-{lock_backend}: ",
+                            prefix="action_fetch_and_extract_conda_packages: ",
                         ),
+                    )
+                    orm.CondaStoreConfiguration.increment_pkgs_cache_metrics(
+                        db, **context.result
+                    )
+                    log.flush()
+
+                with build_phase.build_phase(db, conda_store, build, "install"):
+                    source_prefix = previous_build_prefix(conda_store, build)
+                    is_installed = False
+                    if source_prefix is not None:
+                        context = action.action_install_lockfile_incremental(
+                            conda_lock_spec=conda_lock_spec,
+                            conda_prefix=conda_prefix,
+                            source_prefix=source_prefix,
+                            stdout=LoggedStream(
+                                db=db,
+                                conda_store=conda_store,
+                                build=build,
+                                prefix="action_install_lockfile_incremental: ",
+                            ),
+                        )
+                        is_installed = context.result
+
+                    if not is_installed:
+                        context = action.action_install_lockfile(
+                            conda_lock_spec=conda_lock_spec,
+                            conda_prefix=conda_prefix,
+                            stdout=LoggedStream(
+                                db=db,
+                                conda_store=conda_store,
+                                build=build,
+                                prefix="action_install_lockfile: ",
+                            ),
+                        )
+                    log.flush()
+
+        if environment_prefix is not None:
+            utils.symlink(conda_prefix, environment_prefix)
+
+        # Permissions are part of the lockfile_hash, so shared prefixes
+        # already have the right permissions
+        if shared_prefix is None:
+            with build_phase.build_phase(db, conda_store, build, "permissions"):
+                action.action_set_conda_prefix_permissions(
+                    conda_prefix=conda_prefix,
+                    permissions=settings.default_permissions,
+                    uid=settings.default_uid,
+                    gid=settings.default_gid,
+                    stdout=LoggedStream(
+                        db=db,
+                        conda_store=conda_store,
+                        build=build,
+                        prefix="action_set_conda_prefix_permissions: ",
                     ),
                 )
+                log.flush()
 
-            conda_store.storage.set(
-                db,
-                build.id,
-                build.conda_lock_key,
-                json.dumps(
-                    conda_lock_spec, indent=4, cls=utils.CustomJSONEncoder
-                ).encode("utf-8"),
-                content_type="application/json",
-                artifact_type=schema.BuildArtifactType.LOCKFILE,
-            )
-
-            context = action.action_fetch_and_extract_conda_packages(
-                conda_lock_spec=conda_lock_spec,
-                pkgs_dir=conda_utils.conda_root_package_dir(),
+        with build_phase.build_phase(db, conda_store, build, "register_packages"):
+            action.action_add_conda_prefix_packages(
+                db=db,
+                conda_prefix=conda_prefix,
+                build_id=build.id,
                 stdout=LoggedStream(
                     db=db,
                     conda_store=conda_store,
                     build=build,
-                    prefix="action_fetch_and_extract_conda_packages: ",
+                    prefix="action_add_conda_prefix_packages: ",
                 ),
             )
+            log.flush()
 
-            context = action.action_install_lockfile(
-                conda_lock_spec=conda_lock_spec,
-                conda_prefix=conda_prefix,
+        with build_phase.build_phase(db, conda_store, build, "stats"):
+            context = action.action_get_conda_prefix_stats(
+                conda_prefix,
                 stdout=LoggedStream(
                     db=db,
                     conda_store=conda_store,
                     build=build,
-                    prefix="action_install_lockfile: ",
+                    prefix="action_get_conda_prefix_stats: ",
                 ),
             )
-
-        if environment_prefix is not None:
-            utils.symlink(conda_prefix, environment_prefix)
-
-        action.action_set_conda_prefix_permissions(
-            conda_prefix=conda_prefix,
-            permissions=settings.default_permissions,
-            uid=settings.default_uid,
-            gid=settings.default_gid,
-            stdout=LoggedStream(
-                db=db,
-                conda_store=conda_store,
-                build=build,
-                prefix="action_set_conda_prefix_permissions: ",
-            ),
-        )
-
-        action.action_add_conda_prefix_packages(
-            db=db,
-            conda_prefix=conda_prefix,
-            build_id=build.id,
-            stdout=LoggedStream(
-                db=db,
-                conda_store=conda_store,
-                build=build,
-                prefix="action_add_conda_prefix_packages: ",
-            ),
-        )
-
-        context = action.action_get_conda_prefix_stats(
-            conda_prefix,
-            stdout=LoggedStream(
-                db=db,
-                conda_store=conda_store,
-                build=build,
-                prefix="action_get_conda_prefix_stats: ",
-            ),
-        )
-        build.size = context.result["disk_usage"]
+            build.size = context.result["disk_usage"]
+            build.size_unique = context.result["disk_usage_unique"]
+            build.package_sizes = context.result["package_sizes"]
 
         set_build_completed(db, conda_store, build)
     # Always mark build as failed first since other functions may throw an
@@ -340,8 +484,12 @@ def solve_conda_environment(db: Session, conda_store, solve: orm.Solve):
     solve.started_on = datetime.datetime.utcnow()
     db.commit()
 
-    _, locker = conda_store.lock_plugin()
-    conda_lock_spec = locker.lock_environment(
+    lock_backend, locker = conda_store.lock_plugin()
+    conda_lock_spec = solve_cache.lock_environment(
+        db=db,
+        conda_store=conda_store,
+        lock_backend=lock_backend,
+        locker=locker,
         context=plugin_context.PluginContext(conda_store=conda_store),
         spec=schema.CondaSpecification.model_validate(solve.specification.spec),
         platforms=[conda_utils.conda_platform()],
@@ -357,62 +505,120 @@ def solve_conda_environment(db: Session, conda_store, solve: orm.Solve):
     db.commit()
 
 
-def build_conda_env_export(db: Session, conda_store, build: orm.Build):
-    conda_prefix = build.build_path(conda_store)
-    settings = conda_store.get_settings(
-        namespace=build.environment.namespace.name,
-        environment_name=build.environment.name,
-    )
-
-    context = action.action_generate_conda_export(
-        conda_command=settings.conda_command,
-        conda_prefix=conda_prefix,
-        stdout=LoggedStream(
-            db=db,
-            conda_store=conda_store,
-            build=build,
-            prefix="action_generate_conda_export: ",
-        ),
-    )
-
-    conda_prefix_export = yaml.dump(context.result).encode("utf-8")
-
-    conda_store.storage.set(
-        db,
-        build.id,
-        build.conda_env_export_key,
-        conda_prefix_export,
-        content_type="text/yaml",
-        artifact_type=schema.BuildArtifactType.YAML,
-    )
-
+def lockfile_channels(conda_store, build: orm.Build) -> typing.List[str]:
+    """Returns the channels the lockfile of build was solved against"""
+    try:
+        lockfile = json.loads(conda_store.storage.get(build.conda_lock_key))
+        return [channel["url"] for channel in lockfile["metadata"]["channels"]]
+    except Exception as e:
+        conda_store.log.warning(
+            "Exception while obtaining channels from lockfile", exc_info=e
+        )
+        return []
 
-def build_conda_pack(db: Session, conda_store, build: orm.Build):
-    conda_prefix = build.build_path(conda_store)
 
-    with utils.timer(
-        conda_store.log, f"packaging archive of conda environment={conda_prefix}"
+def build_conda_env_export(db: Session, conda_store, build: orm.Build):
+    with (
+        build_log.open_build_log(db, conda_store, build),
+        build_phase.build_phase(db, conda_store, build, "conda_env_export"),
     ):
-        with tempfile.TemporaryDirectory() as tmpdir:
-            output_filename = pathlib.Path(tmpdir) / "environment.tar.gz"
-            action.action_generate_conda_pack(
+        conda_prefix = build.build_path(conda_store)
+        settings = conda_store.get_settings(
+            namespace=build.environment.namespace.name,
+            environment_name=build.environment.name,
+        )
+
+        if conda_store.config.conda_env_export_in_process:
+            context = action.action_generate_conda_prefix_export(
                 conda_prefix=conda_prefix,
-                output_filename=output_filename,
+                channels=lockfile_channels(conda_store, build),
                 stdout=LoggedStream(
                     db=db,
                     conda_store=conda_store,
                     build=build,
-                    prefix="action_generate_conda_pack: ",
+                    prefix="action_generate_conda_prefix_export: ",
                 ),
             )
-            conda_store.storage.fset(
+        else:
+            context = action.action_generate_conda_export(
+                conda_command=settings.conda_command,
+                conda_prefix=conda_prefix,
+                stdout=LoggedStream(
+                    db=db,
+                    conda_store=conda_store,
+                    build=build,
+                    prefix="action_generate_conda_export: ",
+                ),
+            )
+
+        conda_prefix_export = yaml.dump(context.result).encode("utf-8")
+
+        conda_store.storage.set(
+            db,
+            build.id,
+            build.conda_env_export_key,
+            conda_prefix_export,
+            content_type="text/yaml",
+            artifact_type=schema.BuildArtifactType.YAML,
+        )
+
+
+def build_conda_pack(db: Session, conda_store, build: orm.Build):
+    with (
+        build_log.open_build_log(db, conda_store, build),
+        build_phase.build_phase(db, conda_store, build, "conda_pack"),
+    ):
+        conda_prefix = build.build_path(conda_store)
+
+        if conda_store.config.build_deduplication:
+            build_artifact = api.get_shared_build_artifact(
+                db, build, schema.BuildArtifactType.CONDA_PACK
+            )
+            # The archive may have been removed from storage, e.g. by a
+            # lifecycle rule of the bucket
+            if (
+                build_artifact is not None
+                and conda_store.storage.exists_many([build_artifact.key])[
+                    build_artifact.key
+                ]
+            ):
+                append_to_logs(
+                    db,
+                    conda_store,
+                    build,
+                    f"reusing archive {build_artifact.key} of a build with an identical lockfile\n",
+                )
+                conda_store.storage.register_build_artifact(
+                    db,
+                    build.id,
+                    build_artifact.key,
+                    artifact_type=schema.BuildArtifactType.CONDA_PACK,
+                )
+                return
+
+        with utils.timer(
+            conda_store.log, f"packaging archive of conda environment={conda_prefix}"
+        ):
+            conda_pack_format = conda_store.config.conda_pack_format
+            with conda_store.storage.open_writer(
                 db,
                 build.id,
-                build.conda_pack_key,
-                output_filename,
-                content_type="application/gzip",
+                build.get_conda_pack_key(conda_pack_format),
+                content_type=CONDA_PACK_CONTENT_TYPES[conda_pack_format],
                 artifact_type=schema.BuildArtifactType.CONDA_PACK,
-            )
+            ) as output:
+                action.action_generate_conda_pack(
+                    conda_prefix=conda_prefix,
+                    output=output,
+                    format=conda_pack_format,
+                    n_threads=conda_store.config.conda_pack_threads,
+                    stdout=LoggedStream(
+                        db=db,
+                        conda_store=conda_store,
+                        build=build,
+                        prefix="action_generate_conda_pack: ",
+                    ),
+                )
 
 
 def build_conda_docker(db: Session, conda_store, build: orm.Build):
@@ -426,68 +632,72 @@ def build_conda_docker(db: Session, conda_store, build: orm.Build):
 
 
 def build_constructor_installer(db: Session, conda_store, build: orm.Build):
-    conda_prefix = build.build_path(conda_store)
+    with (
+        build_log.open_build_log(db, conda_store, build),
+        build_phase.build_phase(db, conda_store, build, "constructor_installer"),
+    ):
+        conda_prefix = build.build_path(conda_store)
 
-    settings = conda_store.get_settings(
-        namespace=build.environment.namespace.name,
-        environment_name=build.environment.name,
-    )
+        settings = conda_store.get_settings(
+            namespace=build.environment.namespace.name,
+            environment_name=build.environment.name,
+        )
 
-    with utils.timer(
-        conda_store.log, f"creating installer for conda environment={conda_prefix}"
-    ):
-        with tempfile.TemporaryDirectory() as tmpdir:
-            is_lockfile = build.specification.is_lockfile
+        with utils.timer(
+            conda_store.log, f"creating installer for conda environment={conda_prefix}"
+        ):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                is_lockfile = build.specification.is_lockfile
 
-            if is_lockfile:
-                specification = schema.LockfileSpecification.model_validate(
-                    build.specification.spec
-                )
-            else:
-                try:
-                    # Tries to use the lockfile if it's available since it has
-                    # pinned dependencies. This code is wrapped into try/except
-                    # because the lockfile lookup might fail if the file is not
-                    # in external storage or on disk, or if parsing fails
+                if is_lockfile:
                     specification = schema.LockfileSpecification.model_validate(
-                        {
-                            "name": build.specification.name,
-                            "lockfile": json.loads(
-                                conda_store.storage.get(build.conda_lock_key)
-                            ),
-                        }
-                    )
-                    is_lockfile = True
-                except Exception as e:
-                    conda_store.log.warning(
-                        "Exception while obtaining lockfile, using specification",
-                        exc_info=e,
-                    )
-                    specification = schema.CondaSpecification.model_validate(
                         build.specification.spec
                     )
-
-            context = action.action_generate_constructor_installer(
-                conda_command=settings.conda_command,
-                specification=specification,
-                installer_dir=pathlib.Path(tmpdir),
-                version=build.build_key,
-                stdout=LoggedStream(
-                    db=db,
-                    conda_store=conda_store,
-                    build=build,
-                    prefix="action_generate_constructor_installer: ",
-                ),
-                is_lockfile=is_lockfile,
-            )
-            output_filename = context.result
-            if output_filename is None:
-                return
-            conda_store.storage.fset(
-                db,
-                build.id,
-                build.constructor_installer_key,
-                output_filename,
-                content_type="application/octet-stream",
-                artifact_type=schema.BuildArtifactType.CONSTRUCTOR_INSTALLER,
-            )
+                else:
+                    try:
+                        # Tries to use the lockfile if it's available since it has
+                        # pinned dependencies. This code is wrapped into try/except
+                        # because the lockfile lookup might fail if the file is not
+                        # in external storage or on disk, or if parsing fails
+                        specification = schema.LockfileSpecification.model_validate(
+                            {
+                                "name": build.specification.name,
+                                "lockfile": json.loads(
+                                    conda_store.storage.get(build.conda_lock_key)
+                                ),
+                            }
+                        )
+                        is_lockfile = True
+                    except Exception as e:
+                        conda_store.log.warning(
+                            "Exception while obtaining lockfile, using specification",
+                            exc_info=e,
+                        )
+                        specification = schema.CondaSpecification.model_validate(
+                            build.specification.spec
+                        )
+
+                context = action.action_generate_constructor_installer(
+                    conda_command=settings.conda_command,
+                    specification=specification,
+                    installer_dir=pathlib.Path(tmpdir),
+                    version=build.build_key,
+                    stdout=LoggedStream(
+                        db=db,
+                        conda_store=conda_store,
+                        build=build,
+                        prefix="action_generate_constructor_installer: ",
+                    ),
+                    is_lockfile=is_lockfile,
+                )
+                output_filename = context.result
+                if output_filename is None:
+                    return
+                conda_store.storage.fset(
+                    db,
+                    build.id,
+                    build.constructor_installer_key,
+                    output_filename,
+                    content_type="application/octet-stream",
+                    artifact_type=schema.BuildArtifactType.CONSTRUCTOR_INSTALLER,
+                )
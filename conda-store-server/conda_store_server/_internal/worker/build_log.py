@@ -0,0 +1,165 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Append-only, buffered writer for build logs
+
+Build logs used to be written by reading the whole log back from storage,
+appending a single line and uploading the result again, which is quadratic
+in the size of the log. Instead, each task writing to a build log opens a
+BuildLogWriter that buffers lines in memory and only appends them to storage
+when the buffer grows too large, when too much time has passed since the
+last flush, or when the build moves to the next phase. The BuildArtifact row
+for the log is registered once, when the writer is closed. Storage backends
+which can not append in place, e.g. S3, store each flush as a separate part
+which is concatenated into the log when the writer is closed.
+"""
+
+import contextlib
+import threading
+import time
+import typing
+
+from filelock import FileLock
+from sqlalchemy.orm import Session
+
+from conda_store_server._internal import orm, schema
+
+# Flush buffered logs once this many bytes are pending
+FLUSH_BYTES = 64 * 1024
+
+# Flush buffered logs if this many seconds passed since the last flush, so
+# users following a build still see progress during long running phases
+FLUSH_INTERVAL = 5.0
+
+# Writers opened via open_build_log, indexed by build id. Used by
+# append_to_logs to route writes to the writer of a running task
+_active_writers: typing.Dict[int, "BuildLogWriter"] = {}
+_active_writers_lock = threading.Lock()
+
+
+class BuildLogWriter:
+    """Buffered, append-only writer for the log of a single build"""
+
+    def __init__(
+        self,
+        db: Session,
+        conda_store,
+        build: orm.Build,
+        flush_bytes: int = FLUSH_BYTES,
+        flush_interval: float = FLUSH_INTERVAL,
+    ):
+        self.db = db
+        self.conda_store = conda_store
+        self.build_id = build.id
+        self.build = build
+        self.key = build.log_key
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+
+        self._buffer: typing.List[bytes] = []
+        self._buffer_size = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+        self._closed = False
+        self._lock_path = None
+
+    def write(self, logs: typing.Union[str, bytes, None]):
+        if isinstance(logs, str):
+            logs = logs.encode("utf-8")
+        elif logs is None:
+            logs = b""
+
+        if not logs:
+            return
+
+        with self._lock:
+            if self._closed:
+                raise ValueError(f"log writer for build {self.build_id} is closed")
+
+            self._log_lock_path()
+            self._buffer.append(logs)
+            self._buffer_size += len(logs)
+
+            if (
+                self._buffer_size >= self.flush_bytes
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            ):
+                self.flush()
+
+    def _log_lock_path(self) -> str:
+        # Note: build_path can fail due to the filename size limit, so it's
+        # only evaluated once logs need to be written. It is evaluated once,
+        # by the first write, as it may load the build through the session,
+        # which other threads writing to the log must not use
+        if self._lock_path is None:
+            self._lock_path = f"{self.build.build_path(self.conda_store)}.log.lock"
+        return self._lock_path
+
+    def flush(self):
+        """Append all buffered logs to storage"""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._buffer:
+                return
+
+            data = b"".join(self._buffer)
+            self._buffer = []
+            self._buffer_size = 0
+
+            # For instance, with local storage, this involves writing to a
+            # file. Locking here prevents a race condition when multiple
+            # tasks attempt to write to a shared resource, which is the log.
+            with FileLock(self._log_lock_path()):
+                self.conda_store.storage.append(
+                    self.key, data, content_type="text/plain"
+                )
+
+    def close(self):
+        """Flush remaining logs and register the log as a build artifact"""
+        with self._lock:
+            if self._closed:
+                return
+            self.flush()
+            self._closed = True
+
+            with FileLock(self._log_lock_path()):
+                self.conda_store.storage.finish_append(
+                    self.key, content_type="text/plain"
+                )
+
+        self.conda_store.storage.register_build_artifact(
+            self.db,
+            self.build_id,
+            self.key,
+            artifact_type=schema.BuildArtifactType.LOGS,
+        )
+
+
+def get_build_log_writer(build: orm.Build) -> typing.Optional[BuildLogWriter]:
+    """Returns the writer opened by the current process for build, if any"""
+    with _active_writers_lock:
+        return _active_writers.get(build.id)
+
+
+@contextlib.contextmanager
+def open_build_log(db: Session, conda_store, build: orm.Build, **kwargs):
+    """Opens a BuildLogWriter for build for the duration of the context
+
+    Nested calls for the same build reuse the outer writer, which is only
+    closed when the outermost context exits.
+    """
+    with _active_writers_lock:
+        writer = _active_writers.get(build.id)
+        is_owner = writer is None
+        if is_owner:
+            writer = BuildLogWriter(db, conda_store, build, **kwargs)
+            _active_writers[build.id] = writer
+
+    try:
+        yield writer
+    finally:
+        if is_owner:
+            with _active_writers_lock:
+                _active_writers.pop(build.id, None)
+            writer.close()
@@ -0,0 +1,123 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Timing and resource usage of the phases of a build
+
+Each phase is recorded as an orm.BuildPhase with its wall time and the
+resource usage of the worker process and of the child processes it reaped
+during the phase, e.g. conda and conda-lock. CPU time and I/O are the
+difference of getrusage before and after the phase. The peak RSS is that
+of the largest child process, the peak RSS of the worker process is used
+for phases which run in-process.
+"""
+
+import contextlib
+import datetime
+import sys
+import time
+import typing
+
+from sqlalchemy.orm import Session
+
+from conda_store_server._internal import orm, utils
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# getrusage counts blocks of 512 bytes for inblock and oublock
+BLOCK_SIZE = 512
+
+
+def _maxrss_bytes(maxrss: int) -> int:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def _cpu_time(rusage) -> float:
+    return rusage.ru_utime + rusage.ru_stime
+
+
+def _usage(
+    self_start, self_end, children_start, children_end, reaped: typing.List
+) -> typing.Dict:
+    max_rss = [_maxrss_bytes(_.ru_maxrss) for _ in reaped]
+    # Children which were not reaped by utils.wait_process only show up in
+    # the peak of all children, when they exceed the previous peak
+    if children_end.ru_maxrss > children_start.ru_maxrss:
+        max_rss.append(_maxrss_bytes(children_end.ru_maxrss))
+
+    return {
+        "cpu_time": (
+            _cpu_time(self_end)
+            - _cpu_time(self_start)
+            + _cpu_time(children_end)
+            - _cpu_time(children_start)
+        ),
+        "max_rss": max(max_rss) if max_rss else _maxrss_bytes(self_end.ru_maxrss),
+        "bytes_read": BLOCK_SIZE
+        * (
+            self_end.ru_inblock
+            - self_start.ru_inblock
+            + children_end.ru_inblock
+            - children_start.ru_inblock
+        ),
+        "bytes_written": BLOCK_SIZE
+        * (
+            self_end.ru_oublock
+            - self_start.ru_oublock
+            + children_end.ru_oublock
+            - children_start.ru_oublock
+        ),
+    }
+
+
+@contextlib.contextmanager
+def build_phase(db: Session, conda_store, build: orm.Build, name: str):
+    """Records the phase name of build, also when it fails"""
+    reaped = []
+    token = utils.child_rusage.set(reaped)
+    started_on = datetime.datetime.utcnow()
+    start_time = time.monotonic()
+    if resource is not None:
+        self_start = resource.getrusage(resource.RUSAGE_SELF)
+        children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    try:
+        yield
+    finally:
+        wall_time = time.monotonic() - start_time
+        utils.child_rusage.reset(token)
+
+        usage = {}
+        if resource is not None:
+            usage = _usage(
+                self_start,
+                resource.getrusage(resource.RUSAGE_SELF),
+                children_start,
+                resource.getrusage(resource.RUSAGE_CHILDREN),
+                reaped,
+            )
+
+        conda_store.log.info(f"build {build.id} phase {name} took {wall_time:.3f} [s]")
+        # Failing to record a phase must not fail the build or hide the
+        # exception of the phase
+        try:
+            db.add(
+                orm.BuildPhase(
+                    build_id=build.id,
+                    name=name,
+                    started_on=started_on,
+                    wall_time=wall_time,
+                    **usage,
+                )
+            )
+            db.commit()
+        except Exception:
+            conda_store.log.exception(
+                f"failed to record phase {name} of build {build.id}"
+            )
+            db.rollback()
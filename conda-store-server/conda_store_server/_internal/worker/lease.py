@@ -0,0 +1,70 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Leases of workers on the builds they are running
+
+While a worker runs a build it holds a lease on it, which a heartbeat
+thread renews several times per CondaStore.build_lease_timeout. When the
+worker dies the lease expires and build_cleanup marks the build as failed,
+without having to ask the workers which tasks they are running.
+"""
+
+import contextlib
+import datetime
+import os
+import socket
+import threading
+
+from conda_store_server import api
+
+# Number of times a lease is renewed before it would expire, so that a
+# single slow renewal does not lose the lease
+LEASE_RENEWALS = 3
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+@contextlib.contextmanager
+def build_lease(conda_store, build_id: int):
+    """Holds the lease on a build while the context is active"""
+    duration = datetime.timedelta(seconds=conda_store.config.build_lease_timeout)
+    owner = worker_id()
+
+    with conda_store.session_factory() as db:
+        api.acquire_build_lease(db, build_id, owner, duration)
+
+    stop = threading.Event()
+
+    def heartbeat():
+        with conda_store.session_factory() as db:
+            while not stop.wait(duration.total_seconds() / LEASE_RENEWALS):
+                try:
+                    is_renewed = api.renew_build_lease(db, build_id, owner, duration)
+                except Exception:
+                    conda_store.log.exception(
+                        f"failed to renew the lease on build {build_id}"
+                    )
+                    db.rollback()
+                    continue
+
+                if not is_renewed:
+                    conda_store.log.warning(
+                        f"lost the lease on build {build_id}, "
+                        "it was canceled or considered stuck"
+                    )
+                    return
+
+    thread = threading.Thread(
+        target=heartbeat, name=f"build-{build_id}-lease", daemon=True
+    )
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        with conda_store.session_factory() as db:
+            api.release_build_lease(db, build_id, owner)
@@ -0,0 +1,270 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Speculative download of packages while a build is solved
+
+The packages of a build are only known once its environment is solved,
+but they can often be predicted: lockfile specifications list them, and
+a new build of an environment mostly needs the packages of its current
+build. While the solve runs, these packages are downloaded into the
+package cache by a few background threads, with a bounded bandwidth.
+
+Once the solve finishes, downloads of packages which the build does not
+need are aborted and the remaining ones are left to finish, the download
+phase of the build waits for them on the package locks. Downloads are
+also aborted when the build is canceled.
+
+The background threads log to the build log writer of the build through a
+PrefetchLogStream, which never uses the database session of the build.
+"""
+
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import pathlib
+import threading
+import time
+import typing
+
+from conda_store_server import api
+from conda_store_server._internal import conda_utils, orm, schema
+from conda_store_server._internal.action.base import ActionContext
+from conda_store_server._internal.action.download_packages import (
+    fetch_and_extract_conda_package,
+)
+from conda_store_server._internal.worker import build_log
+
+# Seconds between checks whether the build was canceled
+CANCEL_CHECK_INTERVAL = 5
+
+
+class PrefetchCanceledError(Exception):
+    pass
+
+
+class RateLimiter:
+    """Limits the number of bytes per second consumed by several threads"""
+
+    def __init__(self, rate: int):
+        self.rate = rate
+        self._lock = threading.Lock()
+        # Allows bursts of up to one second worth of bytes
+        self._available = rate
+        self._updated_on = time.monotonic()
+
+    def consume(self, size: int):
+        with self._lock:
+            now = time.monotonic()
+            self._available = min(
+                self.rate, self._available + (now - self._updated_on) * self.rate
+            )
+            self._updated_on = now
+            self._available -= size
+            delay = -self._available / self.rate if self._available < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+
+class PrefetchLogStream:
+    """Writes the logs of the prefetch threads to the log writer of a build
+
+    Unlike build.LoggedStream, it does not open a writer when none is open,
+    which requires the database session of the build, a session is not
+    thread safe. Downloads left to finish may log once the writer is
+    closed, their logs then go to the conda-store logger.
+    """
+
+    def __init__(self, conda_store, log: build_log.BuildLogWriter, prefix: str):
+        self.conda_store = conda_store
+        self.log = log
+        self.prefix = prefix
+
+    def write(self, b, /):
+        for line in b.split("\n"):
+            # Skips empty lines
+            if not line:
+                continue
+            try:
+                self.log.write(f"{self.prefix}{line}\n")
+            except ValueError:
+                self.conda_store.log.info(
+                    f"build {self.log.build_id} {self.prefix}{line}"
+                )
+
+    def flush(self):
+        pass
+
+
+def predicted_lockfile(conda_store, build: orm.Build) -> typing.Optional[typing.Dict]:
+    """The lockfile of build if it is known, else the lockfile of the current
+    build of its environment
+    """
+    if build.specification.is_lockfile:
+        return schema.LockfileSpecification.model_validate(
+            build.specification.spec
+        ).model_dump()["lockfile"]
+
+    previous_build = build.environment.current_build
+    if (
+        previous_build is None
+        or previous_build.id == build.id
+        or previous_build.status != schema.BuildStatus.COMPLETED
+    ):
+        return None
+
+    try:
+        return json.loads(conda_store.storage.get(previous_build.conda_lock_key))
+    except Exception:
+        conda_store.log.warning(
+            f"cannot read lockfile of build {previous_build.id}", exc_info=True
+        )
+        return None
+
+
+class Prefetcher:
+    def __init__(
+        self,
+        conda_store,
+        build_id: int,
+        packages: typing.List[typing.Dict],
+        pkgs_dir: pathlib.Path,
+        context: ActionContext,
+        max_workers: int = 1,
+        max_bandwidth: int = 0,
+    ):
+        self.conda_store = conda_store
+        self.build_id = build_id
+        self.pkgs_dir = pkgs_dir
+        self.context = context
+        self.rate_limiter = RateLimiter(max_bandwidth) if max_bandwidth else None
+
+        # urls of the packages whose downloads are not aborted once stopped
+        self._keep = set()
+        self._stopped = threading.Event()
+        self._is_build_canceled = False
+        self._checked_on = time.monotonic()
+        self._check_lock = threading.Lock()
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, max_workers),
+            thread_name_prefix=f"build-{build_id}-prefetch",
+        )
+        self._futures = [
+            self._executor.submit(self._fetch, package) for package in packages
+        ]
+
+    def _build_canceled(self) -> bool:
+        with self._check_lock:
+            now = time.monotonic()
+            if (
+                not self._is_build_canceled
+                and now - self._checked_on >= CANCEL_CHECK_INTERVAL
+            ):
+                self._checked_on = now
+                with self.conda_store.session_factory() as db:
+                    build = api.get_build(db, self.build_id)
+                    lease = api.get_build_lease(db, self.build_id)
+                    # Canceling a running build revokes its lease
+                    self._is_build_canceled = (
+                        build.status == schema.BuildStatus.CANCELED
+                        or (
+                            lease is not None
+                            and lease.expires_on <= datetime.datetime.utcnow()
+                        )
+                    )
+            return self._is_build_canceled
+
+    def _is_canceled(self, url: str) -> bool:
+        if self._stopped.is_set() and url not in self._keep:
+            return True
+        return self._build_canceled()
+
+    def _fetch(self, package: typing.Dict):
+        url = package["url"]
+
+        def on_chunk(size: int):
+            if self._is_canceled(url):
+                raise PrefetchCanceledError(url)
+            if self.rate_limiter is not None:
+                self.rate_limiter.consume(size)
+
+        if self._is_canceled(url):
+            raise PrefetchCanceledError(url)
+
+        fetch_and_extract_conda_package(
+            self.context, package, self.pkgs_dir, "prefetch", on_chunk=on_chunk
+        )
+
+    def stop(self, keep: typing.Iterable[str] = ()):
+        """Stops prefetching packages whose url is not in keep
+
+        Downloads which did not start yet are canceled, the downloads of
+        packages in keep which already started are left to finish.
+        """
+        if self._stopped.is_set():
+            return
+
+        self._keep = set(keep)
+        self._stopped.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+        done = [
+            future
+            for future in self._futures
+            if future.done() and not future.cancelled()
+        ]
+        fetched = sum(1 for future in done if future.exception() is None)
+        self.context.log.info(
+            f"prefetched {fetched} of {len(self._futures)} packages, "
+            f"{len(self._futures) - len(done)} were still pending\n"
+        )
+
+
+@contextlib.contextmanager
+def prefetch_packages(
+    conda_store,
+    build: orm.Build,
+    log: typing.Optional[build_log.BuildLogWriter] = None,
+):
+    """Prefetches the packages build is likely to need while the context is
+    active, logging to the build log writer log
+
+    Yields a function which is called with the urls of the packages the
+    build actually needs once they are known.
+    """
+    keep = set()
+    lockfile = None
+    if conda_store.config.conda_prefetch_packages:
+        lockfile = predicted_lockfile(conda_store, build)
+
+    if lockfile is None:
+        yield keep.update
+        return
+
+    platforms = [conda_utils.conda_platform(), "noarch"]
+    packages = [
+        package
+        for package in lockfile["package"]
+        if package["manager"] == "conda" and package["platform"] in platforms
+    ]
+    prefetcher = Prefetcher(
+        conda_store,
+        build.id,
+        packages,
+        pkgs_dir=conda_utils.conda_root_package_dir(),
+        context=ActionContext(
+            stdout=None
+            if log is None
+            else PrefetchLogStream(conda_store, log, prefix="prefetch: ")
+        ),
+        max_workers=conda_store.config.conda_prefetch_max_workers,
+        max_bandwidth=conda_store.config.conda_prefetch_max_bandwidth,
+    )
+
+    try:
+        yield keep.update
+    finally:
+        prefetcher.stop(keep)
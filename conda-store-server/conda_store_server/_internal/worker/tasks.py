@@ -2,10 +2,13 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import concurrent.futures
 import datetime
 import os
+import pathlib
 import shutil
 import sys
+import time
 import typing
 
 import yaml
@@ -13,10 +16,20 @@ from celery import Task, platforms, shared_task
 from celery.execute import send_task
 from celery.signals import worker_ready
 from filelock import FileLock
-from sqlalchemy.orm import Session
-
-from conda_store_server import api
-from conda_store_server._internal import environment, schema, utils
+from sqlalchemy.orm import Session, joinedload
+
+from conda_store_server import api, exception
+from conda_store_server._internal import (
+    admission,
+    conda_utils,
+    environment,
+    orm,
+    pkgs_cache,
+    scheduler,
+    schema,
+    utils,
+)
+from conda_store_server._internal.worker import lease
 from conda_store_server._internal.worker.app import CondaStoreWorker
 from conda_store_server._internal.worker.build import (
     build_cleanup,
@@ -24,9 +37,17 @@ from conda_store_server._internal.worker.build import (
     build_conda_environment,
     build_conda_pack,
     build_constructor_installer,
+    set_build_deferred,
+    set_build_failed,
     solve_conda_environment,
 )
 
+# Number of keys deleted from storage per call of Storage.delete_many
+DELETE_BATCH_SIZE = 1000
+
+# Seconds between progress reports of bulk deletions
+PROGRESS_INTERVAL = 10
+
 
 @worker_ready.connect
 def at_start(sender, **k):
@@ -110,6 +131,33 @@ def task_update_storage_metrics(self):
         )
 
 
+# The package cache is local to each worker, this evicts packages from the
+# cache of the worker which runs the task
+@shared_task(base=WorkerTask, name="task_evict_pkgs_cache", bind=True)
+def task_evict_pkgs_cache(self):
+    conda_store = self.worker.conda_store
+    max_size = conda_store.config.pkgs_cache_max_size
+    if not max_size:
+        return
+
+    pkgs_dir = conda_utils.conda_root_package_dir()
+    if not pkgs_dir.exists():
+        return
+
+    result = pkgs_cache.evict_packages(pkgs_dir, max_size, log=conda_store.log)
+    conda_store.log.info(
+        f"evicted {result['evicted_packages']} packages of "
+        f"{result['evicted_bytes']} bytes from {pkgs_dir}, "
+        f"{result['size']} bytes remain"
+    )
+    with conda_store.session_factory() as db:
+        orm.CondaStoreConfiguration.increment_pkgs_cache_metrics(
+            db,
+            evicted_packages=result["evicted_packages"],
+            evicted_bytes=result["evicted_bytes"],
+        )
+
+
 @shared_task(base=WorkerTask, name="task_cleanup_builds", bind=True)
 def task_cleanup_builds(
     self,
@@ -120,6 +168,14 @@ def task_cleanup_builds(
     conda_store = self.worker.conda_store
     with conda_store.session_factory() as db:
         build_cleanup(db, conda_store, build_ids, reason, is_canceled)
+        scheduler.schedule_builds(db, conda_store)
+
+
+@shared_task(base=WorkerTask, name="task_schedule_builds", bind=True)
+def task_schedule_builds(self):
+    conda_store = self.worker.conda_store
+    with conda_store.session_factory() as db:
+        scheduler.schedule_builds(db, conda_store)
 
 
 """
@@ -133,6 +189,11 @@ Two scenarios :
 The reason behind having the task running only once at a time is
 to avoid integrity exceptions when running channel.update_packages.
 
+With the repodata cache, each subdir of a channel is updated by its own task,
+task_update_conda_channel_subdir, locked per channel and subdir. The packages
+shared by the subdirs of a channel may then be inserted concurrently, which
+ChannelIndexer handles.
+
 Sources :
 Lock : http://loose-bits.com/2010/10/distributed-task-locking-in-celery.html
 Redis : https://pypi.org/project/redis/
@@ -150,10 +211,15 @@ def task_update_conda_channels(self):
             send_task("task_update_conda_channel", args=[channel.name], kwargs={})
 
 
-@shared_task(base=WorkerTask, name="task_update_conda_channel", bind=True)
-def task_update_conda_channel(self, channel_name):
-    conda_store = self.worker.conda_store
-    settings = conda_store.get_settings()
+def _repodata_cache_directory(conda_store) -> typing.Optional[str]:
+    cache_dir = conda_store.config.conda_repodata_cache_directory.format(
+        store_directory=conda_store.config.store_directory
+    )
+    return cache_dir or None
+
+
+def _update_conda_channel(task, channel_name, subdirs, cache_dir=None):
+    conda_store = task.worker.conda_store
 
     # sanitize the channel name as it's an URL, and it's used for the lock.
     sanitizing = {
@@ -169,7 +235,9 @@ def task_update_conda_channel(self, channel_name):
     for k, v in sanitizing.items():
         channel_name_sanitized = channel_name_sanitized.replace(k, v)
 
-    task_key = f"lock_{self.name}_{channel_name_sanitized}"
+    task_key = f"lock_{task.name}_{channel_name_sanitized}"
+    if len(subdirs) == 1:
+        task_key = f"{task_key}_{subdirs[0]}"
 
     is_locked = False
 
@@ -186,12 +254,19 @@ def task_update_conda_channel(self, channel_name):
             with conda_store.session_factory() as db:
                 channel = api.get_conda_channel(db, channel_name)
 
-                conda_store.log.debug(f"updating packages for channel {channel.name}")
-                channel.update_packages(db, subdirs=settings.conda_platforms)
+                conda_store.log.debug(
+                    f"updating packages for channel {channel.name} subdirs {subdirs}"
+                )
+                channel.update_packages(
+                    db,
+                    subdirs=subdirs,
+                    cache_dir=cache_dir,
+                    max_workers=conda_store.config.conda_channel_max_concurrent_downloads,
+                )
 
         else:
             conda_store.log.debug(
-                f"skipping updating packages for channel {channel_name} - already in progress"
+                f"skipping updating packages for channel {channel_name} subdirs {subdirs} - already in progress"
             )
 
     except TimeoutError:
@@ -206,6 +281,40 @@ def task_update_conda_channel(self, channel_name):
             lock.release()
 
 
+@shared_task(base=WorkerTask, name="task_update_conda_channel", bind=True)
+def task_update_conda_channel(self, channel_name):
+    conda_store = self.worker.conda_store
+    settings = conda_store.get_settings()
+    cache_dir = _repodata_cache_directory(conda_store)
+
+    if cache_dir is None:
+        # Without the repodata cache, the repodata of all the subdirs is
+        # downloaded if channeldata.json changed since the channel was last
+        # updated, so that the subdirs are updated together
+        _update_conda_channel(self, channel_name, settings.conda_platforms)
+        return
+
+    # Each subdir has its own task, so that the subdirs of large channels
+    # are downloaded and indexed in parallel by the workers
+    for subdir in settings.conda_platforms:
+        send_task(
+            "task_update_conda_channel_subdir",
+            args=[channel_name, subdir],
+            kwargs={},
+        )
+
+
+@shared_task(base=WorkerTask, name="task_update_conda_channel_subdir", bind=True)
+def task_update_conda_channel_subdir(self, channel_name, subdir):
+    conda_store = self.worker.conda_store
+    _update_conda_channel(
+        self,
+        channel_name,
+        [subdir],
+        cache_dir=_repodata_cache_directory(conda_store),
+    )
+
+
 @shared_task(base=WorkerTask, name="task_solve_conda_environment", bind=True)
 def task_solve_conda_environment(self, solve_id):
     conda_store = self.worker.conda_store
@@ -219,9 +328,45 @@ def task_solve_conda_environment(self, solve_id):
 def task_build_conda_environment(self, build_id):
     conda_store = self.worker.conda_store
 
-    with conda_store.session_factory() as db:
-        build = api.get_build(db, build_id)
-        build_conda_environment(db, conda_store, build)
+    try:
+        with conda_store.session_factory() as db:
+            build = api.get_build(db, build_id)
+            if build.status != schema.BuildStatus.QUEUED:
+                # e.g. canceled while waiting for a worker
+                raise exception.CondaStoreError(
+                    f"build {build_id} is {build.status.value}, not building it"
+                )
+
+            reason = admission.check_build_resources(conda_store)
+            if reason is not None:
+                if (
+                    self.request.retries
+                    >= conda_store.config.build_admission_max_deferrals
+                ):
+                    set_build_failed(
+                        db,
+                        build,
+                        status_info=f"insufficient worker resources: {reason}",
+                    )
+                    raise exception.CondaStoreError(reason)
+
+                # Retrying keeps the rest of the chain of the build, the
+                # retry may be picked up by another worker
+                conda_store.log.info(f"deferring build {build_id}: {reason}")
+                set_build_deferred(db, build, reason)
+                raise self.retry(
+                    countdown=conda_store.config.build_admission_retry_delay,
+                    max_retries=None,
+                )
+
+            # The lease is acquired before the build is marked as BUILDING
+            # so that build_cleanup never sees a running build without one
+            with lease.build_lease(conda_store, build.id):
+                build_conda_environment(db, conda_store, build)
+    finally:
+        # The build no longer counts towards the limits of the scheduler
+        with conda_store.session_factory() as db:
+            scheduler.schedule_builds(db, conda_store)
 
 
 @shared_task(base=WorkerTask, name="task_build_conda_env_export", bind=True)
@@ -264,21 +409,195 @@ def task_update_environment_build(self, environment_id):
             conda_store.post_update_environment_build_hook(conda_store, environment)
 
 
+def _delete_build_prefix(
+    conda_store, conda_prefix: pathlib.Path, key: str, is_shared: bool
+) -> bool:
+    """Deletes the prefix of a build, returns whether it existed"""
+    # be REALLY sure this is a directory within store directory
+    if not str(conda_prefix).startswith(conda_store.config.store_directory):
+        return False
+
+    if conda_prefix.is_symlink():
+        # the key is the shared prefix the build path links to
+        shared_prefix = pathlib.Path(key)
+        conda_prefix.unlink()
+        if (
+            not is_shared
+            and str(shared_prefix).startswith(conda_store.config.store_directory)
+            and shared_prefix.is_dir()
+        ):
+            shutil.rmtree(shared_prefix)
+        return True
+    elif os.path.isdir(conda_prefix):
+        if not is_shared:
+            shutil.rmtree(conda_prefix)
+        return True
+    return False
+
+
+def _delete_build_prefixes(
+    conda_store,
+    prefixes: typing.List[typing.Tuple[pathlib.Path, str, bool, int]],
+) -> typing.List[int]:
+    """Deletes prefixes which resolve to the same directory one after the
+    other, symlinks first
+
+    prefixes are tuples (conda_prefix, key, is_shared, build_artifact_id).
+    Returns the ids of the build artifacts whose prefix was not deleted,
+    e.g. because it is missing or not within the store directory, like
+    delete_build_artifact. The directory removed through a symlink is the
+    prefix of the other builds.
+    """
+    not_deleted = []
+    for conda_prefix, key, is_shared, build_artifact_id in sorted(
+        prefixes, key=lambda prefix: not prefix[0].is_symlink()
+    ):
+        if not _delete_build_prefix(conda_store, conda_prefix, key, is_shared):
+            not_deleted.append(build_artifact_id)
+    if len(not_deleted) < len(prefixes):
+        return []
+    return not_deleted
+
+
 def delete_build_artifact(db: Session, conda_store, build_artifact):
+    # Builds with identical lockfiles may share a prefix or archive, see
+    # CondaStore.build_deduplication. Shared data is only deleted together
+    # with the last artifact referencing it
+    is_shared = (
+        api.list_build_artifacts(db, key=build_artifact.key)
+        .filter(orm.BuildArtifact.build_id != build_artifact.build_id)
+        .count()
+        > 0
+    )
+
     if build_artifact.artifact_type == schema.BuildArtifactType.DIRECTORY:
-        # ignore key
-        conda_prefix = build_artifact.build.build_path(conda_store)
-        # be REALLY sure this is a directory within store directory
-        if str(conda_prefix).startswith(
-            conda_store.config.store_directory
-        ) and os.path.isdir(conda_prefix):
-            shutil.rmtree(conda_prefix)
+        if _delete_build_prefix(
+            conda_store,
+            build_artifact.build.build_path(conda_store),
+            build_artifact.key,
+            is_shared,
+        ):
             db.delete(build_artifact)
+    elif is_shared:
+        conda_store.log.info(f"keeping {build_artifact.key} referenced by other builds")
+        db.delete(build_artifact)
+        db.commit()
     else:
         conda_store.log.info(f"deleting {build_artifact.key}")
         conda_store.storage.delete(db, build_artifact.build.id, build_artifact.key)
 
 
+def delete_builds_artifacts(
+    db: Session,
+    conda_store,
+    build_ids,
+    excluded_artifact_types: typing.List[schema.BuildArtifactType] = None,
+    progress: typing.Optional[typing.Callable[[int, int], None]] = None,
+):
+    """Deletes the artifacts of many builds at once
+
+    build_ids is a list or a select of build ids. Prefixes are removed by
+    CondaStore.delete_max_workers threads and other artifacts are deleted
+    from storage in batches of DELETE_BATCH_SIZE keys. progress is called
+    with the number of deleted and of all artifacts.
+    """
+    filters = [orm.BuildArtifact.build_id.in_(build_ids)]
+    if excluded_artifact_types:
+        filters.append(orm.BuildArtifact.artifact_type.not_in(excluded_artifact_types))
+
+    build_artifacts = (
+        db.query(orm.BuildArtifact)
+        .filter(*filters)
+        .options(
+            joinedload(orm.BuildArtifact.build)
+            .joinedload(orm.Build.environment)
+            .joinedload(orm.Environment.namespace)
+        )
+        .all()
+    )
+    # Artifacts shared with builds which are not deleted, see
+    # delete_build_artifact
+    shared_keys = set(api.list_shared_build_artifact_keys(db, build_ids))
+
+    prefixes = {}
+    keys = set()
+    for build_artifact in build_artifacts:
+        if build_artifact.artifact_type == schema.BuildArtifactType.DIRECTORY:
+            conda_prefix = build_artifact.build.build_path(conda_store)
+            prefixes[conda_prefix] = (build_artifact.key, build_artifact.id)
+        elif build_artifact.key and build_artifact.key not in shared_keys:
+            # Lockfiles of old builds are stored in the database, with an
+            # empty key
+            keys.add(build_artifact.key)
+
+    # A build sharing the prefix of another build, see
+    # CondaStore.build_deduplication, links to the same directory, which is
+    # removed by a single thread
+    directories = {}
+    for conda_prefix, (key, build_artifact_id) in prefixes.items():
+        directories.setdefault(os.path.realpath(conda_prefix), []).append(
+            (conda_prefix, key, key in shared_keys, build_artifact_id)
+        )
+
+    total = len(prefixes) + len(keys)
+    deleted = 0
+    not_deleted = []
+    # Storage and database sessions are not shared with the threads, which
+    # only remove directories
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=conda_store.config.delete_max_workers
+    ) as executor:
+        futures = {
+            executor.submit(
+                _delete_build_prefixes, conda_store, directory_prefixes
+            ): directory_prefixes
+            for directory_prefixes in directories.values()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            not_deleted.extend(future.result())
+            deleted += len(futures[future])
+            if progress is not None:
+                progress(deleted, total)
+
+    keys = sorted(keys)
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[start : start + DELETE_BATCH_SIZE]
+        conda_store.storage.delete_many(db, batch)
+        deleted += len(batch)
+        if progress is not None:
+            progress(deleted, total)
+
+    # Artifacts which are not deleted from storage: prefixes and artifacts
+    # shared with other builds. The artifacts of prefixes which were not
+    # deleted are kept, as delete_build_artifact does
+    if not_deleted:
+        filters.append(orm.BuildArtifact.id.not_in(not_deleted))
+    db.query(orm.BuildArtifact).filter(*filters).delete(synchronize_session=False)
+    db.commit()
+
+
+def _deletion_progress(task, conda_store, description: str):
+    """Progress callback of delete_builds_artifacts which logs at most every
+    PROGRESS_INTERVAL seconds and updates the state of task
+    """
+    last_report = time.monotonic()
+
+    def progress(deleted: int, total: int):
+        nonlocal last_report
+        now = time.monotonic()
+        if deleted < total and now - last_report < PROGRESS_INTERVAL:
+            return
+
+        last_report = now
+        conda_store.log.info(f"{description}: deleted {deleted} of {total} artifacts")
+        if task.request.id is not None:
+            task.update_state(
+                state="PROGRESS", meta={"deleted": deleted, "total": total}
+            )
+
+    return progress
+
+
 @shared_task(base=WorkerTask, name="task_delete_build", bind=True)
 def task_delete_build(self, build_id):
     conda_store = self.worker.conda_store
@@ -289,16 +608,17 @@ def task_delete_build(self, build_id):
 
         # Deletes build artifacts for this build
         conda_store.log.info(f"deleting artifacts for build={build.id}")
-        for build_artifact in api.list_build_artifacts(
+        delete_builds_artifacts(
             db,
-            build_id=build_id,
+            conda_store,
+            [build_id],
             excluded_artifact_types=settings.build_artifacts_kept_on_deletion,
-        ).all():
-            delete_build_artifact(db, conda_store, build_artifact)
+        )
 
         # Updates build size and marks build as deleted
         build.deleted_on = datetime.datetime.utcnow()
         build.size = 0
+        build.size_unique = 0
 
         db.commit()
 
@@ -307,17 +627,16 @@ def task_delete_build(self, build_id):
 def task_delete_environment(self, environment_id):
     conda_store = self.worker.conda_store
     with conda_store.session_factory() as db:
-        environment = api.get_environment(db, id=environment_id)
-
-        for build in environment.builds:
-            conda_store.log.info(f"deleting artifacts for build={build.id}")
-            for build_artifact in api.list_build_artifacts(
-                db,
-                build_id=build.id,
-            ).all():
-                delete_build_artifact(db, conda_store, build_artifact)
+        delete_builds_artifacts(
+            db,
+            conda_store,
+            api.select_environment_build_ids(environment_id=environment_id),
+            progress=_deletion_progress(
+                self, conda_store, f"deleting environment={environment_id}"
+            ),
+        )
 
-        db.delete(environment)
+        api.delete_environments(db, environment_id=environment_id)
         db.commit()
 
 
@@ -325,16 +644,15 @@ def task_delete_environment(self, environment_id):
 def task_delete_namespace(self, namespace_id):
     conda_store = self.worker.conda_store
     with conda_store.session_factory() as db:
-        namespace = api.get_namespace(db, id=namespace_id)
+        delete_builds_artifacts(
+            db,
+            conda_store,
+            api.select_environment_build_ids(namespace_id=namespace_id),
+            progress=_deletion_progress(
+                self, conda_store, f"deleting namespace={namespace_id}"
+            ),
+        )
 
-        for environment_orm in namespace.environments:
-            for build in environment_orm.builds:
-                conda_store.log.info(f"deleting artifacts for build={build.id}")
-                for build_artifact in api.list_build_artifacts(
-                    db,
-                    build_id=build.id,
-                ).all():
-                    delete_build_artifact(db, conda_store, build_artifact)
-            db.delete(environment_orm)
-        db.delete(namespace)
+        api.delete_environments(db, namespace_id=namespace_id)
+        api.delete_namespace(db, id=namespace_id)
         db.commit()
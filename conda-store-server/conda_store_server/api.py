@@ -3,11 +3,12 @@
 # license that can be found in the LICENSE file.
 from __future__ import annotations
 
+import datetime
 import re
 from typing import Any, Dict, List, Union
 
-from sqlalchemy import distinct, func, null, or_
-from sqlalchemy.orm import Query, aliased, session
+from sqlalchemy import and_, case, distinct, func, null, or_, select
+from sqlalchemy.orm import Query, aliased, contains_eager, session
 
 from conda_store_server._internal import conda_utils, orm, schema, utils
 from conda_store_server._internal.environment import filter_environments
@@ -276,6 +277,75 @@ def delete_namespace(db, name: str = None, id: int = None):
         db.delete(namespace)
 
 
+def _environments_filter(namespace_id: int = None, environment_id: int = None):
+    if environment_id is not None:
+        return orm.Environment.id == environment_id
+    return orm.Environment.namespace_id == namespace_id
+
+
+def select_environment_build_ids(namespace_id: int = None, environment_id: int = None):
+    """Select of the ids of the builds of an environment, or of all the
+    environments of a namespace
+    """
+    environment_ids = select(orm.Environment.id).where(
+        _environments_filter(namespace_id, environment_id)
+    )
+    return select(orm.Build.id).where(orm.Build.environment_id.in_(environment_ids))
+
+
+def soft_delete_environments(
+    db,
+    deleted_on: datetime.datetime,
+    namespace_id: int = None,
+    environment_id: int = None,
+):
+    """Marks an environment, or all the environments of a namespace, and
+    their builds as deleted with one UPDATE statement each
+    """
+    environments_filter = _environments_filter(namespace_id, environment_id)
+    db.query(orm.Build).filter(
+        orm.Build.environment_id.in_(
+            select(orm.Environment.id).where(environments_filter)
+        )
+    ).update({orm.Build.deleted_on: deleted_on}, synchronize_session=False)
+    db.query(orm.Environment).filter(environments_filter).update(
+        {orm.Environment.deleted_on: deleted_on}, synchronize_session=False
+    )
+
+
+def delete_environments(db, namespace_id: int = None, environment_id: int = None):
+    """Deletes an environment, or all the environments of a namespace, and
+    their builds with bulk DELETE statements
+
+    The artifacts of the builds are expected to be deleted from storage
+    already, see task_delete_environment.
+    """
+    environments_filter = _environments_filter(namespace_id, environment_id)
+    build_ids = select_environment_build_ids(namespace_id, environment_id)
+
+    # Environments reference their current build
+    db.query(orm.Environment).filter(environments_filter).update(
+        {orm.Environment.current_build_id: None}, synchronize_session=False
+    )
+    db.execute(
+        orm.build_conda_package.delete().where(
+            orm.build_conda_package.c.build_id.in_(build_ids)
+        )
+    )
+    for table in [orm.BuildArtifact, orm.BuildLease, orm.BuildPhase]:
+        db.query(table).filter(table.build_id.in_(build_ids)).delete(
+            synchronize_session=False
+        )
+    db.query(orm.Build).filter(
+        orm.Build.environment_id.in_(
+            select(orm.Environment.id).where(environments_filter)
+        )
+    ).delete(synchronize_session=False)
+    db.query(orm.Environment).filter(environments_filter).delete(
+        synchronize_session=False
+    )
+
+
 def list_environments(
     db: session.Session,
     namespace: str = None,
@@ -533,6 +603,236 @@ def get_build(db, build_id: int):
     return db.query(orm.Build).filter(orm.Build.id == build_id).first()
 
 
+def list_pending_builds(db):
+    """Builds waiting to be dispatched to workers, in order of submission
+
+    The environment and namespace of the builds are loaded by the same query,
+    the scheduler groups the builds by namespace.
+    """
+    return (
+        db.query(orm.Build)
+        .join(orm.Build.environment)
+        .join(orm.Environment.namespace)
+        .options(
+            contains_eager(orm.Build.environment).contains_eager(
+                orm.Environment.namespace
+            )
+        )
+        .filter(
+            orm.Build.status == schema.BuildStatus.QUEUED,
+            orm.Build.dispatched_on == null(),
+            orm.Build.deleted_on == null(),
+        )
+        .order_by(orm.Build.id)
+    )
+
+
+def count_dispatched_builds(db) -> Dict[str, int]:
+    """Number of dispatched builds which did not finish yet, by namespace name"""
+    query = (
+        db.query(orm.Namespace.name, func.count(orm.Build.id))
+        .join(orm.Build.environment)
+        .join(orm.Environment.namespace)
+        .filter(
+            orm.Build.status.in_(
+                [schema.BuildStatus.QUEUED, schema.BuildStatus.BUILDING]
+            ),
+            orm.Build.dispatched_on != null(),
+        )
+        .group_by(orm.Namespace.name)
+    )
+    return dict(query.all())
+
+
+def claim_pending_build(db, build_id: int) -> bool:
+    """Marks a pending build as dispatched
+
+    Returns False if the build is no longer pending, e.g. because it was
+    claimed by another process or canceled.
+    """
+    count = (
+        db.query(orm.Build)
+        .filter(
+            orm.Build.id == build_id,
+            orm.Build.status == schema.BuildStatus.QUEUED,
+            orm.Build.dispatched_on == null(),
+        )
+        .update(
+            {orm.Build.dispatched_on: datetime.datetime.utcnow()},
+            synchronize_session="fetch",
+        )
+    )
+    db.commit()
+    return count == 1
+
+
+def cancel_pending_build(db, build_id: int, status_info: str = None) -> bool:
+    """Cancels a build which was not dispatched to workers yet
+
+    Returns False if the build is not pending.
+    """
+    count = (
+        db.query(orm.Build)
+        .filter(
+            orm.Build.id == build_id,
+            orm.Build.status == schema.BuildStatus.QUEUED,
+            orm.Build.dispatched_on == null(),
+        )
+        .update(
+            {
+                orm.Build.status: schema.BuildStatus.CANCELED,
+                orm.Build.status_info: status_info,
+                orm.Build.ended_on: datetime.datetime.utcnow(),
+            },
+            synchronize_session="fetch",
+        )
+    )
+    db.commit()
+    return count == 1
+
+
+def get_build_lease(db, build_id: int) -> orm.BuildLease | None:
+    return db.query(orm.BuildLease).filter(orm.BuildLease.build_id == build_id).first()
+
+
+def acquire_build_lease(
+    db, build_id: int, worker_id: str, duration: datetime.timedelta
+) -> orm.BuildLease:
+    """Gives worker_id the lease on a build, replacing any previous lease"""
+    now = datetime.datetime.utcnow()
+    db.query(orm.BuildLease).filter(orm.BuildLease.build_id == build_id).delete()
+    lease = orm.BuildLease(
+        build_id=build_id,
+        worker_id=worker_id,
+        acquired_on=now,
+        expires_on=now + duration,
+    )
+    db.add(lease)
+    db.commit()
+    return lease
+
+
+def renew_build_lease(
+    db, build_id: int, worker_id: str, duration: datetime.timedelta
+) -> bool:
+    """Extends the lease of worker_id on a build
+
+    Returns False if the lease was lost, because it expired, it was
+    revoked or another worker acquired it.
+    """
+    now = datetime.datetime.utcnow()
+    count = (
+        db.query(orm.BuildLease)
+        .filter(
+            orm.BuildLease.build_id == build_id,
+            orm.BuildLease.worker_id == worker_id,
+            orm.BuildLease.expires_on > now,
+        )
+        .update(
+            {orm.BuildLease.expires_on: now + duration},
+            synchronize_session="fetch",
+        )
+    )
+    db.commit()
+    return count == 1
+
+
+def revoke_build_lease(db, build_id: int):
+    """Expires the lease on a build, so that it is reaped by build_cleanup"""
+    db.query(orm.BuildLease).filter(orm.BuildLease.build_id == build_id).update(
+        {orm.BuildLease.expires_on: datetime.datetime.utcnow()},
+        synchronize_session="fetch",
+    )
+    db.commit()
+
+
+def release_build_lease(db, build_id: int, worker_id: str = None):
+    query = db.query(orm.BuildLease).filter(orm.BuildLease.build_id == build_id)
+    if worker_id is not None:
+        query = query.filter(orm.BuildLease.worker_id == worker_id)
+    query.delete(synchronize_session="fetch")
+    db.commit()
+
+
+def list_expired_builds(db, grace: datetime.timedelta):
+    """BUILDING builds which are no longer running on a worker
+
+    These are builds whose lease expired, and builds without a lease which
+    started more than grace ago, e.g. builds started before leases existed.
+    """
+    now = datetime.datetime.utcnow()
+    return (
+        db.query(orm.Build)
+        .outerjoin(orm.BuildLease, orm.BuildLease.build_id == orm.Build.id)
+        .filter(
+            orm.Build.status == schema.BuildStatus.BUILDING,
+            or_(
+                orm.BuildLease.expires_on <= now,
+                (orm.BuildLease.build_id == null())
+                & (orm.Build.started_on < now - grace),
+            ),
+        )
+        .order_by(orm.Build.id)
+    )
+
+
+def cancel_unleased_build(db, build_id: int, status_info: str = None) -> bool:
+    """Cancels a dispatched build which is not running on any worker
+
+    Returns False if the build finished or a worker holds a live lease on
+    it, in which case the worker has to be stopped.
+    """
+    live_lease = (
+        db.query(orm.BuildLease.build_id)
+        .filter(
+            orm.BuildLease.build_id == build_id,
+            orm.BuildLease.expires_on > datetime.datetime.utcnow(),
+        )
+        .exists()
+    )
+    count = (
+        db.query(orm.Build)
+        .filter(
+            orm.Build.id == build_id,
+            orm.Build.status.in_(
+                [schema.BuildStatus.QUEUED, schema.BuildStatus.BUILDING]
+            ),
+            ~live_lease,
+        )
+        .update(
+            {
+                orm.Build.status: schema.BuildStatus.CANCELED,
+                orm.Build.status_info: status_info,
+                orm.Build.ended_on: datetime.datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+    )
+    db.commit()
+    return count == 1
+
+
+def get_average_build_duration(db, limit: int = 20) -> datetime.timedelta | None:
+    """Average time taken by the last limit completed builds"""
+    builds = (
+        db.query(orm.Build.started_on, orm.Build.ended_on)
+        .filter(
+            orm.Build.status == schema.BuildStatus.COMPLETED,
+            orm.Build.started_on != null(),
+            orm.Build.ended_on != null(),
+        )
+        .order_by(orm.Build.ended_on.desc())
+        .limit(limit)
+        .all()
+    )
+    if not builds:
+        return None
+    return sum(
+        (ended_on - started_on for started_on, ended_on in builds),
+        datetime.timedelta(),
+    ) / len(builds)
+
+
 def get_build_packages(
     db, build_id: int, search: str = None, exact: bool = False, build: str = None
 ):
@@ -604,6 +904,50 @@ def get_build_artifact(db, build_id: int, key: str):
     )
 
 
+def list_shared_build_artifact_keys(db, build_ids) -> List[str]:
+    """Keys of the artifacts of build_ids which are also artifacts of other
+    builds, see CondaStore.build_deduplication
+    """
+    other = aliased(orm.BuildArtifact)
+    return [
+        key
+        for (key,) in db.query(other.key)
+        .filter(
+            other.key.in_(
+                select(orm.BuildArtifact.key).where(
+                    orm.BuildArtifact.build_id.in_(build_ids)
+                )
+            ),
+            other.build_id.not_in(build_ids),
+        )
+        .distinct()
+    ]
+
+
+def get_shared_build_artifact(
+    db, build: orm.Build, artifact_type: schema.BuildArtifactType
+):
+    """Get an artifact of artifact_type of another completed build with the
+    same lockfile_hash as build
+    """
+    if build.lockfile_hash is None:
+        return None
+
+    return (
+        db.query(orm.BuildArtifact)
+        .join(orm.BuildArtifact.build)
+        .filter(
+            orm.Build.lockfile_hash == build.lockfile_hash,
+            orm.Build.id != build.id,
+            orm.Build.status == schema.BuildStatus.COMPLETED,
+            orm.Build.deleted_on == null(),
+            orm.BuildArtifact.artifact_type == artifact_type,
+        )
+        .order_by(orm.Build.id)
+        .first()
+    )
+
+
 def ensure_conda_channel(db, channel_name: str):
     conda_channel = get_conda_channel(db, channel_name)
     if conda_channel is None:
@@ -694,6 +1038,104 @@ def create_or_ignore_conda_package(db, package_record: Dict):
     return conda_package_build
 
 
+def create_or_ignore_conda_packages(
+    db, package_records: List[Dict], batch_size: int = 500
+) -> List[orm.CondaPackageBuild]:
+    """Bulk version of create_or_ignore_conda_package
+
+    Resolves channels, packages and package builds for all records with a
+    handful of set based queries instead of several queries per record, and
+    adds the missing rows to the session. Rows are flushed but not
+    committed, so the caller decides when the transaction ends.
+
+    Returns the unique package builds in input order. PyPI packages are
+    ignored.
+    """
+    package_records = [
+        _
+        for _ in package_records
+        if _["channel_id"] != "https://conda.anaconda.org/pypi"
+    ]
+    if not package_records:
+        return []
+
+    def batches(items):
+        items = list(items)
+        for i in range(0, len(items), batch_size):
+            yield items[i : i + batch_size]
+
+    # channels
+    channel_names = {_["channel_id"] for _ in package_records}
+    channels = {}
+    for batch in batches(channel_names):
+        for channel_orm in db.query(orm.CondaChannel).filter(
+            orm.CondaChannel.name.in_(batch)
+        ):
+            channels[channel_orm.name] = channel_orm
+    for channel_name in channel_names - channels.keys():
+        channels[channel_name] = create_conda_channel(db, channel_name)
+    db.flush()
+
+    # packages, unique on (channel_id, name, version)
+    def package_key(record):
+        return (channels[record["channel_id"]].id, record["name"], record["version"])
+
+    package_keys = {package_key(_) for _ in package_records}
+    packages = {}
+    for batch in batches({name for _, name, _ in package_keys}):
+        query = db.query(orm.CondaPackage).filter(
+            orm.CondaPackage.channel_id.in_({_[0] for _ in package_keys}),
+            orm.CondaPackage.name.in_(batch),
+        )
+        for package_orm in query:
+            key = (package_orm.channel_id, package_orm.name, package_orm.version)
+            if key in package_keys:
+                packages.setdefault(key, package_orm)
+    for record in package_records:
+        key = package_key(record)
+        if key not in packages:
+            packages[key] = create_conda_package(
+                db, package_record={**record, "channel_id": key[0]}
+            )
+    db.flush()
+
+    # package builds, matched on (package_id, subdir, build) like
+    # get_conda_package_build
+    def package_build_key(record):
+        return (packages[package_key(record)].id, record["subdir"], record["build"])
+
+    package_ids = {package.id for package in packages.values()}
+    package_builds = {}
+    for batch in batches(package_ids):
+        for package_build_orm in db.query(orm.CondaPackageBuild).filter(
+            orm.CondaPackageBuild.package_id.in_(batch)
+        ):
+            key = (
+                package_build_orm.package_id,
+                package_build_orm.subdir,
+                package_build_orm.build,
+            )
+            package_builds.setdefault(key, package_build_orm)
+
+    result = []
+    seen = set()
+    for record in package_records:
+        key = package_build_key(record)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        if key not in package_builds:
+            package_builds[key] = create_conda_package_build(
+                db, package_id=key[0], package_record=record
+            )
+            package_builds[key].channel_id = channels[record["channel_id"]].id
+        result.append(package_builds[key])
+    db.flush()
+
+    return result
+
+
 def create_conda_package(db, package_record: Dict):
     conda_package_keys = [
         "channel_id",
@@ -739,8 +1181,15 @@ def list_conda_packages(db, search: str = None, exact: bool = False, build: str
             filters.append(orm.CondaPackage.name.like(search.replace("%", r"\%")))
         else:
             filters.append(orm.CondaPackage.name.contains(search, autoescape=True))
+
+    # Packages whose builds were all removed from their channel, and are
+    # tombstoned, are not listed
+    build_filters = [orm.CondaPackageBuild.deleted_on.is_(None)]
     if build:
-        filters.append(orm.CondaPackage.build.contains(build, autoescape=True))
+        build_filters.append(
+            orm.CondaPackageBuild.build.contains(build, autoescape=True)
+        )
+    filters.append(orm.CondaPackage.builds.any(and_(*build_filters)))
 
     return db.query(orm.CondaPackage).join(orm.CondaChannel).filter(*filters)
 
@@ -751,6 +1200,12 @@ def get_metrics(db):
             orm.CondaStoreConfiguration.free_storage.label("disk_free"),
             orm.CondaStoreConfiguration.total_storage.label("disk_total"),
             orm.CondaStoreConfiguration.disk_usage,
+            orm.CondaStoreConfiguration.solve_cache_hits,
+            orm.CondaStoreConfiguration.solve_cache_misses,
+            orm.CondaStoreConfiguration.pkgs_cache_hits,
+            orm.CondaStoreConfiguration.pkgs_cache_misses,
+            orm.CondaStoreConfiguration.pkgs_cache_evicted_packages,
+            orm.CondaStoreConfiguration.pkgs_cache_evicted_bytes,
         )
         .first()
         ._asdict()
@@ -766,6 +1221,43 @@ def get_metrics(db):
     return metrics
 
 
+def list_build_phases(db, build_id: int):
+    return (
+        db.query(orm.BuildPhase)
+        .filter(orm.BuildPhase.build_id == build_id)
+        .order_by(orm.BuildPhase.id)
+    )
+
+
+def get_build_phase_histogram(
+    db, column: str, buckets: List[float]
+) -> Dict[str, Dict[str, Any]]:
+    """Histogram of a column of orm.BuildPhase by phase name
+
+    Returns the count, sum and cumulative count of each bucket upper bound
+    like a Prometheus histogram. Phases without a value are left out.
+    """
+    column = getattr(orm.BuildPhase, column)
+    query = (
+        db.query(
+            orm.BuildPhase.name,
+            func.count(column),
+            func.sum(column),
+            *[func.sum(case((column <= le, 1), else_=0)) for le in buckets],
+        )
+        .filter(column != null())
+        .group_by(orm.BuildPhase.name)
+    )
+    return {
+        name: {
+            "count": count,
+            "sum": total,
+            "buckets": list(zip(buckets, bucket_counts, strict=True)),
+        }
+        for name, count, total, *bucket_counts in query.all()
+    }
+
+
 def get_system_metrics(db):
     return db.query(
         orm.CondaStoreConfiguration.free_storage.label("disk_free"),
@@ -781,6 +1273,7 @@ def get_namespace_metrics(db):
             func.count(distinct(orm.Environment.id)),
             func.count(distinct(orm.Build.id)),
             func.sum(orm.Build.size),
+            func.sum(orm.Build.size_unique),
         )
         .join(orm.Build.environment)
         .join(orm.Environment.namespace)
@@ -788,6 +1281,25 @@ def get_namespace_metrics(db):
     )
 
 
+def get_solve_cache_entry(db, key: str):
+    return db.query(orm.SolveCache).filter(orm.SolveCache.key == key).first()
+
+
+def create_solve_cache_entry(db, key: str, lock_backend: str, lockfile: Dict):
+    entry = orm.SolveCache(key=key, lock_backend=lock_backend, lockfile=lockfile)
+    db.add(entry)
+    return entry
+
+
+def delete_solve_cache_entries(db, created_before: datetime.datetime) -> int:
+    """Delete solve cache entries created before the given time"""
+    return (
+        db.query(orm.SolveCache)
+        .filter(orm.SolveCache.created_on < created_before)
+        .delete(synchronize_session=False)
+    )
+
+
 def get_kvstore_key_values(db, prefix: str):
     """Get effective key, values for a particular prefix"""
     return {
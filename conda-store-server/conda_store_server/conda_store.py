@@ -13,7 +13,14 @@ from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.pool import QueuePool
 
 from conda_store_server import CONDA_STORE_DIR, api, conda_store_config, storage
-from conda_store_server._internal import conda_utils, orm, schema, settings, utils
+from conda_store_server._internal import (
+    conda_utils,
+    orm,
+    scheduler,
+    schema,
+    settings,
+    utils,
+)
 from conda_store_server.exception import CondaStoreError
 from conda_store_server.plugins import hookspec, plugin_manager
 from conda_store_server.plugins.types import lock
@@ -109,6 +116,7 @@ class CondaStore:
                 "celery.contrib.testing.tasks",
             ],
             "task_track_started": True,
+            "task_routes": self.config.celery_task_routes,
             "result_extended": True,
             "beat_schedule": {
                 "watch-paths": {
@@ -117,6 +125,24 @@ class CondaStore:
                     "args": [],
                     "kwargs": {},
                 },
+                "schedule-builds": {
+                    "task": "task_schedule_builds",
+                    "schedule": 30.0,  # 30 seconds
+                    "args": [],
+                    "kwargs": {},
+                },
+                "cleanup-builds": {
+                    "task": "task_cleanup_builds",
+                    "schedule": 60.0,  # 1 minute
+                    "args": [],
+                    "kwargs": {},
+                },
+                "evict-pkgs-cache": {
+                    "task": "task_evict_pkgs_cache",
+                    "schedule": 15.0 * 60.0,  # 15 minutes
+                    "args": [],
+                    "kwargs": {},
+                },
                 "update-conda-channels": {
                     "task": "task_update_conda_channels",
                     "schedule": 15.0 * 60.0,  # 15 minutes
@@ -315,16 +341,23 @@ class CondaStore:
             action=auth_schema.Permissions.ENVIRONMENT_UPDATE,
         )
 
-        settings = self.get_settings(
-            namespace=environment.namespace.name, environment_name=environment.name
-        )
-
         specification = api.get_specification(db, specification_sha256)
         build = api.create_build(
             db, environment_id=environment_id, specification_id=specification.id
         )
         db.commit()
 
+        scheduler.schedule_builds(db, self)
+
+        return build
+
+    def dispatch_build(self, db: Session, build: orm.Build):
+        """Submits the tasks of a build to the workers, see scheduler.py"""
+        environment = build.environment
+        settings = self.get_settings(
+            namespace=environment.namespace.name, environment_name=environment.name
+        )
+
         self.celery_app
 
         # must import tasks after a celery app has been initialized
@@ -359,19 +392,22 @@ class CondaStore:
                 )
             )
 
+        environment_task = tasks.task_build_conda_environment.subtask(
+            args=(build.id,),
+            task_id=f"build-{build.id}-environment",
+            immutable=True,
+        )
+        queue = self.config.namespace_build_queues.get(environment.namespace.name)
+        if queue is not None:
+            environment_task.set(queue=queue)
+
         (
             tasks.task_update_storage_metrics.si()
-            | tasks.task_build_conda_environment.subtask(
-                args=(build.id,),
-                task_id=f"build-{build.id}-environment",
-                immutable=True,
-            )
+            | environment_task
             | group(*artifact_tasks)
             | tasks.task_update_storage_metrics.si()
         ).apply_async(task_id=f"build-{build.id}")
 
-        return build
-
     def update_environment_build(
         self, db: Session, namespace: str, name: str, build_id: int
     ):
@@ -437,10 +473,7 @@ class CondaStore:
 
         utcnow = datetime.datetime.utcnow()
         namespace.deleted_on = utcnow
-        for environment_orm in namespace.environments:
-            environment_orm.deleted_on = utcnow
-            for build in environment_orm.builds:
-                build.deleted_on = utcnow
+        api.soft_delete_environments(db, utcnow, namespace_id=namespace.id)
         db.commit()
 
         self.celery_app
@@ -464,10 +497,9 @@ class CondaStore:
                 f"environment namespace={namespace} name={name} does not exist"
             )
 
-        utcnow = datetime.datetime.utcnow()
-        environment.deleted_on = utcnow
-        for build in environment.builds:
-            build.deleted_on = utcnow
+        api.soft_delete_environments(
+            db, datetime.datetime.utcnow(), environment_id=environment.id
+        )
         db.commit()
 
         self.celery_app
@@ -9,6 +9,7 @@ from sqlalchemy.orm import Session
 from traitlets import (
     Bool,
     Callable,
+    Dict,
     Integer,
     List,
     TraitError,
@@ -98,6 +99,51 @@ class CondaStore(LoggingConfigurable):
         config=True,
     )
 
+    delete_max_workers = Integer(
+        4,
+        help="Number of prefixes removed concurrently when deleting an environment or a namespace",
+        config=True,
+    )
+
+    build_deduplication = Bool(
+        False,
+        help="Share the prefix and conda-pack archive of builds with identical lockfiles and permissions, e.g. the same environment built in different namespaces. Shared data is only removed once the last build using it is deleted",
+        config=True,
+    )
+
+    max_concurrent_builds = Integer(
+        0,
+        help="Maximum number of builds dispatched to workers at the same time. Further builds wait in the scheduler and are dispatched in weighted fair-share order across namespaces, see CondaStore.namespace_build_weights. 0 means unlimited",
+        config=True,
+    )
+
+    namespace_max_concurrent_builds = Integer(
+        0,
+        help="Maximum number of builds of a single namespace dispatched to workers at the same time. 0 means unlimited",
+        config=True,
+    )
+
+    namespace_build_weights = Dict(
+        {},
+        help="Share of the build capacity of namespaces relative to each other, e.g. {'production': 4}. Namespaces which are not listed have a weight of 1",
+        config=True,
+    )
+
+    @validate("namespace_build_weights")
+    def _check_namespace_build_weights(self, proposal):
+        for namespace, weight in proposal.value.items():
+            if not isinstance(weight, (int, float)) or weight <= 0:
+                raise TraitError(
+                    f"c.CondaStore.namespace_build_weights: weight of namespace {namespace} must be a positive number"
+                )
+        return proposal.value
+
+    namespace_build_queues = Dict(
+        {},
+        help="celery queue to which environment builds of a namespace are routed, e.g. {'production': 'builds-high'} to build environments of the production namespace on dedicated workers started with `-Q builds-high`. Builds of other namespaces use the default queue",
+        config=True,
+    )
+
     @validate("build_key_version")
     def _check_build_key_version(self, proposal):
         try:
@@ -127,6 +173,12 @@ class CondaStore(LoggingConfigurable):
             return self.redis_url
         return f"db+{self.database_url}"
 
+    celery_task_routes = Dict(
+        {},
+        help="celery task routes, e.g. {'task_solve_conda_environment': {'queue': 'solve'}, 'task_build_conda_pack': {'queue': 'artifacts'}} to handle solves and conda-pack archives on workers started with `-Q solve` and `-Q artifacts`. See https://docs.celeryq.dev/en/stable/userguide/routing.html",
+        config=True,
+    )
+
     container_registry_class = Type(allow_none=True, help="(deprecated)")
 
     conda_command = Unicode(
@@ -153,6 +205,30 @@ class CondaStore(LoggingConfigurable):
         config=True,
     )
 
+    conda_lock_parallel_platforms = Bool(
+        False,
+        help="Solve each platform of conda_solve_platforms in a separate conda-lock process concurrently and merge the results into one lockfile, instead of solving the platforms one after another",
+        config=True,
+    )
+
+    conda_prefetch_packages = Bool(
+        True,
+        help="While the environment of a build is solved, download the packages it is likely to need into the package cache in the background: those of its lockfile or of the current build of its environment",
+        config=True,
+    )
+
+    conda_prefetch_max_workers = Integer(
+        2,
+        help="Maximum number of packages downloaded concurrently while prefetching",
+        config=True,
+    )
+
+    conda_prefetch_max_bandwidth = Integer(
+        0,
+        help="Maximum bandwidth in bytes per second used by all prefetch downloads of a build, 0 for unlimited",
+        config=True,
+    )
+
     conda_platforms = List(
         [conda_utils.conda_platform(), "noarch"],
         help="Conda platforms to download package repodata.json from. By default includes current architecture and noarch",
@@ -182,6 +258,18 @@ class CondaStore(LoggingConfigurable):
         config=True,
     )
 
+    conda_repodata_cache_directory = Unicode(
+        "{store_directory}/.repodata-cache",
+        help="Template used to form the directory caching the repodata of the indexed channels, which is updated incrementally. Available keys: store_directory. Set to an empty string to download the whole repodata of a channel whenever its channeldata.json changed.",
+        config=True,
+    )
+
+    conda_channel_max_concurrent_downloads = Integer(
+        4,
+        help="Maximum number of files of a channel, e.g. the repodata of its subdirs, downloaded concurrently when indexing it",
+        config=True,
+    )
+
     conda_default_packages = List(
         [],
         help="Conda packages that included by default if none are included",
@@ -206,6 +294,44 @@ class CondaStore(LoggingConfigurable):
         config=True,
     )
 
+    conda_download_max_workers = Integer(
+        4,
+        help="Maximum number of conda packages to download and extract concurrently during a build. Set to 1 to download packages sequentially",
+        config=True,
+    )
+
+    conda_env_export_in_process = Bool(
+        True,
+        help="Generate the YAML artifact of builds from the prefix metadata within the worker instead of running `conda env export` with CondaStore.conda_command. The channels are taken from the lockfile of the build rather than the conda configuration of the worker",
+        config=True,
+    )
+
+    conda_incremental_builds = Bool(
+        False,
+        help="Build new environment versions by cloning unchanged packages from the prefix of the current build via hardlinks and only installing changed packages. Falls back to a clean install whenever the resulting prefix does not match the lockfile",
+        config=True,
+    )
+
+    conda_pack_format = Unicode(
+        "tar.gz",
+        help="Archive format of conda-pack artifacts, either 'tar.gz' or 'tar.zst'. Archives are compressed with CondaStore.conda_pack_threads threads and streamed to the storage backend. zstd compresses and decompresses considerably faster than gzip but requires a tar with zstd support to extract",
+        config=True,
+    )
+
+    @validate("conda_pack_format")
+    def _check_conda_pack_format(self, proposal):
+        if proposal.value not in {"tar.gz", "tar.zst"}:
+            raise TraitError(
+                f"c.CondaStore.conda_pack_format must be 'tar.gz' or 'tar.zst', got {proposal.value}"
+            )
+        return proposal.value
+
+    conda_pack_threads = Integer(
+        4,
+        help="Number of threads used to compress conda-pack archives. Set to -1 to use all cores or 1 to compress in a single thread",
+        config=True,
+    )
+
     database_url = Unicode(
         "sqlite:///" + str(CONDA_STORE_DIR / "conda-store.sqlite"),
         help="url for the database. e.g. 'sqlite:///conda-store.sqlite' tables will be automatically created if they do not exist",
@@ -255,6 +381,18 @@ class CondaStore(LoggingConfigurable):
         config=True,
     )
 
+    solve_cache_enabled = Bool(
+        True,
+        help="Reuse the lockfile of a previous solve when the same specification is solved for the same platforms against channels that have not been updated since",
+        config=True,
+    )
+
+    solve_cache_ttl = Integer(
+        24 * 60 * 60,  # 1 day
+        help="Time in seconds after which cached solves are discarded. Channels which are not indexed by conda-store can only be invalidated by this ttl",
+        config=True,
+    )
+
     post_update_environment_build_hook = Callable(
         default_value=None,
         help="callable function taking conda_store and `orm.Environment` object as input arguments. This function can be used to add custom behavior that will run after an environment's current build changes.",
@@ -320,6 +458,42 @@ class CondaStore(LoggingConfigurable):
         config=True,
     )
 
+    build_pkgs_dir_max_size = Integer(
+        0,
+        help="Maximum size in bytes of the conda package cache of a worker for it to start builds. 0 disables the check",
+        config=True,
+    )
+
+    pkgs_cache_max_size = Integer(
+        0,
+        help="Size in bytes the conda package cache of a worker is reduced to by evicting the least recently used packages, see task_evict_pkgs_cache. Packages hardlinked into environments are never evicted. 0 disables eviction",
+        config=True,
+    )
+
+    build_min_available_memory = Integer(
+        0,
+        help="Minimum memory in bytes available on a worker for it to start builds. 0 disables the check",
+        config=True,
+    )
+
+    build_admission_retry_delay = Integer(
+        60,
+        help="Seconds after which a build deferred due to insufficient worker resources is retried",
+        config=True,
+    )
+
+    build_lease_timeout = Integer(
+        60,
+        help="Seconds after which a build is considered stuck when its worker stops renewing its lease, e.g. because the worker died",
+        config=True,
+    )
+
+    build_admission_max_deferrals = Integer(
+        60,
+        help="Number of times a build is deferred due to insufficient worker resources before it fails",
+        config=True,
+    )
+
     serialize_builds = Bool(
         True,
         help="DEPRICATED no longer has any effect",
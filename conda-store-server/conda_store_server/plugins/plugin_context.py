@@ -7,6 +7,8 @@ import logging
 import subprocess
 import uuid
 
+from conda_store_server._internal import utils
+
 
 class PluginContext:
     """The plugin context provides some useful attributes to a hook.
@@ -59,6 +61,7 @@ class PluginContext:
             if not redirect_stderr:
                 for line in proc.stderr:
                     self.stderr.write(line)
+            utils.wait_process(proc)
 
         if proc.returncode != 0:
             raise subprocess.CalledProcessError(proc.returncode, proc.args)
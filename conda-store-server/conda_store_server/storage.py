@@ -2,29 +2,38 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import concurrent.futures
+import contextlib
 import io
 import os
 import posixpath
 import shutil
+import tempfile
+import time
+import typing
+import uuid
 
 import minio
 from minio.credentials.providers import Provider
-from traitlets import Bool, Dict, List, Type, Unicode
+from minio.deleteobjects import DeleteObject
+from minio.error import S3Error
+from traitlets import Bool, Dict, Integer, List, Type, Unicode
 from traitlets.config import LoggingConfigurable
 
 from conda_store_server import CONDA_STORE_DIR, api
 from conda_store_server._internal import orm, schema
+from conda_store_server.exception import CondaStoreError
 
 
 class Storage(LoggingConfigurable):
-    def fset(
+    def register_build_artifact(
         self,
         db,
         build_id: int,
         key: str,
-        filename: str,
         artifact_type: schema.BuildArtifactType,
     ):
+        """Ensure a BuildArtifact row exists for the given build and key"""
         ba = orm.BuildArtifact
         exists = (
             db.query(ba)
@@ -37,6 +46,36 @@ class Storage(LoggingConfigurable):
             db.add(ba(build_id=build_id, key=key, artifact_type=artifact_type))
             db.commit()
 
+    def register_build_artifacts(
+        self,
+        db,
+        build_id: int,
+        artifacts: typing.List[typing.Tuple[str, schema.BuildArtifactType]],
+    ):
+        """Ensure BuildArtifact rows exist for the given build and (key,
+        artifact_type) pairs, with a single query
+        """
+        ba = orm.BuildArtifact
+        existing = set(
+            db.query(ba.key, ba.artifact_type)
+            .filter(ba.build_id == build_id)
+            .filter(ba.key.in_([key for key, _ in artifacts]))
+        )
+        for key, artifact_type in dict.fromkeys(artifacts):
+            if (key, artifact_type) not in existing:
+                db.add(ba(build_id=build_id, key=key, artifact_type=artifact_type))
+        db.commit()
+
+    def fset(
+        self,
+        db,
+        build_id: int,
+        key: str,
+        filename: str,
+        artifact_type: schema.BuildArtifactType,
+    ):
+        self.register_build_artifact(db, build_id, key, artifact_type)
+
     def set(
         self,
         db,
@@ -45,17 +84,69 @@ class Storage(LoggingConfigurable):
         value: bytes,
         artifact_type: schema.BuildArtifactType,
     ):
-        ba = orm.BuildArtifact
-        exists = (
-            db.query(ba)
-            .filter(ba.build_id == build_id)
-            .filter(ba.key == key)
-            .filter(ba.artifact_type == artifact_type)
-            .first()
+        self.register_build_artifact(db, build_id, key, artifact_type)
+
+    def set_many(self, db, build_id: int, items: typing.List[typing.Dict]):
+        """Store several blobs of a build
+
+        Each item is a dict of the key, value, content_type and
+        artifact_type arguments of set. The BuildArtifacts are registered
+        once all blobs are stored.
+        """
+        self.register_build_artifacts(
+            db, build_id, [(item["key"], item["artifact_type"]) for item in items]
         )
-        if not exists:
-            db.add(ba(build_id=build_id, key=key, artifact_type=artifact_type))
-            db.commit()
+
+    @contextlib.contextmanager
+    def open_writer(
+        self,
+        db,
+        build_id: int,
+        key: str,
+        content_type: str = None,
+        artifact_type: schema.BuildArtifactType = None,
+    ):
+        """Yields a binary file object whose contents are stored at key
+
+        The blob is stored and the BuildArtifact registered once the
+        context exits without an exception. This default implementation
+        buffers the contents in a temporary file which is passed to fset,
+        backends override it to write the contents while they are produced.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, posixpath.basename(key))
+            with open(filename, "wb") as f:
+                yield f
+            self.fset(
+                db,
+                build_id,
+                key,
+                filename,
+                content_type=content_type,
+                artifact_type=artifact_type,
+            )
+
+    def append(self, key: str, value: bytes, content_type: str = None):
+        """Append value to the blob stored at key, creating it if missing
+
+        Unlike set, this does not register a BuildArtifact. Callers are
+        expected to call finish_append and register_build_artifact once the
+        blob is complete.
+        """
+        raise NotImplementedError()
+
+    def finish_append(self, key: str, content_type: str = None):
+        """Store the values appended to key as a single blob
+
+        Backends which can not append to a blob in place store the appended
+        values separately until this is called.
+        """
+
+    def is_appending(self, key: str) -> bool:
+        """Whether values appended to key are not stored in its blob yet, in
+        which case get returns them but get_url does not
+        """
+        return False
 
     def get(self, key: str):
         raise NotImplementedError()
@@ -63,11 +154,34 @@ class Storage(LoggingConfigurable):
     def get_url(self, key: str):
         raise NotImplementedError()
 
+    def exists_many(self, keys: typing.List[str]) -> typing.Dict[str, bool]:
+        """Whether a blob is stored at each of keys"""
+        raise NotImplementedError()
+
     def delete(self, db, build_id: int, key: str):
         build_artifact = api.get_build_artifact(db, build_id, key)
         db.delete(build_artifact)
         db.commit()
 
+    def delete_many(self, db, keys: typing.List[str]):
+        """Delete the blobs stored at keys and all the BuildArtifact rows
+        referencing them
+
+        Callers are expected to pass at most a few thousand keys per call.
+        """
+        db.query(orm.BuildArtifact).filter(orm.BuildArtifact.key.in_(keys)).delete(
+            synchronize_session=False
+        )
+        db.commit()
+
+
+# Prefix of the keys values are appended to, see S3Storage.append
+APPENDED_KEY_PREFIX = "logs/"
+
+# Metadata of an object holding the name of the last part joined into it by
+# S3Storage.finish_append
+LAST_PART_HEADER = "x-amz-meta-last-part"
+
 
 class S3Storage(Storage):
     internal_endpoint = Unicode(
@@ -116,6 +230,18 @@ class S3Storage(Storage):
         config=True,
     )
 
+    upload_part_size = Integer(
+        64 * 1024**2,  # 64 MB
+        help="part size in bytes of multipart uploads of artifacts which are streamed to the s3 bucket, e.g. conda-pack archives. Each upload buffers one part in memory. Must be at least 5 MB",
+        config=True,
+    )
+
+    max_concurrent_requests = Integer(
+        8,
+        help="maximum number of concurrent requests to the s3 bucket made by batch operations, e.g. Storage.set_many and Storage.exists_many",
+        config=True,
+    )
+
     credentials = Type(
         klass=Provider,
         default_value=None,
@@ -200,17 +326,220 @@ class S3Storage(Storage):
         )
         super().fset(db, build_id, key, value, artifact_type)
 
-    def get(self, key):
+    def _map_concurrently(self, function, keys):
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_concurrent_requests
+        ) as executor:
+            return list(executor.map(function, keys))
+
+    def set_many(self, db, build_id, items):
+        def put_object(item):
+            self.internal_client.put_object(
+                self.bucket_name,
+                item["key"],
+                io.BytesIO(item["value"]),
+                length=len(item["value"]),
+                content_type=item.get("content_type"),
+            )
+
+        self._map_concurrently(put_object, items)
+        super().set_many(db, build_id, items)
+
+    @contextlib.contextmanager
+    def open_writer(self, db, build_id, key, content_type=None, artifact_type=None):
+        # The contents are uploaded from the read end of a pipe via a
+        # multipart upload of unknown length while the caller writes to it
+        read_fd, write_fd = os.pipe()
+        reader = os.fdopen(read_fd, "rb")
+        writer = os.fdopen(write_fd, "wb")
+
+        def upload():
+            try:
+                self.internal_client.put_object(
+                    self.bucket_name,
+                    key,
+                    reader,
+                    length=-1,
+                    part_size=self.upload_part_size,
+                    content_type=content_type or "application/octet-stream",
+                )
+            finally:
+                # Unblocks the writer if the upload fails
+                reader.close()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(upload)
+            try:
+                with writer:
+                    yield writer
+            except BaseException as e:
+                upload_error = future.exception()
+                if upload_error is None:
+                    # Closing the pipe completed the upload, remove the
+                    # truncated object
+                    self.internal_client.remove_object(self.bucket_name, key)
+                elif isinstance(e, BrokenPipeError):
+                    raise upload_error from e
+                raise
+            future.result()
+
+        self.register_build_artifact(db, build_id, key, artifact_type)
+
+    def _parts_prefix(self, key):
+        return f"{key}.parts/"
+
+    def _has_parts(self, key):
+        # Only build logs are appended to, other keys are plain objects
+        return key.startswith(APPENDED_KEY_PREFIX)
+
+    def _list_parts(self, key) -> typing.List[str]:
+        return sorted(
+            o.object_name
+            for o in self.internal_client.list_objects(
+                self.bucket_name, prefix=self._parts_prefix(key), recursive=True
+            )
+        )
+
+    def append(self, key, value, content_type=None):
+        # S3 objects are immutable, so each value is stored as a part object,
+        # named after the time it was appended, and the parts are only
+        # concatenated by finish_append
+        part = f"{self._parts_prefix(key)}{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        self.internal_client.put_object(
+            self.bucket_name,
+            part,
+            io.BytesIO(value),
+            length=len(value),
+            content_type=content_type,
+        )
+
+    def _get_appended(self, key) -> typing.Tuple[bytes, str]:
+        """Contents of key and the name of the last part they include"""
+        try:
+            response = self.internal_client.get_object(self.bucket_name, key)
+        except S3Error as e:
+            if e.code != "NoSuchKey":
+                raise
+            return b"", ""
+        try:
+            return response.read(), response.headers.get(LAST_PART_HEADER, "")
+        finally:
+            response.close()
+            response.release_conn()
+
+    def finish_append(self, key, content_type=None):
+        parts = self._list_parts(key)
+        if not parts:
+            return
+
+        value, last_part = self._get_appended(key)
+        pending = [part for part in parts if part > last_part]
+        if pending:
+            # The object records the last part it includes, so that
+            # concurrent readers skip the parts until they are removed
+            value += b"".join(self._map_concurrently(self._get, pending))
+            self.internal_client.put_object(
+                self.bucket_name,
+                key,
+                io.BytesIO(value),
+                length=len(value),
+                content_type=content_type,
+                metadata={LAST_PART_HEADER: pending[-1]},
+            )
+        self._remove_objects(parts)
+
+    def is_appending(self, key):
+        return bool(self._list_parts(key))
+
+    def _get(self, key):
         response = self.internal_client.get_object(self.bucket_name, key)
-        return response.read()
+        try:
+            return response.read()
+        finally:
+            response.close()
+            response.release_conn()
+
+    def get(self, key):
+        if not self._has_parts(key):
+            return self._get(key)
+
+        while True:
+            # The parts are listed before reading the object, parts joined
+            # into it meanwhile are skipped via the last part it includes
+            parts = self._list_parts(key)
+            if not parts:
+                return self._get(key)
+
+            value, last_part = self._get_appended(key)
+            pending = [part for part in parts if part > last_part]
+            try:
+                return value + b"".join(self._map_concurrently(self._get, pending))
+            except S3Error as e:
+                # The parts were joined and removed after reading the object
+                if e.code != "NoSuchKey":
+                    raise
 
     def get_url(self, key):
         return self.external_client.presigned_get_object(self.bucket_name, key)
 
+    def exists_many(self, keys):
+        def exists(key):
+            try:
+                self.internal_client.stat_object(self.bucket_name, key)
+            except S3Error as e:
+                if e.code != "NoSuchKey":
+                    raise
+                return False
+            return True
+
+        return dict(zip(keys, self._map_concurrently(exists, keys), strict=True))
+
+    def _remove_objects(self, names) -> typing.Set[str]:
+        """Removes objects with multi-object delete requests of up to 1000
+        objects, returns the names of the objects which were not removed
+        """
+        failed = set()
+        for start in range(0, len(names), 1000):
+            errors = self.internal_client.remove_objects(
+                self.bucket_name,
+                [DeleteObject(name) for name in names[start : start + 1000]],
+            )
+            # The errors are returned lazily, iterating them sends the requests
+            for error in errors:
+                self.log.error(f"failed to delete {error.name}: {error.message}")
+                failed.add(error.name)
+        return failed
+
+    def _with_parts(self, keys) -> typing.Dict[str, str]:
+        """Objects of keys, including their parts, mapped to their key"""
+        objects = {key: key for key in keys}
+        appended_keys = [key for key in keys if self._has_parts(key)]
+        for key, parts in zip(
+            appended_keys,
+            self._map_concurrently(self._list_parts, appended_keys),
+            strict=True,
+        ):
+            objects.update((part, key) for part in parts)
+        return objects
+
     def delete(self, db, build_id, key):
         self.internal_client.remove_object(self.bucket_name, key)
+        # Parts left behind by a log which was not finished, e.g. because
+        # its build crashed
+        if self._has_parts(key):
+            self._remove_objects(self._list_parts(key))
         super().delete(db, build_id, key)
 
+    def delete_many(self, db, keys):
+        objects = self._with_parts(keys)
+        failed = {objects[name] for name in self._remove_objects(list(objects))}
+
+        super().delete_many(db, [key for key in keys if key not in failed])
+        if failed:
+            raise CondaStoreError(
+                f"failed to delete {len(failed)} objects from S3 bucket={self.bucket_name}"
+            )
+
 
 class LocalStorage(Storage):
     storage_path = Unicode(
@@ -239,6 +568,40 @@ class LocalStorage(Storage):
             f.write(value)
         super().set(db, build_id, key, value, artifact_type)
 
+    def set_many(self, db, build_id, items):
+        for item in items:
+            destination_filename = os.path.join(self.storage_path, item["key"])
+            os.makedirs(os.path.dirname(destination_filename), exist_ok=True)
+
+            with open(destination_filename, "wb") as f:
+                f.write(item["value"])
+        super().set_many(db, build_id, items)
+
+    @contextlib.contextmanager
+    def open_writer(self, db, build_id, key, content_type=None, artifact_type=None):
+        destination_filename = os.path.abspath(os.path.join(self.storage_path, key))
+        os.makedirs(os.path.dirname(destination_filename), exist_ok=True)
+
+        # Readers never see a partially written blob
+        partial_filename = f"{destination_filename}.partial"
+        try:
+            with open(partial_filename, "wb") as f:
+                yield f
+            os.replace(partial_filename, destination_filename)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(partial_filename)
+            raise
+
+        self.register_build_artifact(db, build_id, key, artifact_type)
+
+    def append(self, key, value, content_type=None):
+        destination_filename = os.path.join(self.storage_path, key)
+        os.makedirs(os.path.dirname(destination_filename), exist_ok=True)
+
+        with open(destination_filename, "ab") as f:
+            f.write(value)
+
     def get(self, key):
         with open(os.path.join(self.storage_path, key), "rb") as f:
             return f.read()
@@ -246,6 +609,11 @@ class LocalStorage(Storage):
     def get_url(self, key):
         return posixpath.join(self.storage_url, key)
 
+    def exists_many(self, keys):
+        return {
+            key: os.path.isfile(os.path.join(self.storage_path, key)) for key in keys
+        }
+
     def delete(self, db, build_id, key):
         filename = os.path.join(self.storage_path, key)
         try:
@@ -257,3 +625,9 @@ class LocalStorage(Storage):
             # for saving build artifacts
             pass
         super().delete(db, build_id, key)
+
+    def delete_many(self, db, keys):
+        for key in keys:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.storage_path, key))
+        super().delete_many(db, keys)
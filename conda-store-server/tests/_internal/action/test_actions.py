@@ -4,14 +4,24 @@
 
 import asyncio
 import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
 import pathlib
 import re
+import shutil
+import subprocess
 import sys
+import tarfile
 import tempfile
+from types import SimpleNamespace
 from unittest import mock
 
 import pytest
 import yarl
+import zstandard
 from celery.result import AsyncResult
 from conda.base.context import context as conda_base_context
 from constructor import construct
@@ -21,6 +31,8 @@ from traitlets import TraitError
 from conda_store_server import BuildKey, api
 from conda_store_server._internal import action, conda_utils, orm, schema, server
 from conda_store_server._internal.action import (
+    add_conda_prefix_packages,
+    download_packages,
     generate_constructor_installer,
 )
 from conda_store_server.server.auth import DummyAuthentication
@@ -157,6 +169,83 @@ def test_fetch_and_extract_conda_packages(tmp_path, simple_conda_lock):
     assert context.stdout.getvalue()
 
 
+def test_fetch_and_extract_conda_package_hashes(tmp_path, conda_channel_server):
+    index = {"name": "a", "version": "1.0", "build": "0", "build_number": 0}
+    content = json.dumps(index).encode("utf-8")
+    tarball = conda_channel_server.directory / "a-1.0-0.tar.bz2"
+    with tarfile.open(tarball, "w:bz2") as tar:
+        info = tarfile.TarInfo("info/index.json")
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+
+    package = {
+        "url": f"{conda_channel_server.url}/a-1.0-0.tar.bz2",
+        "hash": {
+            "md5": hashlib.md5(tarball.read_bytes()).hexdigest(),
+            "sha256": hashlib.sha256(tarball.read_bytes()).hexdigest(),
+        },
+    }
+    pkgs_dir = tmp_path / "pkgs"
+    context = action.base.ActionContext()
+    download_packages.fetch_and_extract_conda_package(context, package, pkgs_dir, "1/1")
+
+    # Both hashes of the lockfile are kept in the package cache
+    with (pkgs_dir / "a-1.0-0" / "info" / "repodata_record.json").open() as f:
+        record = json.load(f)
+    assert record["md5"] == package["hash"]["md5"]
+    assert record["sha256"] == package["hash"]["sha256"]
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_fetch_and_extract_conda_packages_concurrency(
+    tmp_path, simple_conda_lock_with_pip, max_workers
+):
+    fetched = []
+
+    def fetch_and_extract(context, package, pkgs_dir, count_message):
+        fetched.append(package["name"])
+        # Every other package is already in the cache
+        return len(fetched) % 2 == 0
+
+    with mock.patch.object(
+        download_packages,
+        "fetch_and_extract_conda_package",
+        side_effect=fetch_and_extract,
+    ):
+        context = action.action_fetch_and_extract_conda_packages(
+            conda_lock_spec=simple_conda_lock_with_pip,
+            pkgs_dir=tmp_path,
+            max_workers=max_workers,
+        )
+
+    expected = [
+        package["name"]
+        for package in simple_conda_lock_with_pip["package"]
+        if package["manager"] == "conda"
+        and package["platform"] in [conda_utils.conda_platform(), "noarch"]
+    ]
+    assert expected
+    assert sorted(fetched) == sorted(expected)
+    assert context.result == {
+        "hits": len(expected) // 2,
+        "misses": len(expected) - len(expected) // 2,
+    }
+
+
+def test_fetch_and_extract_conda_packages_error(tmp_path, simple_conda_lock):
+    with mock.patch.object(
+        download_packages,
+        "fetch_and_extract_conda_package",
+        side_effect=RuntimeError("download failed"),
+    ):
+        with pytest.raises(RuntimeError, match="download failed"):
+            action.action_fetch_and_extract_conda_packages(
+                conda_lock_spec=simple_conda_lock,
+                pkgs_dir=tmp_path,
+                max_workers=4,
+            )
+
+
 @pytest.mark.long_running_test
 def test_install_specification(tmp_path, conda_store, simple_specification):
     conda_prefix = tmp_path / "test"
@@ -180,6 +269,177 @@ def test_install_lockfile(tmp_path, conda_store, simple_conda_lock):
     assert conda_utils.is_conda_prefix(conda_prefix)
 
 
+def _fake_prefix_package(prefix, name, paths, version="1.0", noarch=None):
+    """Writes a minimal conda-meta record and the files of a package"""
+    platform = "noarch" if noarch else conda_utils.conda_platform()
+    fn = f"{name}-{version}-0.conda"
+    for path, content, placeholder in paths:
+        (prefix / path).parent.mkdir(parents=True, exist_ok=True)
+        (prefix / path).write_text(content)
+
+    record = {
+        "name": name,
+        "version": version,
+        "build": "0",
+        "build_number": 0,
+        "noarch": noarch,
+        "channel": f"https://conda.anaconda.org/conda-forge/{platform}",
+        "subdir": platform,
+        "fn": fn,
+        "url": f"https://conda.anaconda.org/conda-forge/{platform}/{fn}",
+        "depends": [],
+        "link": None,
+        "files": [path for path, _, _ in paths],
+        "paths_data": {
+            "paths_version": 1,
+            "paths": [
+                {
+                    "_path": path,
+                    "path_type": "hardlink",
+                    "file_mode": "text",
+                    **(
+                        {"prefix_placeholder": "/opt/placeholder"}
+                        if placeholder
+                        else {}
+                    ),
+                }
+                for path, _, placeholder in paths
+            ],
+        },
+    }
+    (prefix / "conda-meta" / f"{name}-{version}-0.json").write_text(json.dumps(record))
+    return {
+        "name": name,
+        "version": version,
+        "manager": "conda",
+        "platform": conda_utils.conda_platform(),
+        "url": record["url"],
+        "hash": {},
+    }
+
+
+def test_install_lockfile_incremental(tmp_path):
+    source_prefix = tmp_path / "source"
+    (source_prefix / "conda-meta").mkdir(parents=True)
+    (source_prefix / "conda-meta" / "history").touch()
+
+    kept = _fake_prefix_package(
+        source_prefix,
+        "kept",
+        [
+            ("lib/kept.txt", "kept", False),
+            ("etc/kept.conf", f"prefix={source_prefix}\n", True),
+        ],
+    )
+    _fake_prefix_package(source_prefix, "removed", [("lib/removed.txt", "", False)])
+    linked = _fake_prefix_package(
+        source_prefix,
+        "linked",
+        [("lib/absolute.so", "", False), ("lib/relative.so", "", False)],
+    )
+    for name, target in [
+        ("absolute.so", source_prefix / "lib/kept.txt"),
+        ("relative.so", "kept.txt"),
+    ]:
+        (source_prefix / "lib" / name).unlink()
+        (source_prefix / "lib" / name).symlink_to(target)
+
+    conda_prefix = tmp_path / "incremental"
+    context = action.action_install_lockfile_incremental(
+        conda_lock_spec={"package": [kept, linked]},
+        conda_prefix=conda_prefix,
+        source_prefix=source_prefix,
+    )
+
+    assert context.result is True
+    assert conda_utils.is_conda_prefix(conda_prefix)
+    assert (conda_prefix / "lib/kept.txt").samefile(source_prefix / "lib/kept.txt")
+    assert (conda_prefix / "etc/kept.conf").read_text() == f"prefix={conda_prefix}\n"
+    assert not (conda_prefix / "lib/removed.txt").exists()
+    assert not (conda_prefix / "conda-meta/removed-1.0-0.json").exists()
+    # Symlinks into the source prefix point into the new prefix
+    assert os.readlink(conda_prefix / "lib/absolute.so") == str(
+        conda_prefix / "lib/kept.txt"
+    )
+    assert os.readlink(conda_prefix / "lib/relative.so") == "kept.txt"
+
+
+def test_install_lockfile_incremental_fallback(tmp_path):
+    source_prefix = tmp_path / "source"
+    (source_prefix / "conda-meta").mkdir(parents=True)
+    (source_prefix / "conda-meta" / "history").touch()
+
+    kept = _fake_prefix_package(source_prefix, "kept", [("lib/kept.txt", "", False)])
+    added = dict(kept, name="added", url=kept["url"].replace("kept", "added"))
+
+    conda_prefix = tmp_path / "incremental"
+    with mock.patch.object(
+        action.base.ActionContext,
+        "run_command",
+        side_effect=subprocess.CalledProcessError(1, "conda"),
+    ):
+        context = action.action_install_lockfile_incremental(
+            conda_lock_spec={"package": [kept, added]},
+            conda_prefix=conda_prefix,
+            source_prefix=source_prefix,
+        )
+
+    assert context.result is False
+    assert not conda_prefix.exists()
+
+    # Lockfiles containing pip packages are always installed from scratch
+    context = action.action_install_lockfile_incremental(
+        conda_lock_spec={"package": [kept, dict(kept, manager="pip")]},
+        conda_prefix=conda_prefix,
+        source_prefix=source_prefix,
+    )
+    assert context.result is False
+    assert not conda_prefix.exists()
+
+
+@pytest.mark.parametrize("python_version", ["3.11.8", "3.12.1"])
+def test_install_lockfile_incremental_noarch_python(tmp_path, python_version):
+    source_prefix = tmp_path / "source"
+    (source_prefix / "conda-meta").mkdir(parents=True)
+    (source_prefix / "conda-meta" / "history").touch()
+
+    python = _fake_prefix_package(
+        source_prefix, "python", [("bin/python", "", False)], version="3.11.5"
+    )
+    requests = _fake_prefix_package(
+        source_prefix,
+        "requests",
+        [("lib/python3.11/site-packages/requests/__init__.py", "", False)],
+        noarch="python",
+    )
+    if python_version != python["version"]:
+        python = dict(
+            python,
+            version=python_version,
+            url=python["url"].replace(python["version"], python_version),
+        )
+
+    explicit = []
+
+    def run_command(command, **kwargs):
+        explicit.extend(pathlib.Path(command[-1]).read_text().splitlines())
+        raise subprocess.CalledProcessError(1, "conda")
+
+    with mock.patch.object(
+        action.base.ActionContext, "run_command", side_effect=run_command
+    ):
+        action.action_install_lockfile_incremental(
+            conda_lock_spec={"package": [python, requests]},
+            conda_prefix=tmp_path / "incremental",
+            source_prefix=source_prefix,
+        )
+
+    # noarch: python packages are installed for the python version of the
+    # prefix, they are linked again by conda when it changes
+    assert python["url"] in explicit
+    assert (requests["url"] in explicit) == (python_version.startswith("3.12"))
+
+
 @pytest.mark.long_running_test
 def test_generate_conda_export(conda_store, conda_prefix):
     context = action.action_generate_conda_export(
@@ -193,15 +453,104 @@ def test_generate_conda_export(conda_store, conda_prefix):
 
 
 @pytest.mark.long_running_test
-def test_generate_conda_pack(tmp_path, conda_prefix):
-    output_filename = tmp_path / "environment.tar.gz"
+def test_generate_conda_prefix_export(conda_store, conda_prefix):
+    expected = action.action_generate_conda_export(
+        conda_command=conda_store.config.conda_command, conda_prefix=conda_prefix
+    ).result
+
+    result = action.action_generate_conda_prefix_export(
+        conda_prefix=conda_prefix
+    ).result
+
+    # conda env export adds the channels configured for conda
+    assert expected["channels"][: len(result["channels"])] == result["channels"]
+    assert {**expected, "channels": result["channels"]} == result
+
+
+@pytest.mark.skipif(shutil.which("conda") is None, reason="requires conda")
+def test_generate_conda_prefix_export_parity(tmp_path):
+    conda_prefix = tmp_path / "test"
+    (conda_prefix / "conda-meta").mkdir(parents=True)
+    (conda_prefix / "conda-meta" / "history").touch()
+    _fake_prefix_package(conda_prefix, "zlib", [("lib/libz.so", "zlib", False)])
+    _fake_prefix_package(conda_prefix, "bzip2", [("lib/libbz2.so", "bz2", False)])
+
+    expected = action.action_generate_conda_export(
+        conda_command="conda", conda_prefix=conda_prefix
+    ).result
+
+    result = action.action_generate_conda_prefix_export(
+        conda_prefix=conda_prefix
+    ).result
+    assert result["dependencies"] == ["bzip2=1.0=0", "zlib=1.0=0"]
+    assert expected["channels"][: len(result["channels"])] == result["channels"]
+    assert {**expected, "channels": result["channels"]} == result
+
+    # Channels of the lockfile replace the channels configured for conda
+    result = action.action_generate_conda_prefix_export(
+        conda_prefix=conda_prefix,
+        channels=["https://conda.anaconda.org/conda-forge", "defaults"],
+    ).result
+    assert result["channels"] == ["conda-forge", "defaults"]
+
+
+@pytest.mark.long_running_test
+@pytest.mark.parametrize("format", ["tar.gz", "tar.zst"])
+def test_generate_conda_pack(tmp_path, conda_prefix, format):
+    output_filename = tmp_path / f"environment.{format}"
+
+    with output_filename.open("wb") as output:
+        action.action_generate_conda_pack(
+            conda_prefix=conda_prefix,
+            output=output,
+            format=format,
+            n_threads=2,
+        )
 
+    assert output_filename.stat().st_size > 0
+
+
+@pytest.mark.parametrize(
+    "format, decompress",
+    [
+        ("tar.gz", gzip.decompress),
+        (
+            "tar.zst",
+            lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data),
+        ),
+    ],
+)
+@pytest.mark.parametrize("n_threads", [1, 2])
+def test_generate_conda_pack_stream(tmp_path, format, decompress, n_threads):
+    conda_prefix = tmp_path / "test"
+    (conda_prefix / "conda-meta").mkdir(parents=True)
+    (conda_prefix / "conda-meta" / "history").touch()
+    _fake_prefix_package(
+        conda_prefix,
+        "zlib",
+        [("lib/libz.so", "zlib", False), ("bin/zlib-config", "/opt/placeholder", True)],
+    )
+
+    # Only write is required of the output, e.g. a pipe to a storage backend
+    output = io.BytesIO()
     action.action_generate_conda_pack(
         conda_prefix=conda_prefix,
-        output_filename=output_filename,
+        output=mock.Mock(write=output.write),
+        format=format,
+        n_threads=n_threads,
     )
 
-    assert output_filename.exists()
+    with tarfile.open(fileobj=io.BytesIO(decompress(output.getvalue()))) as tar:
+        names = tar.getnames()
+        assert {"lib/libz.so", "bin/zlib-config", "bin/conda-unpack"} <= set(names)
+        assert tar.extractfile("lib/libz.so").read() == b"zlib"
+
+
+def test_generate_conda_pack_unsupported_format(tmp_path):
+    with pytest.raises(ValueError, match="unsupported conda-pack format"):
+        action.action_generate_conda_pack(
+            conda_prefix=tmp_path, output=io.BytesIO(), format="zip"
+        )
 
 
 def test_remove_not_conda_prefix(tmp_path):
@@ -247,6 +596,25 @@ def test_set_conda_prefix_permissions(tmp_path, conda_store, simple_conda_lock):
     assert "no changes for gid and uid of conda_prefix" in context.stdout.getvalue()
 
 
+@pytest.mark.skipif(
+    sys.platform == "win32", reason="permissions are not supported on Windows"
+)
+def test_set_conda_prefix_permissions_changed(tmp_path):
+    conda_prefix = tmp_path / "test"
+    (conda_prefix / "conda-meta").mkdir(parents=True)
+    (conda_prefix / "conda-meta" / "history").touch()
+    conda_prefix.chmod(0o700)
+
+    context = action.action_set_conda_prefix_permissions(
+        conda_prefix=conda_prefix,
+        permissions="750",
+        uid=None,
+        gid=None,
+    )
+    assert "modified permissions or owner of 3 entries" in context.stdout.getvalue()
+    assert (conda_prefix / "conda-meta" / "history").stat().st_mode & 0o777 == 0o750
+
+
 def test_get_conda_prefix_stats(tmp_path, conda_store, simple_conda_lock):
     conda_prefix = tmp_path / "test"
 
@@ -258,6 +626,21 @@ def test_get_conda_prefix_stats(tmp_path, conda_store, simple_conda_lock):
     assert context.result["disk_usage"] > 0
 
 
+def test_get_conda_prefix_stats_package_sizes(tmp_path):
+    conda_prefix = tmp_path / "test"
+    (conda_prefix / "conda-meta").mkdir(parents=True)
+    (conda_prefix / "conda-meta" / "history").touch()
+    (conda_prefix / "lib").mkdir()
+    (conda_prefix / "lib" / "libz.so").write_bytes(b"z" * 100)
+    (conda_prefix / "conda-meta" / "zlib-1.0-0.json").write_text(
+        json.dumps({"name": "zlib", "files": ["lib/libz.so", "lib/missing"]})
+    )
+
+    context = action.action_get_conda_prefix_stats(conda_prefix)
+    assert context.result["package_sizes"] == {"zlib": 100}
+    assert context.result["disk_usage"] == context.result["disk_usage_unique"]
+
+
 @pytest.mark.long_running_test
 def test_add_conda_prefix_packages(db, conda_store, simple_specification, conda_prefix):
     build_id = conda_store.register_environment(
@@ -274,6 +657,76 @@ def test_add_conda_prefix_packages(db, conda_store, simple_specification, conda_
     assert len(build.package_builds) > 0
 
 
+def test_add_lockfile_packages_bulk(db, seed_conda_store, simple_conda_lock):
+    solve = api.get_solve(db, solve_id=1)
+    assert len(solve.package_builds) == 0
+
+    for _ in range(2):
+        action.action_add_lockfile_packages(
+            db=db,
+            conda_lock_spec=simple_conda_lock,
+            solve_id=solve.id,
+        )
+        db.refresh(solve)
+        assert sorted(_.package.name for _ in solve.package_builds) == sorted(
+            package["name"]
+            for package in simple_conda_lock["package"]
+            if package["platform"] == conda_utils.conda_platform()
+        )
+
+
+def test_package_tarball_hashes(tmp_path):
+    tarball = tmp_path / "package-1.0-0.tar.bz2"
+    tarball.write_bytes(b"package contents")
+    expected = {
+        "md5": hashlib.md5(b"package contents").hexdigest(),
+        "sha256": hashlib.sha256(b"package contents").hexdigest(),
+    }
+
+    # Hashes recorded by conda are used without reading the tarball
+    record = SimpleNamespace(
+        md5="recorded-md5",
+        sha256="recorded-sha256",
+        package_tarball_full_path=str(tmp_path / "missing.tar.bz2"),
+    )
+    assert add_conda_prefix_packages.package_tarball_hashes(record) == {
+        "md5": "recorded-md5",
+        "sha256": "recorded-sha256",
+    }
+
+    # Otherwise the tarball is hashed once and cached
+    record = SimpleNamespace(
+        md5="recorded-md5", sha256=None, package_tarball_full_path=str(tarball)
+    )
+    with mock.patch.object(
+        add_conda_prefix_packages.utils,
+        "file_hashes",
+        wraps=add_conda_prefix_packages.utils.file_hashes,
+    ) as mock_file_hashes:
+        assert add_conda_prefix_packages.package_tarball_hashes(record) == expected
+        # Touching the tarball, e.g. to record its use, keeps the cached hashes
+        os.utime(tarball)
+        assert add_conda_prefix_packages.package_tarball_hashes(record) == expected
+    assert mock_file_hashes.call_count == 1
+
+    # Then the hashes of info/repodata_record.json in the package cache
+    extracted_dir = tmp_path / "package-1.0-0"
+    (extracted_dir / "info").mkdir(parents=True)
+    (extracted_dir / "info" / "repodata_record.json").write_text(
+        json.dumps({"md5": "cached-md5", "sha256": "cached-sha256"})
+    )
+    record = SimpleNamespace(
+        md5="recorded-md5",
+        sha256=None,
+        package_tarball_full_path=str(tmp_path / "missing.tar.bz2"),
+        extracted_package_dir=str(extracted_dir),
+    )
+    assert add_conda_prefix_packages.package_tarball_hashes(record) == {
+        "md5": "recorded-md5",
+        "sha256": "cached-sha256",
+    }
+
+
 @pytest.mark.long_running_test
 def test_add_lockfile_packages(
     db,
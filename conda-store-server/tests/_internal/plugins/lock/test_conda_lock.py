@@ -2,6 +2,8 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import subprocess
+import sys
 from unittest import mock
 
 import pytest
@@ -109,3 +111,84 @@ def test_solve_lockfile_invalid_conda_flags(conda_store, simple_specification):
             spec=simple_specification,
             platforms=[conda_utils.conda_platform()],
         )
+
+
+def _fake_conda_lock(platform, lockfile_path):
+    """Writes a lockfile with a single package for platform"""
+    lockfile = {
+        "version": 1,
+        "metadata": {
+            "content_hash": {platform: f"hash-{platform}"},
+            "channels": [{"url": "conda-forge", "used_env_vars": []}],
+            "platforms": [platform],
+            "sources": ["environment.yaml"],
+        },
+        "package": [
+            {
+                "name": "zlib",
+                "version": "1.2.13",
+                "manager": "conda",
+                "platform": platform,
+                "dependencies": {},
+                "url": f"https://conda.anaconda.org/conda-forge/{platform}/zlib-1.2.13-0.conda",
+                "hash": {"md5": "0" * 32},
+                "category": "main",
+                "optional": False,
+            }
+        ],
+    }
+    with open(lockfile_path, "w") as f:
+        yaml.dump(lockfile, f)
+
+
+def test_solve_lockfile_parallel_platforms(conda_store, simple_specification):
+    conda_store.config.conda_lock_parallel_platforms = True
+    platforms = ["linux-64", "osx-arm64"]
+    popen = subprocess.Popen
+    commands = []
+
+    def fake_popen(command, **kwargs):
+        # Also replaces the conda info and config commands
+        if "conda_lock" not in command:
+            return popen([sys.executable, "-c", ""], **kwargs)
+        commands.append(command)
+        _fake_conda_lock(
+            command[command.index("--platform") + 1],
+            command[command.index("--lockfile") + 1],
+        )
+        return popen([sys.executable, "-c", ""], **kwargs)
+
+    with mock.patch.object(conda_lock.subprocess, "Popen", side_effect=fake_popen):
+        lock_result = conda_lock.CondaLock().lock_environment(
+            context=plugin_context.PluginContext(conda_store),
+            spec=simple_specification,
+            platforms=platforms,
+        )
+
+    assert [command[command.index("--platform") + 1] for command in commands] == (
+        platforms
+    )
+    assert all(command[1:4] == ["-m", "conda_lock", "lock"] for command in commands)
+    assert sorted(lock_result["metadata"]["platforms"]) == platforms
+    assert lock_result["metadata"]["content_hash"] == {
+        platform: f"hash-{platform}" for platform in platforms
+    }
+    assert sorted(package["platform"] for package in lock_result["package"]) == (
+        platforms
+    )
+
+
+def test_solve_lockfile_parallel_platforms_error(conda_store, simple_specification):
+    conda_store.config.conda_lock_parallel_platforms = True
+    popen = subprocess.Popen
+
+    def fake_popen(command, **kwargs):
+        return popen([sys.executable, "-c", "raise SystemExit(1)"], **kwargs)
+
+    with mock.patch.object(conda_lock.subprocess, "Popen", side_effect=fake_popen):
+        with pytest.raises(subprocess.CalledProcessError):
+            conda_lock.CondaLock().lock_environment(
+                context=plugin_context.PluginContext(conda_store),
+                spec=simple_specification,
+                platforms=["linux-64", "osx-arm64"],
+            )
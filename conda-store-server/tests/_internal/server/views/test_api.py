@@ -16,7 +16,7 @@ import yaml
 from fastapi import Request
 from fastapi.testclient import TestClient
 
-from conda_store_server import CONDA_STORE_DIR, __version__
+from conda_store_server import CONDA_STORE_DIR, __version__, api
 from conda_store_server._internal import schema
 from conda_store_server._internal.server import dependencies
 from conda_store_server._internal.server.pagination import Cursor
@@ -159,6 +159,20 @@ def test_get_usage_auth(testclient, authenticate):
     assert r.status == schema.APIStatus.OK
 
 
+def test_get_usage_storage_unique(testclient, authenticate, db, seed_conda_store):
+    build = api.get_build(db, build_id=4)
+    build.size = 1000
+    build.size_unique = 100
+    db.commit()
+
+    response = testclient.get("/api/v1/usage/")
+    response.raise_for_status()
+
+    data = response.json()["data"]
+    assert data["namespace2"]["storage"] == 1000
+    assert data["namespace2"]["storage_unique"] == 100
+
+
 def test_api_list_namespace_unauth(testclient, seed_conda_store):
     response = testclient.get("api/v1/namespace")
     response.raise_for_status()
@@ -428,6 +442,9 @@ def test_api_get_build_one_auth(testclient, seed_conda_store, authenticate):
     assert r.data.id == 3
     assert r.data.specification.name == "name3"
     assert r.data.status == schema.BuildStatus.QUEUED.value
+    # Seeded builds were never dispatched to workers
+    assert r.data.queue_position >= 1
+    assert r.data.phases == []
 
 
 def test_api_get_build_one_unauth_packages(testclient, seed_conda_store):
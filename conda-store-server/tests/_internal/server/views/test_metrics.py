@@ -2,6 +2,10 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
+import datetime
+
+from conda_store_server._internal import orm
+
 
 def test_prometheus_metrics(testclient):
     response = testclient.get("metrics")
@@ -16,6 +20,35 @@ def test_prometheus_metrics(testclient):
     } <= d.keys()
 
 
+def test_prometheus_metrics_build_phases(testclient, db, seed_conda_store):
+    for wall_time in [0.5, 42]:
+        db.add(
+            orm.BuildPhase(
+                build_id=1,
+                name="solve",
+                started_on=datetime.datetime.utcnow(),
+                wall_time=wall_time,
+            )
+        )
+    db.commit()
+
+    response = testclient.get("metrics")
+    lines = response.content.decode("utf-8").split("\n")
+    assert "# TYPE conda_store_build_phase_wall_seconds histogram" in lines
+    assert (
+        'conda_store_build_phase_wall_seconds_bucket{phase="solve",le="1"} 1' in lines
+    )
+    assert (
+        'conda_store_build_phase_wall_seconds_bucket{phase="solve",le="60"} 2' in lines
+    )
+    assert 'conda_store_build_phase_wall_seconds_sum{phase="solve"} 42.5' in lines
+    assert 'conda_store_build_phase_wall_seconds_count{phase="solve"} 2' in lines
+    # Phases without resource usage are left out
+    assert not any(
+        line.startswith("conda_store_build_phase_cpu_seconds_") for line in lines
+    )
+
+
 def test_celery_stats(testclient, celery_worker):
     response = testclient.get("celery")
     assert response.json().keys() == {
@@ -0,0 +1,94 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import collections
+from unittest import mock
+
+import pytest
+from celery.exceptions import Retry
+
+from conda_store_server import api, exception
+from conda_store_server._internal import admission, schema
+from conda_store_server._internal.worker import tasks
+
+DiskUsage = collections.namedtuple("DiskUsage", ["total", "used", "free"])
+
+
+@pytest.fixture
+def worker(conda_store):
+    with mock.patch.object(
+        tasks.WorkerTask, "worker", new_callable=mock.PropertyMock
+    ) as worker:
+        worker.return_value.conda_store = conda_store
+        yield worker
+
+
+def test_available_memory():
+    memory = admission.available_memory()
+    assert memory is None or memory > 0
+
+
+def test_check_build_resources(conda_store):
+    conda_store.config.storage_threshold = 10
+
+    with mock.patch("shutil.disk_usage", return_value=DiskUsage(100, 95, 5)):
+        assert "CondaStore.storage_threshold" in admission.check_build_resources(
+            conda_store
+        )
+
+    with mock.patch("shutil.disk_usage", return_value=DiskUsage(100, 50, 50)):
+        assert admission.check_build_resources(conda_store) is None
+
+        conda_store.config.build_min_available_memory = 1024
+        with mock.patch.object(admission, "available_memory", return_value=512):
+            assert "CondaStore.build_min_available_memory" in (
+                admission.check_build_resources(conda_store)
+            )
+        with mock.patch.object(admission, "available_memory", return_value=None):
+            assert admission.check_build_resources(conda_store) is None
+
+
+def test_check_build_resources_pkgs_dir(conda_store, tmp_path):
+    conda_store.config.storage_threshold = 0
+    conda_store.config.build_pkgs_dir_max_size = 1024
+    (tmp_path / "package.conda").write_bytes(b"0" * 4096)
+
+    with mock.patch(
+        "conda_store_server._internal.conda_utils.conda_root_package_dir",
+        return_value=tmp_path,
+    ):
+        assert "CondaStore.build_pkgs_dir_max_size" in (
+            admission.check_build_resources(conda_store)
+        )
+
+        conda_store.config.build_pkgs_dir_max_size = 1024**2
+        assert admission.check_build_resources(conda_store) is None
+
+
+def test_task_build_conda_environment_deferred(
+    db, conda_store, seed_conda_store, worker
+):
+    build = api.get_build(db, build_id=1)
+    build.status = schema.BuildStatus.QUEUED
+    db.commit()
+
+    with (
+        mock.patch.object(admission, "check_build_resources", return_value="no space"),
+        mock.patch.object(tasks, "build_conda_environment") as build_environment,
+    ):
+        with pytest.raises(Retry):
+            tasks.task_build_conda_environment(build.id)
+        db.refresh(build)
+        assert build.status == schema.BuildStatus.QUEUED
+        assert build.status_info == "deferred: no space"
+
+        # The build fails once it was deferred too often
+        conda_store.config.build_admission_max_deferrals = 0
+        with pytest.raises(exception.CondaStoreError):
+            tasks.task_build_conda_environment(build.id)
+        db.refresh(build)
+        assert build.status == schema.BuildStatus.FAILED
+        assert build.status_info == "insufficient worker resources: no space"
+
+        build_environment.assert_not_called()
@@ -0,0 +1,146 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+from unittest import mock
+
+from sqlalchemy.dialects import postgresql
+
+from conda_store_server import api
+from conda_store_server._internal import channel_index, orm
+
+
+def _record(name, version, build, subdir="linux-64", **kwargs):
+    return {
+        "build": build,
+        "build_number": 0,
+        "depends": [],
+        "license": "BSD",
+        "md5": f"md5-{name}-{version}-{build}-{subdir}",
+        "name": name,
+        "sha256": f"sha256-{name}-{version}-{build}-{subdir}",
+        "size": 1024,
+        "subdir": subdir,
+        "timestamp": 1530731681870,
+        "version": version,
+        **kwargs,
+    }
+
+
+def test_channel_indexer_batches(db):
+    channel = api.create_conda_channel(db, "test-channel")
+    db.commit()
+
+    records = [
+        _record("a", "1.0", "0"),
+        _record("a", "1.0", "1"),
+        _record("a", "2.0", "0"),
+        # Duplicates within the repodata are inserted once
+        _record("a", "2.0", "0"),
+        _record("b", "1.0", "0"),
+        # Records without a required key are skipped
+        _record("c", "1.0", "0", md5=None),
+    ]
+
+    with (
+        mock.patch.object(channel_index, "BATCH_SIZE", 2),
+        mock.patch.object(channel_index, "NAME_BATCH_SIZE", 1),
+    ):
+        indexer = channel_index.ChannelIndexer(
+            db, channel.id, package_info={"a": {"summary": "package a"}}
+        )
+        indexer.index_subdir("linux-64", records)
+        # Packages are shared by the subdirs
+        indexer.index_subdir("noarch", [_record("a", "1.0", "0", subdir="noarch")])
+
+    assert indexer.stats == {
+        "packages": 3,
+        "package_builds": 5,
+        "tombstoned": 0,
+        "restored": 0,
+    }
+    packages = {
+        (package.name, package.version): package
+        for package in db.query(orm.CondaPackage)
+    }
+    assert set(packages) == {("a", "1.0"), ("a", "2.0"), ("b", "1.0")}
+    assert packages[("a", "1.0")].summary == "package a"
+    for package_build in db.query(orm.CondaPackageBuild):
+        assert package_build.package.name in package_build.sha256
+        assert package_build.package.version in package_build.sha256
+        assert package_build.depends == ""
+
+    # Indexing the same records again inserts nothing
+    indexer = channel_index.ChannelIndexer(db, channel.id)
+    indexer.index_subdir("linux-64", records)
+    assert indexer.stats["packages"] == indexer.stats["package_builds"] == 0
+
+
+def test_channel_indexer_concurrent_packages(db):
+    channel = api.create_conda_channel(db, "test-channel")
+    db.commit()
+
+    # The packages are inserted by the indexer of another subdir after they
+    # were looked up
+    indexer = channel_index.ChannelIndexer(db, channel.id)
+    indexer.index_subdir("noarch", [_record("a", "1.0", "0", subdir="noarch")])
+    indexer = channel_index.ChannelIndexer(db, channel.id)
+    with mock.patch.object(
+        channel_index,
+        "load_package_ids",
+        wraps=channel_index.load_package_ids,
+        side_effect=[{}, mock.DEFAULT, mock.DEFAULT],
+    ):
+        indexer.index_subdir(
+            "linux-64", [_record("a", "1.0", "0"), _record("b", "1.0", "0")]
+        )
+
+    assert indexer.stats["packages"] == 1
+    assert indexer.stats["package_builds"] == 2
+    assert db.query(orm.CondaPackage).count() == 2
+    assert db.query(orm.CondaPackageBuild).count() == 3
+
+
+def test_copy_value():
+    depends = orm.CondaPackageBuild.__table__.c.depends
+    summary = orm.CondaPackage.__table__.c.summary
+
+    assert channel_index.copy_value(None, summary) == r"\N"
+    assert channel_index.copy_value("a\tb\nc\\d", summary) == r"a\tb\nc\\d"
+    # Like the engine, JSON columns persist None as the JSON null
+    assert channel_index.copy_value(None, depends) == "null"
+    assert channel_index.copy_value(['a "1.0"'], depends) == r'["a \\"1.0\\""]'
+
+
+def test_bulk_insert_copy():
+    db = mock.MagicMock()
+    db.get_bind.return_value.dialect = postgresql.psycopg2.dialect()
+    cursor = db.connection.return_value.connection.cursor.return_value.__enter__()
+    cursor.rowcount = 1
+    copied = []
+    cursor.copy_expert.side_effect = lambda _sql, rows: copied.append(rows.read())
+
+    mappings = [
+        channel_index.package_mapping(1, _record("a", "1.0", "0"), {}),
+        channel_index.package_mapping(1, _record("b", "1.0", "0"), {}),
+    ]
+    assert channel_index.bulk_insert(db, orm.CondaPackage, mappings) == 1
+
+    # The rows are copied into a staging table merged into conda_package
+    statements = [call.args[0] for call in cursor.execute.call_args_list]
+    assert statements[0].startswith(
+        "CREATE TEMPORARY TABLE conda_package_staging ON COMMIT DROP AS SELECT "
+        "channel_id, license, license_family, name, version, summary, description "
+        "FROM conda_package WITH NO DATA"
+    )
+    assert cursor.copy_expert.call_args.args[0] == (
+        "COPY conda_package_staging (channel_id, license, license_family, name, "
+        "version, summary, description) FROM STDIN"
+    )
+    assert copied == ["1\tBSD\t\\N\ta\t1.0\t\\N\t\\N\n1\tBSD\t\\N\tb\t1.0\t\\N\t\\N\n"]
+    assert statements[1].endswith(
+        "SELECT channel_id, license, license_family, name, version, summary, "
+        "description FROM conda_package_staging ON CONFLICT DO NOTHING"
+    )
+    db.commit.assert_called_once()
+    db.bulk_insert_mappings.assert_not_called()
@@ -0,0 +1,128 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import bz2
+import io
+import json
+import os
+from unittest import mock
+
+import pytest
+import zstandard
+
+from conda_store_server._internal import conda_utils
+
+REPODATA = {
+    "info": {"subdir": "linux-64"},
+    "packages": {
+        f"package-{i}-1.0-0.tar.bz2": {
+            "build": "0",
+            "build_number": 0,
+            "depends": ["python >=3.10"],
+            "md5": f"md5-{i}",
+            "name": f"package-{i}",
+            "sha256": f"sha256-{i}",
+            "size": 1024,
+            "subdir": "linux-64",
+            "timestamp": 1530731681870,
+            "version": "1.0",
+        }
+        for i in range(100)
+    },
+    "packages.conda": {
+        f"package-{i}-2.0-0.conda": {
+            "build": "0",
+            "build_number": 0,
+            "depends": ["python >=3.10"],
+            "md5": f"md5-conda-{i}",
+            "name": f"package-{i}",
+            "sha256": f"sha256-conda-{i}",
+            "size": 1024,
+            "subdir": "linux-64",
+            "timestamp": 1530731681870,
+            "version": "2.0",
+        }
+        for i in range(10)
+    },
+    "repodata_version": 1,
+}
+
+
+@pytest.mark.parametrize(
+    "compression, compress",
+    [
+        ("json", lambda data: data),
+        ("bz2", bz2.compress),
+        ("zst", lambda data: zstandard.ZstdCompressor().compress(data)),
+    ],
+)
+def test_stream_repodata_records(compression, compress):
+    response = mock.MagicMock(status_code=200)
+    response.__enter__.return_value = response
+    response.raw = io.BytesIO(compress(json.dumps(REPODATA).encode("utf-8")))
+
+    with mock.patch.object(conda_utils, "http_session") as http_session:
+        get = http_session.return_value.get
+        get.return_value = response
+        records = conda_utils.stream_repodata_records(
+            f"https://conda.example.com/linux-64/repodata.json.{compression}"
+        )
+        # Nothing is downloaded before the records are consumed
+        get.assert_not_called()
+        assert list(records) == [
+            *REPODATA["packages"].values(),
+            *REPODATA["packages.conda"].values(),
+        ]
+
+    get.assert_called_once_with(
+        f"https://conda.example.com/linux-64/repodata.json.{compression}",
+        headers=None,
+        stream=True,
+    )
+
+
+def test_stream_repodata_records_not_modified():
+    response = mock.MagicMock(status_code=304)
+    response.__enter__.return_value = response
+
+    with mock.patch.object(conda_utils, "http_session") as http_session:
+        http_session.return_value.get.return_value = response
+        records = conda_utils.stream_repodata_records(
+            "https://conda.example.com/linux-64/repodata.json.bz2",
+            headers={"If-Modified-Since": "Mon, 01 Jan 2024 00:00:00 GMT"},
+        )
+        assert list(records) == []
+
+
+def test_http_session(monkeypatch):
+    monkeypatch.setattr(conda_utils, "_http_session", None)
+
+    # The session, and its connection pools, is shared within a process
+    session = conda_utils.http_session()
+    assert conda_utils.http_session() is session
+    adapter = session.get_adapter("https://conda.anaconda.org")
+    assert adapter.max_retries.total == conda_utils.HTTP_RETRIES
+
+    with mock.patch("os.getpid", return_value=os.getpid() + 1):
+        assert conda_utils.http_session() is not session
+
+
+def test_http_session_retries(monkeypatch, conda_channel_server):
+    monkeypatch.setattr(conda_utils, "_http_session", None)
+    monkeypatch.setattr(conda_utils, "HTTP_BACKOFF_FACTOR", 0)
+    (conda_channel_server.directory / "channeldata.json").write_text("{}")
+
+    conda_channel_server.failures["/channeldata.json"] = 2
+    response = conda_utils.http_session().get(
+        f"{conda_channel_server.url}/channeldata.json"
+    )
+    assert response.status_code == 200
+    assert [status for _, status in conda_channel_server.requests] == [503, 503, 200]
+
+    # The last response is returned once the retries are exhausted
+    conda_channel_server.failures["/channeldata.json"] = conda_utils.HTTP_RETRIES + 1
+    response = conda_utils.http_session().get(
+        f"{conda_channel_server.url}/channeldata.json"
+    )
+    assert response.status_code == 503
@@ -10,6 +10,19 @@ from conda_store_server import api
 from conda_store_server._internal import orm
 
 
+def _streamed(repodata):
+    """Repodata as returned by download_repodata, with the package records of
+    each architecture instead of its parsed repodata.json
+    """
+    return {
+        **repodata,
+        "architectures": {
+            subdir: list(subdir_repodata["packages"].values())
+            for subdir, subdir_repodata in repodata["architectures"].items()
+        },
+    }
+
+
 @pytest.fixture
 def populated_db(db):
     """A database fixture populated with
@@ -174,7 +187,7 @@ def test_repodata_multiple_packages():
 @mock.patch("conda_store_server._internal.conda_utils.download_repodata")
 def test_update_packages_first_time(mock_repdata, db, test_repodata):
     # mock download_repodata to return static test repodata
-    mock_repdata.return_value = test_repodata
+    mock_repdata.return_value = _streamed(test_repodata)
 
     # create test channel
     channel = api.create_conda_channel(db, "test-channel-1")
@@ -194,7 +207,7 @@ def test_update_packages_add_existing_pkg_new_version(
     mock_repdata, populated_db, test_repodata
 ):
     # mock download_repodata to return static test repodata
-    mock_repdata.return_value = test_repodata
+    mock_repdata.return_value = _streamed(test_repodata)
 
     # check state of db before updating packages
     count = (
@@ -273,7 +286,7 @@ def test_update_packages_multiple_subdirs(mock_repdata, populated_db):
             },
         }
     }
-    mock_repdata.return_value = repodata
+    mock_repdata.return_value = _streamed(repodata)
 
     # check state of db before updating packages
     count = (
@@ -308,7 +321,7 @@ def test_update_packages_multiple_subdirs(mock_repdata, populated_db):
 @mock.patch("conda_store_server._internal.conda_utils.download_repodata")
 def test_update_packages_twice(mock_repdata, populated_db, test_repodata):
     # mock download_repodata to return static test repodata
-    mock_repdata.return_value = test_repodata
+    mock_repdata.return_value = _streamed(test_repodata)
 
     def check_packages():
         # ensure package is added
@@ -357,7 +370,7 @@ def test_update_packages_twice(mock_repdata, populated_db, test_repodata):
 @mock.patch("conda_store_server._internal.conda_utils.download_repodata")
 def test_update_packages_new_package_channel(mock_repdata, populated_db, test_repodata):
     # mock download_repodata to return static test repodata
-    mock_repdata.return_value = test_repodata
+    mock_repdata.return_value = _streamed(test_repodata)
 
     channel = (
         populated_db.query(orm.CondaChannel).filter(orm.CondaChannel.id == 2).first()
@@ -388,7 +401,7 @@ def test_update_packages_multiple_builds(
     mock_repdata, populated_db, test_repodata_multiple_packages
 ):
     # mock download_repodata to return static test repodata
-    mock_repdata.return_value = test_repodata_multiple_packages
+    mock_repdata.return_value = _streamed(test_repodata_multiple_packages)
 
     count = populated_db.query(orm.CondaPackageBuild).count()
     assert count == 3
@@ -419,7 +432,7 @@ def test_update_packages_multiple_builds(
 def test_update_packages_channel_consistency(
     mock_repdata, populated_db, test_repodata_multiple_packages
 ):
-    mock_repdata.return_value = test_repodata_multiple_packages
+    mock_repdata.return_value = _streamed(test_repodata_multiple_packages)
 
     channel = (
         populated_db.query(orm.CondaChannel).filter(orm.CondaChannel.id == 2).first()
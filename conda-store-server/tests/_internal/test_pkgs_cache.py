@@ -0,0 +1,105 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import time
+
+import filelock
+
+from conda_store_server._internal import pkgs_cache
+
+DAY = 24 * 60 * 60
+
+
+def _add_package(pkgs_dir, name, size, age):
+    tarball = pkgs_dir / f"{name}.conda"
+    tarball.write_bytes(b"0" * size)
+    extracted_dir = pkgs_dir / name
+    (extracted_dir / "info").mkdir(parents=True)
+    (extracted_dir / "info" / "index.json").write_text("{}")
+    (extracted_dir / "lib.so").write_bytes(b"0" * size)
+
+    last_used = time.time() - age
+    for path in [tarball, extracted_dir]:
+        os.utime(path, (last_used, last_used))
+    return extracted_dir
+
+
+def test_list_packages(tmp_path):
+    _add_package(tmp_path, "a-1.0-0", 100, DAY)
+    (tmp_path / "urls.txt").touch()
+
+    (package,) = pkgs_cache.list_packages(tmp_path)
+    assert package["name"] == "a-1.0-0"
+    assert package["size"] == 2 * 100 + len("{}")
+    assert not package["is_linked"]
+
+    tarball_mtime = (tmp_path / "a-1.0-0.conda").stat().st_mtime_ns
+    pkgs_cache.mark_used(tmp_path, "a-1.0-0.conda")
+    (package,) = pkgs_cache.list_packages(tmp_path)
+    assert time.time() - package["last_used"] < 60
+    # The use is recorded in a marker, the package files are untouched
+    assert (tmp_path / "a-1.0-0.conda").stat().st_mtime_ns == tarball_mtime
+
+    # Markers of packages removed from the cache are cleaned up
+    (tmp_path / "b-1.0-0.used").touch()
+    assert len(pkgs_cache.list_packages(tmp_path)) == 1
+    assert not (tmp_path / "b-1.0-0.used").exists()
+
+
+def test_evict_packages(tmp_path):
+    _add_package(tmp_path, "oldest-1.0-0", 1000, 4 * DAY)
+    _add_package(tmp_path, "old-1.0-0", 1000, 3 * DAY)
+    _add_package(tmp_path, "recent-1.0-0", 1000, 2 * DAY)
+    _add_package(tmp_path, "used-1.0-0", 1000, 5 * DAY)
+    for name, age in [("oldest-1.0-0", 4 * DAY), ("used-1.0-0", DAY)]:
+        used_on = time.time() - age
+        (tmp_path / f"{name}.used").touch()
+        os.utime(tmp_path / f"{name}.used", (used_on, used_on))
+
+    result = pkgs_cache.evict_packages(tmp_path, max_size=7000)
+    assert result["evicted_packages"] == 1
+    assert result["evicted_bytes"] == 2002
+    assert result["size"] <= 7000
+    assert not (tmp_path / "oldest-1.0-0").exists()
+    assert not (tmp_path / "oldest-1.0-0.conda").exists()
+    assert not (tmp_path / "oldest-1.0-0.used").exists()
+    assert (tmp_path / "old-1.0-0.conda").exists()
+    # Its marker tells that the package was used recently
+    assert (tmp_path / "used-1.0-0.conda").exists()
+
+
+def test_evict_packages_protected(tmp_path):
+    # Hardlinked into a prefix
+    linked = _add_package(tmp_path, "linked-1.0-0", 1000, 4 * DAY)
+    prefix = tmp_path / "prefix"
+    prefix.mkdir()
+    os.link(linked / "lib.so", prefix / "lib.so")
+    # Locked by a download
+    _add_package(tmp_path, "locked-1.0-0", 1000, 3 * DAY)
+    # Used by a running build
+    _add_package(tmp_path, "recent-1.0-0", 1000, 60)
+
+    with filelock.FileLock(str(tmp_path / "locked-1.0-0.conda.lock")):
+        result = pkgs_cache.evict_packages(tmp_path, max_size=0)
+
+    assert result["evicted_packages"] == 0
+    assert {_["name"] for _ in pkgs_cache.list_packages(tmp_path)} == {
+        "linked-1.0-0",
+        "locked-1.0-0",
+        "recent-1.0-0",
+    }
+
+
+def test_packages_size(tmp_path):
+    _add_package(tmp_path, "a-1.0-0", 1000, 4 * DAY)
+    assert pkgs_cache.packages_size(tmp_path) == 2002
+
+    # The size is reused for a while, and updated by evictions
+    _add_package(tmp_path, "b-1.0-0", 1000, 3 * DAY)
+    assert pkgs_cache.packages_size(tmp_path) == 2002
+    assert pkgs_cache.packages_size(tmp_path, max_age=0) == 4004
+
+    pkgs_cache.evict_packages(tmp_path, max_size=3000)
+    assert pkgs_cache.packages_size(tmp_path) == 2002
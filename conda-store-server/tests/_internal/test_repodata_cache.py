@@ -0,0 +1,316 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import bz2
+import hashlib
+import json
+from unittest import mock
+
+import jsonpatch
+import pytest
+import zstandard
+
+from conda_store_server import api
+from conda_store_server._internal import channel_index, orm, repodata_cache
+
+
+def _record(name):
+    return {
+        "build": "0",
+        "build_number": 0,
+        "depends": [],
+        "md5": f"md5-{name}",
+        "name": name,
+        "sha256": f"sha256-{name}",
+        "size": 1024,
+        "subdir": "linux-64",
+        "timestamp": 1530731681870,
+        "version": "1.0",
+    }
+
+
+def _repodata(*names, conda=()):
+    return {
+        "info": {"subdir": "linux-64"},
+        "packages": {f"{name}-1.0-0.tar.bz2": _record(name) for name in names},
+        "packages.conda": {f"{name}-1.0-0.conda": _record(name) for name in conda},
+        "repodata_version": 1,
+    }
+
+
+def _dumps(repodata):
+    return json.dumps(repodata).encode("utf-8")
+
+
+def _blake2_256(content):
+    return hashlib.blake2b(content, digest_size=32).hexdigest()
+
+
+def _write_channel(directory, repodata, compressions=("zst", "bz2"), subdir="linux-64"):
+    (directory / "channeldata.json").write_text(
+        json.dumps({"packages": {"a": {"summary": "package a"}}})
+    )
+    (directory / subdir).mkdir(exist_ok=True)
+    content = _dumps(repodata)
+    compress = {
+        "zst": zstandard.ZstdCompressor().compress,
+        "bz2": bz2.compress,
+    }
+    for compression in compressions:
+        path = directory / subdir / f"repodata.json.{compression}"
+        path.write_bytes(compress[compression](content))
+
+
+def _write_jlap(directory, versions):
+    """repodata.jlap with the patches between consecutive repodata versions"""
+    lines = [repodata_cache.JLAP_NULL_IV.encode("ascii")]
+    for old, new in zip(versions, versions[1:], strict=False):
+        patch = {
+            "from": _blake2_256(_dumps(old)),
+            "to": _blake2_256(_dumps(new)),
+            "patch": jsonpatch.make_patch(old, new).patch,
+        }
+        lines.append(json.dumps(patch).encode("utf-8"))
+    lines.append(
+        json.dumps(
+            {"url": "repodata.json", "latest": _blake2_256(_dumps(versions[-1]))}
+        ).encode("utf-8")
+    )
+
+    digest = bytes.fromhex(repodata_cache.JLAP_NULL_IV)
+    for line in lines[1:]:
+        digest = hashlib.blake2b(line, digest_size=32, key=digest).digest()
+    lines.append(digest.hex().encode("ascii"))
+    (directory / "linux-64" / "repodata.jlap").write_bytes(b"\n".join(lines) + b"\n")
+
+
+def _download(server, tmp_path, subdirs=("linux-64",), max_workers=None):
+    server.requests.clear()
+    repodata = repodata_cache.download_repodata(
+        server.url, str(tmp_path / "cache"), subdirs=subdirs, max_workers=max_workers
+    )
+    names = {}
+    for subdir, records in repodata["architectures"].items():
+        names[subdir] = sorted(record["name"] for record in records)
+        repodata_cache.mark_indexed(server.url, str(tmp_path / "cache"), subdir)
+    return names
+
+
+def _subdir_requests(server, subdir="linux-64"):
+    """Requests of a subdir, which are sent by the thread updating it"""
+    return [
+        request for request in server.requests if request[0].startswith(f"/{subdir}/")
+    ]
+
+
+def test_download_repodata_conditional(conda_channel_server, tmp_path):
+    _write_channel(conda_channel_server.directory, _repodata("a", "b"))
+
+    assert _download(conda_channel_server, tmp_path) == {"linux-64": ["a", "b"]}
+    assert ("/linux-64/repodata.json.zst", 200) in conda_channel_server.requests
+
+    # Unchanged repodata is validated with its ETag and not indexed again
+    assert _download(conda_channel_server, tmp_path) == {}
+    assert ("/channeldata.json", 304) in conda_channel_server.requests
+    assert ("/linux-64/repodata.json.zst", 304) in conda_channel_server.requests
+
+    # Only the records changed since the repodata was indexed are iterated
+    _write_channel(conda_channel_server.directory, _repodata("a", "c"))
+    assert _download(conda_channel_server, tmp_path) == {"linux-64": ["c"]}
+
+
+def test_download_repodata_concurrent(conda_channel_server, tmp_path):
+    _write_channel(conda_channel_server.directory, _repodata("a", "b"))
+    _write_channel(conda_channel_server.directory, _repodata("c"), subdir="noarch")
+    conda_channel_server.failures["/noarch/repodata.json.zst"] = 1
+
+    assert _download(
+        conda_channel_server, tmp_path, subdirs=["linux-64", "noarch"], max_workers=3
+    ) == {"linux-64": ["a", "b"], "noarch": ["c"]}
+    # The failed request is retried
+    assert ("/noarch/repodata.json.zst", 503) in conda_channel_server.requests
+    assert ("/noarch/repodata.json.zst", 200) in conda_channel_server.requests
+
+    _write_channel(conda_channel_server.directory, _repodata("d"), subdir="noarch")
+    assert _download(
+        conda_channel_server, tmp_path, subdirs=["linux-64", "noarch"], max_workers=3
+    ) == {"noarch": ["d"]}
+
+
+def test_download_repodata_bz2_fallback(conda_channel_server, tmp_path):
+    _write_channel(
+        conda_channel_server.directory, _repodata("a", "b"), compressions=["bz2"]
+    )
+
+    assert _download(conda_channel_server, tmp_path) == {"linux-64": ["a", "b"]}
+    assert _subdir_requests(conda_channel_server)[-2:] == [
+        ("/linux-64/repodata.json.zst", 404),
+        ("/linux-64/repodata.json.bz2", 200),
+    ]
+
+    # repodata.json.zst is known to be unavailable
+    assert _download(conda_channel_server, tmp_path) == {}
+    assert ("/linux-64/repodata.json.zst", 404) not in conda_channel_server.requests
+    assert ("/linux-64/repodata.json.bz2", 304) in conda_channel_server.requests
+
+
+def test_download_repodata_jlap(conda_channel_server, tmp_path):
+    versions = [_repodata("a", "b"), _repodata("a", "c"), _repodata("a", "c", "d")]
+    # The compressed repodata is not updated, so that it is only read once
+    _write_channel(conda_channel_server.directory, versions[0])
+    _write_jlap(conda_channel_server.directory, versions[:1])
+    assert _download(conda_channel_server, tmp_path) == {"linux-64": ["a", "b"]}
+
+    _write_jlap(conda_channel_server.directory, versions[:2])
+    assert _download(conda_channel_server, tmp_path) == {"linux-64": ["c"]}
+    assert _subdir_requests(conda_channel_server)[-1] == (
+        "/linux-64/repodata.jlap",
+        200,
+    )
+
+    # Only the lines appended since the last update are read
+    _write_jlap(conda_channel_server.directory, versions)
+    assert _download(conda_channel_server, tmp_path) == {"linux-64": ["d"]}
+    assert _subdir_requests(conda_channel_server)[-1] == (
+        "/linux-64/repodata.jlap",
+        206,
+    )
+
+    assert _download(conda_channel_server, tmp_path) == {}
+    assert _subdir_requests(conda_channel_server)[-1] == (
+        "/linux-64/repodata.jlap",
+        206,
+    )
+
+
+def test_download_repodata_jlap_invalid(conda_channel_server, tmp_path):
+    _write_channel(conda_channel_server.directory, _repodata("a", "b"))
+    _write_jlap(conda_channel_server.directory, [_repodata("a", "b")])
+    assert _download(conda_channel_server, tmp_path) == {"linux-64": ["a", "b"]}
+
+    # The patches do not lead from the cached repodata to the latest one
+    _write_jlap(conda_channel_server.directory, [_repodata("x"), _repodata("c")])
+    _write_channel(conda_channel_server.directory, _repodata("a", "c"))
+    assert _download(conda_channel_server, tmp_path) == {"linux-64": ["c"]}
+    assert _subdir_requests(conda_channel_server)[-1] == (
+        "/linux-64/repodata.json.zst",
+        200,
+    )
+
+
+def test_parse_jlap_checksum():
+    with pytest.raises(repodata_cache.JlapError):
+        repodata_cache.parse_jlap(
+            b"\n".join([repodata_cache.JLAP_NULL_IV.encode(), b"{}", b"0" * 64]),
+            0,
+            repodata_cache.JLAP_NULL_IV,
+        )
+
+
+def test_update_packages_tombstones(conda_channel_server, tmp_path, db):
+    cache_dir = str(tmp_path / "cache")
+    channel = api.create_conda_channel(db, conda_channel_server.url)
+    db.commit()
+
+    def deleted():
+        return {
+            package_build.package.name: package_build.deleted_on is not None
+            for package_build in db.query(orm.CondaPackageBuild)
+        }
+
+    def listed():
+        return sorted(package.name for package in api.list_conda_packages(db))
+
+    _write_channel(conda_channel_server.directory, _repodata("a", "b", conda=["e"]))
+    channel.update_packages(db, subdirs=["linux-64"], cache_dir=cache_dir)
+    assert deleted() == {"a": False, "b": False, "e": False}
+
+    # A build registered by a worker, e.g. installed before it was removed
+    # from the channel, is not one of the builds removed from the repodata
+    api.create_or_ignore_conda_packages(
+        db,
+        [
+            {
+                **_record("w"),
+                "channel_id": conda_channel_server.url,
+                "constrains": None,
+                "license": None,
+                "license_family": None,
+                "summary": None,
+                "description": None,
+            }
+        ],
+    )
+    db.commit()
+
+    _write_channel(conda_channel_server.directory, _repodata("a", "c", conda=["e"]))
+    channel.update_packages(db, subdirs=["linux-64"], cache_dir=cache_dir)
+    assert deleted() == {"a": False, "b": True, "c": False, "e": False, "w": False}
+    # Tombstoned builds are not listed
+    assert listed() == ["a", "c", "e", "w"]
+
+    _write_channel(conda_channel_server.directory, _repodata("a", "b", "c"))
+    channel.update_packages(db, subdirs=["linux-64"], cache_dir=cache_dir)
+    assert deleted() == {"a": False, "b": False, "c": False, "e": True, "w": False}
+    assert listed() == ["a", "b", "c", "w"]
+
+
+def test_update_packages_changes(conda_channel_server, tmp_path, db):
+    cache_dir = str(tmp_path / "cache")
+    channel = api.create_conda_channel(db, conda_channel_server.url)
+    db.commit()
+
+    _write_channel(conda_channel_server.directory, _repodata("a", "b"))
+    channel.update_packages(db, subdirs=["linux-64"], cache_dir=cache_dir)
+
+    # Only the changed records are inserted or tombstoned, the builds
+    # already indexed are not loaded
+    _write_channel(conda_channel_server.directory, _repodata("a", "c"))
+    with (
+        mock.patch.object(channel_index, "load_package_build_sha256") as load,
+        mock.patch.object(
+            channel_index.ChannelIndexer,
+            "_insert_batch",
+            autospec=True,
+            side_effect=channel_index.ChannelIndexer._insert_batch,
+        ) as insert_batch,
+    ):
+        channel.update_packages(db, subdirs=["linux-64"], cache_dir=cache_dir)
+    load.assert_not_called()
+    (batch,) = [call.args[1] for call in insert_batch.call_args_list]
+    assert [record["name"] for record, _ in batch] == ["c"]
+    assert {
+        package_build.package.name
+        for package_build in db.query(orm.CondaPackageBuild).filter(
+            orm.CondaPackageBuild.deleted_on.is_not(None)
+        )
+    } == {"b"}
+
+
+def test_update_packages_index_failure(conda_channel_server, tmp_path, db):
+    cache_dir = str(tmp_path / "cache")
+    channel = api.create_conda_channel(db, conda_channel_server.url)
+    db.commit()
+    _write_channel(conda_channel_server.directory, _repodata("a", "b"))
+
+    with mock.patch.object(
+        channel_index.ChannelIndexer,
+        "index_subdir",
+        side_effect=RuntimeError("indexing failed"),
+    ):
+        with pytest.raises(RuntimeError, match="indexing failed"):
+            channel.update_packages(db, subdirs=["linux-64"], cache_dir=cache_dir)
+    db.rollback()
+
+    # The repodata is cached, but it is indexed again as it was not indexed
+    channel.update_packages(db, subdirs=["linux-64"], cache_dir=cache_dir)
+    assert ("/linux-64/repodata.json.zst", 304) in conda_channel_server.requests
+    assert sorted(
+        package_build.package.name for package_build in db.query(orm.CondaPackageBuild)
+    ) == ["a", "b"]
+
+    # And then skipped while it is unchanged
+    with mock.patch.object(channel_index.ChannelIndexer, "index_changes") as index:
+        channel.update_packages(db, subdirs=["linux-64"], cache_dir=cache_dir)
+    index.assert_not_called()
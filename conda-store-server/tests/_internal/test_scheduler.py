@@ -0,0 +1,176 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+from unittest import mock
+
+import pytest
+import sqlalchemy
+
+from conda_store_server import api
+from conda_store_server._internal import scheduler, schema
+
+
+@pytest.fixture
+def dispatch_build(conda_store):
+    with mock.patch.object(conda_store, "dispatch_build") as dispatch_build:
+        yield dispatch_build
+
+
+def _create_builds(db, specification, namespace, count):
+    namespace = api.ensure_namespace(db, namespace)
+    specification = api.ensure_specification(db, specification)
+    environment = api.ensure_environment(
+        db, name=specification.name, namespace_id=namespace.id
+    )
+    builds = [
+        api.create_build(db, environment.id, specification.id) for _ in range(count)
+    ]
+    db.commit()
+    return builds
+
+
+def _dispatched_namespaces(dispatch_build):
+    return [
+        call.args[1].environment.namespace.name
+        for call in dispatch_build.call_args_list
+    ]
+
+
+def test_schedule_builds_unlimited(
+    db, conda_store, simple_specification, dispatch_build
+):
+    builds = _create_builds(db, simple_specification, "a", 3)
+
+    assert scheduler.schedule_builds(db, conda_store) == [build.id for build in builds]
+    assert all(build.dispatched_on is not None for build in builds)
+
+    # Builds are only dispatched once
+    assert scheduler.schedule_builds(db, conda_store) == []
+    assert dispatch_build.call_count == 3
+
+
+def test_schedule_builds_fair_share(
+    db, conda_store, simple_specification, dispatch_build
+):
+    conda_store.config.max_concurrent_builds = 4
+    _create_builds(db, simple_specification, "a", 6)
+    _create_builds(db, simple_specification, "b", 2)
+
+    scheduler.schedule_builds(db, conda_store)
+    assert _dispatched_namespaces(dispatch_build) == ["a", "b", "a", "b"]
+    assert api.count_dispatched_builds(db) == {"a": 2, "b": 2}
+
+    # Capacity is freed once a build finishes
+    dispatch_build.reset_mock()
+    build = api.list_builds(db, namespace="b").first()
+    build.status = schema.BuildStatus.COMPLETED
+    db.commit()
+
+    scheduler.schedule_builds(db, conda_store)
+    assert _dispatched_namespaces(dispatch_build) == ["a"]
+
+
+def test_schedule_builds_weights(db, conda_store, simple_specification, dispatch_build):
+    conda_store.config.max_concurrent_builds = 4
+    conda_store.config.namespace_build_weights = {"b": 3}
+    _create_builds(db, simple_specification, "a", 4)
+    _create_builds(db, simple_specification, "b", 4)
+
+    scheduler.schedule_builds(db, conda_store)
+    assert _dispatched_namespaces(dispatch_build) == ["a", "b", "b", "b"]
+
+
+def test_schedule_builds_namespace_limit(
+    db, conda_store, simple_specification, dispatch_build
+):
+    conda_store.config.namespace_max_concurrent_builds = 2
+    _create_builds(db, simple_specification, "a", 5)
+    _create_builds(db, simple_specification, "b", 1)
+
+    scheduler.schedule_builds(db, conda_store)
+    assert sorted(_dispatched_namespaces(dispatch_build)) == ["a", "a", "b"]
+
+
+def test_schedule_builds_dispatch_error(
+    db, conda_store, simple_specification, dispatch_build
+):
+    (build,) = _create_builds(db, simple_specification, "a", 1)
+    dispatch_build.side_effect = ConnectionError()
+
+    with pytest.raises(ConnectionError):
+        scheduler.schedule_builds(db, conda_store)
+
+    # The build is dispatched by the next scheduler run
+    assert build.dispatched_on is None
+    dispatch_build.side_effect = None
+    assert scheduler.schedule_builds(db, conda_store) == [build.id]
+
+
+def test_queue_status(db, conda_store, simple_specification, dispatch_build):
+    conda_store.config.max_concurrent_builds = 1
+    builds = _create_builds(db, simple_specification, "a", 2) + _create_builds(
+        db, simple_specification, "b", 2
+    )
+
+    scheduler.schedule_builds(db, conda_store)
+    assert scheduler.queue_status(db, conda_store, builds[0]) == (None, None)
+    # b has no dispatched builds, so it is next
+    assert scheduler.queue_status(db, conda_store, builds[2]) == (1, None)
+    assert scheduler.queue_status(db, conda_store, builds[1])[0] == 2
+    assert scheduler.queue_status(db, conda_store, builds[3])[0] == 3
+
+    # The ETA is based on the duration of completed builds
+    now = datetime.datetime.utcnow()
+    builds[0].status = schema.BuildStatus.COMPLETED
+    builds[0].started_on = now - datetime.timedelta(minutes=10)
+    builds[0].ended_on = now
+    db.commit()
+
+    position, eta = scheduler.queue_status(db, conda_store, builds[3])
+    assert position == 3
+    assert eta - now >= datetime.timedelta(minutes=30)
+
+
+def test_queue_status_queries(db, conda_store, simple_specification, dispatch_build):
+    conda_store.config.max_concurrent_builds = 1
+    builds = [
+        build
+        for namespace in ["a", "b", "c", "d"]
+        for build in _create_builds(db, simple_specification, namespace, 2)
+    ]
+    scheduler.schedule_builds(db, conda_store)
+    db.expire_all()
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(db.bind, "before_cursor_execute", before_cursor_execute)
+    try:
+        assert scheduler.queue_status(db, conda_store, builds[-1])[0] == 7
+    finally:
+        sqlalchemy.event.remove(db.bind, "before_cursor_execute", before_cursor_execute)
+    # The build, the pending builds with their environment and namespace,
+    # the dispatched builds and the recent build durations, without loading
+    # the namespace of each pending build
+    assert len(statements) == 4
+    assert not any("WHERE namespace.id = " in statement for statement in statements)
+
+
+def test_cancel_pending_build(db, conda_store, simple_specification, dispatch_build):
+    conda_store.config.max_concurrent_builds = 1
+    builds = _create_builds(db, simple_specification, "a", 2)
+    scheduler.schedule_builds(db, conda_store)
+
+    # Dispatched builds have to be revoked instead
+    assert not api.cancel_pending_build(db, builds[0].id)
+    assert api.cancel_pending_build(db, builds[1].id)
+    db.refresh(builds[1])
+    assert builds[1].status == schema.BuildStatus.CANCELED
+
+    builds[0].status = schema.BuildStatus.COMPLETED
+    db.commit()
+    assert scheduler.schedule_builds(db, conda_store) == []
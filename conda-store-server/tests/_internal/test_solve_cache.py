@@ -0,0 +1,157 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import threading
+import time
+from unittest import mock
+
+from conda_store_server import api
+from conda_store_server._internal import conda_utils, orm, schema, solve_cache
+from conda_store_server.plugins import plugin_context
+
+
+def _lock_environment(db, conda_store, locker, spec, platforms=None):
+    return solve_cache.lock_environment(
+        db=db,
+        conda_store=conda_store,
+        lock_backend="conda-lock",
+        locker=locker,
+        context=plugin_context.PluginContext(conda_store=conda_store),
+        spec=spec,
+        platforms=platforms or [conda_utils.conda_platform()],
+    )
+
+
+def _solve_cache_metrics(db):
+    metrics = api.get_metrics(db)
+    return metrics["solve_cache_hits"], metrics["solve_cache_misses"]
+
+
+def test_solve_cache_hit(db, conda_store, simple_specification):
+    locker = mock.Mock()
+    locker.lock_environment.return_value = {"package": [{"name": "zlib"}]}
+
+    assert _lock_environment(db, conda_store, locker, simple_specification) == {
+        "package": [{"name": "zlib"}]
+    }
+    assert _solve_cache_metrics(db) == (0, 1)
+
+    # Same packages submitted under another name reuse the solve
+    other_specification = simple_specification.model_copy(update={"name": "other"})
+    assert _lock_environment(db, conda_store, locker, other_specification) == {
+        "package": [{"name": "zlib"}]
+    }
+    assert _solve_cache_metrics(db) == (1, 1)
+    locker.lock_environment.assert_called_once()
+
+    # Solving for other platforms or dependencies is a miss
+    _lock_environment(db, conda_store, locker, simple_specification, ["win-64"])
+    _lock_environment(
+        db,
+        conda_store,
+        locker,
+        simple_specification.model_copy(update={"dependencies": ["python"]}),
+    )
+    assert _solve_cache_metrics(db) == (1, 3)
+
+
+def test_solve_cache_key_channel_order(db, conda_store):
+    platforms = [conda_utils.conda_platform()]
+    keys = {
+        solve_cache.solve_cache_key(
+            db,
+            conda_store,
+            "conda-lock",
+            schema.CondaSpecification(
+                name="test", channels=channels, dependencies=["zlib"]
+            ),
+            platforms,
+        )
+        for channels in (["main", "conda-forge"], ["conda-forge", "main"])
+    }
+    assert len(keys) == 2
+
+
+def test_solve_cache_channel_update(db, conda_store, simple_specification):
+    settings = conda_store.get_settings()
+    channel = api.ensure_conda_channel(
+        db,
+        conda_utils.normalize_channel_name(
+            settings.conda_channel_alias, simple_specification.channels[0]
+        ),
+    )
+
+    locker = mock.Mock()
+    locker.lock_environment.return_value = {"package": []}
+
+    _lock_environment(db, conda_store, locker, simple_specification)
+    _lock_environment(db, conda_store, locker, simple_specification)
+    assert locker.lock_environment.call_count == 1
+
+    channel.last_update = datetime.datetime.utcnow()
+    db.commit()
+
+    _lock_environment(db, conda_store, locker, simple_specification)
+    assert locker.lock_environment.call_count == 2
+
+
+def test_solve_cache_ttl(db, conda_store, simple_specification):
+    locker = mock.Mock()
+    locker.lock_environment.return_value = {"package": []}
+
+    _lock_environment(db, conda_store, locker, simple_specification)
+
+    entry = db.query(orm.SolveCache).one()
+    entry.created_on -= datetime.timedelta(
+        seconds=conda_store.config.solve_cache_ttl + 1
+    )
+    db.commit()
+
+    _lock_environment(db, conda_store, locker, simple_specification)
+    assert locker.lock_environment.call_count == 2
+    # The expired entry is replaced
+    assert db.query(orm.SolveCache).count() == 1
+
+
+def test_solve_cache_disabled(db, conda_store, simple_specification):
+    conda_store.config.solve_cache_enabled = False
+
+    locker = mock.Mock()
+    locker.lock_environment.return_value = {"package": []}
+
+    _lock_environment(db, conda_store, locker, simple_specification)
+    _lock_environment(db, conda_store, locker, simple_specification)
+    assert locker.lock_environment.call_count == 2
+    assert db.query(orm.SolveCache).count() == 0
+
+
+def test_solve_cache_single_flight(conda_store, simple_specification):
+    def slow_lock_environment(**kwargs):
+        time.sleep(0.5)
+        return {"package": []}
+
+    locker = mock.Mock()
+    locker.lock_environment.side_effect = slow_lock_environment
+
+    results = []
+
+    def solve():
+        with conda_store.session_factory() as db:
+            results.append(
+                _lock_environment(db, conda_store, locker, simple_specification)
+            )
+
+    # The settings of conda_store are read through a single session, which
+    # must not be used concurrently
+    settings = conda_store.get_settings()
+    with mock.patch.object(conda_store, "get_settings", return_value=settings):
+        threads = [threading.Thread(target=solve) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert results == [{"package": []}] * 4
+    locker.lock_environment.assert_called_once()
@@ -2,7 +2,20 @@
 # Use of this source code is governed by a BSD-style
 # license that can be found in the LICENSE file.
 
-from conda_store_server._internal.utils import disk_usage, du
+import hashlib
+import os
+import stat
+import sys
+
+import pytest
+
+from conda_store_server._internal.utils import (
+    disk_usage,
+    disk_usage_stats,
+    du,
+    file_hashes,
+    set_permissions,
+)
 
 # TODO: Add tests for the other functions in utils.py
 
@@ -35,3 +48,72 @@ def test_disk_usage(tmp_path):
     assert isinstance(val, str)
     assert initial_disk_usage_size < int(val)
     assert initial_du_size <= du(test_dir)
+
+
+def test_disk_usage_stats(tmp_path):
+    cache = tmp_path / "pkgs"
+    cache.mkdir()
+    (cache / "shared").write_text("a" * 1000)
+
+    prefix = tmp_path / "prefix"
+    (prefix / "lib").mkdir(parents=True)
+    (prefix / "lib/shared").hardlink_to(cache / "shared")
+    (prefix / "lib/unique").write_text("b" * 500)
+    (prefix / "lib/unique_hardlink").hardlink_to(prefix / "lib/unique")
+
+    stats = disk_usage_stats(prefix)
+
+    # hardlinks within the prefix are counted once, like du
+    assert stats["total"] == du(prefix)
+    assert stats["total"] - stats["unique"] == 1000
+    assert stats["files"] == {
+        "lib/shared": 1000,
+        "lib/unique": 500,
+        "lib/unique_hardlink": 500,
+    }
+
+
+def test_file_hashes(tmp_path):
+    test_file = tmp_path / "test_file"
+    content = b"conda-store" * 100_000
+    test_file.write_bytes(content)
+
+    # Uses a small chunk size to make sure chunks are combined correctly
+    hashes = file_hashes(test_file, chunk_size=1000)
+    assert hashes == {
+        "md5": hashlib.md5(content).hexdigest(),
+        "sha256": hashlib.sha256(content).hexdigest(),
+    }
+
+
+@pytest.mark.skipif(
+    sys.platform == "win32", reason="permissions are not supported on Windows"
+)
+def test_set_permissions(tmp_path):
+    for directory in ["bin", "lib/python", "share"]:
+        (tmp_path / directory).mkdir(parents=True)
+        (tmp_path / directory / "file").write_text("content")
+    (tmp_path / "lib/python/link").symlink_to(tmp_path / "bin/file")
+    os.chmod(tmp_path, 0o750)
+    os.chmod(tmp_path / "bin", 0o750)
+    os.chmod(tmp_path / "bin/file", 0o750)
+
+    def modes():
+        return {
+            str(path.relative_to(tmp_path)): stat.S_IMODE(path.lstat().st_mode)
+            for path in tmp_path.rglob("*")
+            if not path.is_symlink()
+        }
+
+    # lib, lib/python, lib/python/file, share and share/file
+    assert set_permissions(tmp_path, permissions="750", max_workers=2) == 5
+    assert set(modes().values()) == {0o750}
+    assert set_permissions(tmp_path, permissions="750") == 0
+
+    # the owner only changes if it differs
+    assert set_permissions(tmp_path, uid=os.getuid(), gid=os.getgid()) == 0
+
+    with pytest.raises(ValueError):
+        set_permissions(tmp_path, permissions="7777")
+    with pytest.raises(ValueError):
+        set_permissions(tmp_path, uid="root", gid=0)
@@ -42,3 +42,35 @@ def test_build_completed(db, conda_store, seed_conda_store):
         db, 2, str(test_build.build_path(conda_store))
     )
     assert build_artifact is not None
+
+
+def test_lockfile_hash(conda_store, simple_conda_lock):
+    settings = conda_store.get_settings()
+    lockfile_hash = build.lockfile_hash(simple_conda_lock, settings)
+
+    # Metadata of the lockfile does not change the resulting prefix
+    lockfile = dict(simple_conda_lock, metadata={"time_metadata": "now"})
+    assert build.lockfile_hash(lockfile, settings) == lockfile_hash
+
+    settings = settings.model_copy(update={"default_permissions": "700"})
+    assert build.lockfile_hash(simple_conda_lock, settings) != lockfile_hash
+
+
+def test_shared_build_prefix(db, conda_store, seed_conda_store):
+    completed_build = api.get_build(db, build_id=4)
+    new_build = api.get_build(db, build_id=3)
+    completed_build.lockfile_hash = new_build.lockfile_hash = "abc"
+    db.commit()
+
+    shared_prefix = completed_build.build_path(conda_store)
+    (shared_prefix / "conda-meta").mkdir(parents=True)
+    (shared_prefix / "conda-meta" / "history").touch()
+
+    assert build.shared_build_prefix(db, conda_store, new_build) is None
+
+    conda_store.config.build_deduplication = True
+    assert build.shared_build_prefix(db, conda_store, new_build) == shared_prefix
+
+    new_build.lockfile_hash = "def"
+    db.commit()
+    assert build.shared_build_prefix(db, conda_store, new_build) is None
@@ -0,0 +1,90 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+from conda_store_server import api
+from conda_store_server._internal import schema
+from conda_store_server._internal.worker import build, build_log
+
+
+def test_build_log_writer_buffers_until_flush(db, conda_store, seed_conda_store):
+    test_build = api.get_build(db, build_id=1)
+    initial_logs = conda_store.storage.get(test_build.log_key)
+
+    writer = build_log.BuildLogWriter(
+        db, conda_store, test_build, flush_bytes=1024, flush_interval=3600
+    )
+    writer.write("line 1\n")
+    writer.write(b"line 2\n")
+    assert conda_store.storage.get(test_build.log_key) == initial_logs
+
+    writer.flush()
+    assert (
+        conda_store.storage.get(test_build.log_key)
+        == initial_logs + b"line 1\nline 2\n"
+    )
+
+
+def test_build_log_writer_flushes_on_size(db, conda_store, seed_conda_store):
+    test_build = api.get_build(db, build_id=1)
+    initial_logs = conda_store.storage.get(test_build.log_key)
+
+    writer = build_log.BuildLogWriter(
+        db, conda_store, test_build, flush_bytes=8, flush_interval=3600
+    )
+    writer.write("0123456789\n")
+    assert conda_store.storage.get(test_build.log_key) == initial_logs + b"0123456789\n"
+
+
+def test_open_build_log_registers_artifact_once(db, conda_store, seed_conda_store):
+    test_build = api.get_build(db, build_id=1)
+    # Removes the log artifact created when seeding the database
+    for artifact in api.list_build_artifacts(
+        db,
+        build_id=test_build.id,
+        included_artifact_types=[schema.BuildArtifactType.LOGS],
+    ).all():
+        db.delete(artifact)
+    db.commit()
+
+    with build_log.open_build_log(db, conda_store, test_build) as writer:
+        assert build_log.get_build_log_writer(test_build) is writer
+        for i in range(100):
+            build.append_to_logs(db, conda_store, test_build, f"line {i}\n")
+
+        # Nested contexts reuse the writer of the outer context
+        with build_log.open_build_log(db, conda_store, test_build) as inner:
+            assert inner is writer
+
+        assert (
+            api.list_build_artifacts(
+                db,
+                build_id=test_build.id,
+                included_artifact_types=[schema.BuildArtifactType.LOGS],
+            ).count()
+            == 0
+        )
+
+    assert build_log.get_build_log_writer(test_build) is None
+    assert (
+        api.list_build_artifacts(
+            db,
+            build_id=test_build.id,
+            included_artifact_types=[schema.BuildArtifactType.LOGS],
+        ).count()
+        == 1
+    )
+    logs = conda_store.storage.get(test_build.log_key)
+    assert logs.endswith(b"".join(f"line {i}\n".encode() for i in range(100)))
+
+
+def test_append_to_logs_without_writer(db, conda_store, seed_conda_store):
+    test_build = api.get_build(db, build_id=1)
+    initial_logs = conda_store.storage.get(test_build.log_key)
+
+    build.append_to_logs(db, conda_store, test_build, "cleanup reason\n")
+
+    assert (
+        conda_store.storage.get(test_build.log_key)
+        == initial_logs + b"cleanup reason\n"
+    )
@@ -0,0 +1,51 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import subprocess
+import sys
+
+import pytest
+
+from conda_store_server import api
+from conda_store_server._internal.action.base import ActionContext
+from conda_store_server._internal.worker import build_phase
+
+
+def test_build_phase(db, conda_store, seed_conda_store):
+    build = api.get_build(db, build_id=1)
+
+    with build_phase.build_phase(db, conda_store, build, "install"):
+        ActionContext().run_command(
+            [sys.executable, "-c", "b = bytearray(64 * 1024**2)"]
+        )
+
+    (phase,) = api.list_build_phases(db, build.id).all()
+    assert phase.name == "install"
+    assert phase.wall_time > 0
+    if build_phase.resource is not None:
+        assert phase.cpu_time > 0
+        # The child process allocated 64 MiB
+        assert phase.max_rss > 64 * 1024**2
+        assert phase.bytes_read >= 0
+        assert phase.bytes_written >= 0
+
+
+def test_build_phase_failed(db, conda_store, seed_conda_store):
+    build = api.get_build(db, build_id=1)
+
+    with pytest.raises(ValueError):
+        with build_phase.build_phase(db, conda_store, build, "solve"):
+            raise ValueError()
+
+    assert [phase.name for phase in api.list_build_phases(db, build.id)] == ["solve"]
+
+
+def test_wait_process_returncode():
+    context = ActionContext()
+    context.run_command([sys.executable, "-c", "print('hello')"])
+    assert context.stdout.getvalue().endswith("hello\n")
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        context.run_command([sys.executable, "-c", "raise SystemExit(3)"])
+    assert e.value.returncode == 3
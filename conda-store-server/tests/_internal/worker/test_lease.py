@@ -0,0 +1,90 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import datetime
+import time
+from unittest import mock
+
+from conda_store_server import api
+from conda_store_server._internal import schema
+from conda_store_server._internal.worker import build, lease
+
+
+def _set_building(db, build_id, started_ago=datetime.timedelta(0)):
+    test_build = api.get_build(db, build_id=build_id)
+    test_build.status = schema.BuildStatus.BUILDING
+    test_build.started_on = datetime.datetime.utcnow() - started_ago
+    db.commit()
+    return test_build
+
+
+def test_renew_build_lease(db, seed_conda_store):
+    duration = datetime.timedelta(minutes=1)
+    api.acquire_build_lease(db, 1, "worker-a", duration)
+    assert api.renew_build_lease(db, 1, "worker-a", duration)
+    assert not api.renew_build_lease(db, 1, "worker-b", duration)
+
+    # Another worker takes over the build
+    api.acquire_build_lease(db, 1, "worker-b", duration)
+    assert not api.renew_build_lease(db, 1, "worker-a", duration)
+
+    # Revoked leases cannot be renewed
+    api.revoke_build_lease(db, 1)
+    assert not api.renew_build_lease(db, 1, "worker-b", duration)
+
+    api.release_build_lease(db, 1)
+    assert api.get_build_lease(db, 1) is None
+
+
+def test_build_lease_heartbeat(db, conda_store, seed_conda_store):
+    conda_store.config.build_lease_timeout = 1
+
+    with lease.build_lease(conda_store, 1):
+        expires_on = api.get_build_lease(db, 1).expires_on
+        time.sleep(1.5)
+        db.expire_all()
+        assert api.get_build_lease(db, 1).expires_on > expires_on
+
+    assert api.get_build_lease(db, 1) is None
+
+
+def test_build_cleanup(db, conda_store, seed_conda_store):
+    duration = datetime.timedelta(minutes=1)
+    running = _set_building(db, 1)
+    api.acquire_build_lease(db, running.id, "worker-a", duration)
+    dead = _set_building(db, 2)
+    api.acquire_build_lease(db, dead.id, "worker-b", duration)
+    api.revoke_build_lease(db, dead.id)
+    # Builds without a lease are only stuck after the lease timeout
+    starting = _set_building(db, 3)
+    legacy = _set_building(db, 4, started_ago=datetime.timedelta(hours=1))
+
+    with mock.patch.object(build, "append_to_logs"):
+        build.build_cleanup(db, conda_store)
+
+    assert running.status == schema.BuildStatus.BUILDING
+    assert dead.status == schema.BuildStatus.FAILED
+    assert api.get_build_lease(db, dead.id) is None
+    assert starting.status == schema.BuildStatus.BUILDING
+    assert legacy.status == schema.BuildStatus.FAILED
+
+    # Explicitly canceled builds do not wait for the lease timeout
+    with mock.patch.object(build, "append_to_logs"):
+        build.build_cleanup(db, conda_store, [starting.id], is_canceled=True)
+    assert starting.status == schema.BuildStatus.CANCELED
+
+
+def test_cancel_unleased_build(db, seed_conda_store):
+    running = _set_building(db, 1)
+    api.acquire_build_lease(db, running.id, "worker-a", datetime.timedelta(minutes=1))
+    assert not api.cancel_unleased_build(db, running.id)
+
+    api.revoke_build_lease(db, running.id)
+    assert api.cancel_unleased_build(db, running.id, status_info="canceled")
+    db.refresh(running)
+    assert running.status == schema.BuildStatus.CANCELED
+    assert running.status_info == "canceled"
+
+    # Finished builds are not canceled
+    assert not api.cancel_unleased_build(db, running.id)
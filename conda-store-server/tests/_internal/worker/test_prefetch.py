@@ -0,0 +1,125 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import concurrent.futures
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from conda_store_server import api
+from conda_store_server._internal import schema
+from conda_store_server._internal.action.base import ActionContext
+from conda_store_server._internal.worker import build_log, prefetch
+
+
+def _packages(*names):
+    return [
+        {"url": f"https://conda.example.com/noarch/{name}-1.0-0.conda"}
+        for name in names
+    ]
+
+
+def _slow_fetch(started):
+    """Fake download of 50 chunks which signals started once it began"""
+
+    def fetch(context, package, pkgs_dir, count_message, on_chunk):
+        started.release()
+        for _ in range(50):
+            on_chunk(1024)
+            time.sleep(0.01)
+
+    return fetch
+
+
+def test_rate_limiter():
+    rate_limiter = prefetch.RateLimiter(1000)
+    start_time = time.monotonic()
+    # A burst of one second worth of bytes is allowed
+    rate_limiter.consume(1000)
+    assert time.monotonic() - start_time < 0.25
+    rate_limiter.consume(500)
+    assert time.monotonic() - start_time >= 0.45
+
+
+def test_prefetcher_stop(conda_store, tmp_path):
+    started = threading.Semaphore(0)
+    packages = _packages("kept", "unneeded", "queued")
+    with mock.patch.object(
+        prefetch, "fetch_and_extract_conda_package", _slow_fetch(started)
+    ):
+        prefetcher = prefetch.Prefetcher(
+            conda_store, 1, packages, tmp_path, ActionContext(), max_workers=2
+        )
+        started.acquire()
+        started.acquire()
+        prefetcher.stop(keep=[packages[0]["url"], packages[2]["url"]])
+        kept, unneeded, queued = prefetcher._futures
+        concurrent.futures.wait([kept, unneeded])
+
+    assert kept.exception() is None
+    assert isinstance(unneeded.exception(), prefetch.PrefetchCanceledError)
+    # Downloads which did not start are not started after stopping
+    assert queued.cancelled()
+
+
+def test_prefetcher_build_canceled(db, conda_store, seed_conda_store, tmp_path):
+    build = api.get_build(db, build_id=1)
+    build.status = schema.BuildStatus.CANCELED
+    db.commit()
+
+    started = threading.Semaphore(0)
+    with (
+        mock.patch.object(prefetch, "CANCEL_CHECK_INTERVAL", 0),
+        mock.patch.object(
+            prefetch, "fetch_and_extract_conda_package", _slow_fetch(started)
+        ),
+    ):
+        prefetcher = prefetch.Prefetcher(
+            conda_store, build.id, _packages("canceled"), tmp_path, ActionContext()
+        )
+        (future,) = prefetcher._futures
+        with pytest.raises(prefetch.PrefetchCanceledError):
+            future.result()
+        prefetcher.stop()
+
+
+def test_prefetch_packages_disabled(db, conda_store, seed_conda_store):
+    conda_store.config.conda_prefetch_packages = False
+    build = api.get_build(db, build_id=1)
+
+    with mock.patch.object(prefetch, "Prefetcher") as prefetcher:
+        with prefetch.prefetch_packages(conda_store, build) as keep_prefetched:
+            keep_prefetched(["https://conda.example.com/noarch/a-1.0-0.conda"])
+
+    prefetcher.assert_not_called()
+
+
+def test_prefetch_log_stream(db, conda_store, seed_conda_store):
+    build = api.get_build(db, build_id=1)
+    initial_logs = conda_store.storage.get(build.log_key)
+
+    with build_log.open_build_log(db, conda_store, build) as writer:
+        stream = prefetch.PrefetchLogStream(conda_store, writer, prefix="prefetch: ")
+        context = ActionContext(stdout=stream)
+        thread = threading.Thread(target=context.log.info, args=["DONE a"])
+        thread.start()
+        thread.join()
+
+    # Once the writer is closed, logs of the threads do not reopen it, which
+    # would use the session of the build from another thread
+    with (
+        mock.patch.object(build_log, "open_build_log") as open_build_log,
+        mock.patch.object(conda_store, "log") as log,
+    ):
+        thread = threading.Thread(target=context.log.info, args=["DONE b"])
+        thread.start()
+        thread.join()
+    open_build_log.assert_not_called()
+    log.info.assert_called_once_with(f"build {build.id} prefetch: DONE b")
+
+    assert conda_store.storage.get(build.log_key) == (
+        initial_logs + b"prefetch: DONE a\n"
+    )
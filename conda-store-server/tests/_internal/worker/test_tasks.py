@@ -0,0 +1,253 @@
+# Copyright (c) conda-store development team. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+import os
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from conda_store_server import api
+from conda_store_server._internal import orm, schema
+from conda_store_server._internal.worker import tasks
+
+
+@pytest.fixture
+def worker(conda_store):
+    with mock.patch.object(
+        tasks.WorkerTask, "worker", new_callable=mock.PropertyMock
+    ) as worker:
+        worker.return_value.conda_store = conda_store
+        yield worker
+
+
+def _build_artifact(db, build_id, artifact_type):
+    return api.list_build_artifacts(
+        db, build_id=build_id, included_artifact_types=[artifact_type]
+    ).one()
+
+
+def test_delete_shared_build_directory(db, conda_store, seed_conda_store):
+    owner = api.get_build(db, build_id=4)
+    sharing = api.get_build(db, build_id=3)
+
+    shared_prefix = owner.build_path(conda_store)
+    (shared_prefix / "conda-meta").mkdir(parents=True)
+    (shared_prefix / "conda-meta" / "history").touch()
+    sharing_prefix = sharing.build_path(conda_store)
+    sharing_prefix.parent.mkdir(parents=True, exist_ok=True)
+    os.symlink(shared_prefix, sharing_prefix)
+
+    directory = schema.BuildArtifactType.DIRECTORY
+    _build_artifact(db, sharing.id, directory).key = str(shared_prefix)
+    db.commit()
+
+    # The prefix is kept while another build references it
+    tasks.delete_build_artifact(
+        db, conda_store, _build_artifact(db, owner.id, directory)
+    )
+    db.commit()
+    assert shared_prefix.is_dir()
+
+    tasks.delete_build_artifact(
+        db, conda_store, _build_artifact(db, sharing.id, directory)
+    )
+    db.commit()
+    assert not sharing_prefix.is_symlink()
+    assert not shared_prefix.exists()
+
+
+def test_delete_builds_artifacts_shared_directory(db, conda_store, seed_conda_store):
+    owner = api.get_build(db, build_id=4)
+    sharing = api.get_build(db, build_id=3)
+
+    shared_prefix = owner.build_path(conda_store)
+    (shared_prefix / "conda-meta").mkdir(parents=True)
+    sharing_prefix = sharing.build_path(conda_store)
+    sharing_prefix.parent.mkdir(parents=True, exist_ok=True)
+    os.symlink(shared_prefix, sharing_prefix)
+    _build_artifact(db, sharing.id, schema.BuildArtifactType.DIRECTORY).key = str(
+        shared_prefix
+    )
+    db.commit()
+
+    threads = {}
+
+    def delete_build_prefix(conda_store, conda_prefix, key, is_shared):
+        threads[conda_prefix] = threading.get_ident()
+        # Lets another thread pick up the other prefix, if it was submitted
+        time.sleep(0.1)
+        return _delete_build_prefix(conda_store, conda_prefix, key, is_shared)
+
+    _delete_build_prefix = tasks._delete_build_prefix
+    conda_store.config.delete_max_workers = 4
+    with mock.patch.object(tasks, "_delete_build_prefix", delete_build_prefix):
+        tasks.delete_builds_artifacts(db, conda_store, [owner.id, sharing.id])
+
+    # Both prefixes resolve to the same directory, which is removed by a
+    # single thread
+    assert threads[shared_prefix] == threads[sharing_prefix]
+    assert not sharing_prefix.is_symlink()
+    assert not shared_prefix.exists()
+    assert api.list_build_artifacts(db, build_id=owner.id).count() == 0
+    assert api.list_build_artifacts(db, build_id=sharing.id).count() == 0
+
+
+def test_delete_builds_artifacts_missing_directory(db, conda_store, seed_conda_store):
+    build = api.get_build(db, build_id=1)
+    assert not build.build_path(conda_store).exists()
+
+    tasks.delete_builds_artifacts(db, conda_store, [build.id])
+
+    # The artifact of a prefix which was not deleted is kept, like
+    # delete_build_artifact does
+    assert [
+        artifact.artifact_type
+        for artifact in api.list_build_artifacts(db, build_id=build.id)
+    ] == [schema.BuildArtifactType.DIRECTORY]
+
+
+def test_delete_shared_build_archive(db, conda_store, seed_conda_store):
+    owner = api.get_build(db, build_id=4)
+    sharing = api.get_build(db, build_id=3)
+
+    conda_pack = schema.BuildArtifactType.CONDA_PACK
+    _build_artifact(db, sharing.id, conda_pack).key = owner.conda_pack_key
+    db.commit()
+
+    tasks.delete_build_artifact(
+        db, conda_store, _build_artifact(db, owner.id, conda_pack)
+    )
+    assert conda_store.storage.get(owner.conda_pack_key) == b"testing-conda-package"
+
+    tasks.delete_build_artifact(
+        db, conda_store, _build_artifact(db, sharing.id, conda_pack)
+    )
+    assert not os.path.exists(
+        os.path.join(conda_store.storage.storage_path, owner.conda_pack_key)
+    )
+
+
+def test_task_delete_namespace(db, conda_store, seed_conda_store, worker):
+    # Build 3 in namespace1 shares the prefix and archive of build 4 in
+    # namespace2
+    owner = api.get_build(db, build_id=4)
+    deleted = api.get_build(db, build_id=3)
+    namespace_id = deleted.environment.namespace_id
+
+    shared_prefix = owner.build_path(conda_store)
+    (shared_prefix / "conda-meta").mkdir(parents=True)
+    deleted_prefix = deleted.build_path(conda_store)
+    deleted_prefix.parent.mkdir(parents=True, exist_ok=True)
+    os.symlink(shared_prefix, deleted_prefix)
+    _build_artifact(db, deleted.id, schema.BuildArtifactType.DIRECTORY).key = str(
+        shared_prefix
+    )
+    _build_artifact(
+        db, deleted.id, schema.BuildArtifactType.CONDA_PACK
+    ).key = owner.conda_pack_key
+    deleted_env_export_key = deleted.conda_env_export_key
+    db.commit()
+
+    tasks.task_delete_namespace(namespace_id)
+    db.expire_all()
+
+    assert api.get_namespace(db, id=namespace_id) is None
+    assert api.get_build(db, build_id=3) is None
+    assert not deleted_prefix.is_symlink()
+    assert not os.path.exists(
+        os.path.join(conda_store.storage.storage_path, deleted_env_export_key)
+    )
+
+    # The data shared with build 4 is kept
+    assert shared_prefix.is_dir()
+    assert conda_store.storage.get(owner.conda_pack_key) == b"testing-conda-package"
+    assert len(api.list_build_artifacts(db, build_id=owner.id).all()) > 0
+
+
+def test_task_delete_environment(db, conda_store, seed_conda_store, worker):
+    build = api.get_build(db, build_id=1)
+    environment_id = build.environment_id
+    conda_prefix = build.build_path(conda_store)
+    (conda_prefix / "conda-meta").mkdir(parents=True)
+    keys = [build.log_key, build.conda_env_export_key, build.conda_pack_key]
+
+    progress = []
+    with mock.patch.object(
+        tasks,
+        "_deletion_progress",
+        return_value=lambda deleted, total: progress.append((deleted, total)),
+    ):
+        tasks.task_delete_environment(environment_id)
+    db.expire_all()
+
+    assert api.get_environment(db, id=environment_id) is None
+    assert not conda_prefix.exists()
+    for key in keys:
+        assert not os.path.exists(os.path.join(conda_store.storage.storage_path, key))
+    # The prefix, then the storage keys in one batch
+    assert progress == [(1, 4), (4, 4)]
+
+
+def test_task_delete_build(db, conda_store, seed_conda_store, worker):
+    build = api.get_build(db, build_id=1)
+    conda_pack_key = build.conda_pack_key
+    conda_prefix = build.build_path(conda_store)
+    (conda_prefix / "conda-meta").mkdir(parents=True)
+
+    tasks.task_delete_build(build.id)
+    db.expire_all()
+
+    # Logs, lockfiles and YAML are kept by default
+    assert {
+        artifact.artifact_type
+        for artifact in api.list_build_artifacts(db, build_id=build.id)
+    } == {
+        schema.BuildArtifactType.LOGS,
+        schema.BuildArtifactType.LOCKFILE,
+        schema.BuildArtifactType.YAML,
+    }
+    assert conda_store.storage.get(build.log_key) == b"fake logs"
+    assert not conda_store.storage.exists_many([conda_pack_key])[conda_pack_key]
+    assert not conda_prefix.exists()
+    assert api.get_build(db, build_id=build.id).deleted_on is not None
+
+
+def test_task_update_conda_channel_subdirs(db, conda_store, worker):
+    settings = conda_store.get_settings()
+
+    # Each subdir of the channel is updated by its own task
+    with mock.patch.object(tasks, "send_task") as send_task:
+        tasks.task_update_conda_channel("conda-forge")
+    assert [call.kwargs["args"] for call in send_task.call_args_list] == [
+        ["conda-forge", subdir] for subdir in settings.conda_platforms
+    ]
+
+    channel = api.create_conda_channel(db, "https://conda.example.com/channel")
+    db.commit()
+    with mock.patch.object(orm.CondaChannel, "update_packages") as update_packages:
+        tasks.task_update_conda_channel_subdir(channel.name, "noarch")
+    update_packages.assert_called_once_with(
+        mock.ANY,
+        subdirs=["noarch"],
+        cache_dir=f"{conda_store.config.store_directory}/.repodata-cache",
+        max_workers=conda_store.config.conda_channel_max_concurrent_downloads,
+    )
+
+
+def test_task_update_conda_channel_without_cache(db, conda_store, worker):
+    conda_store.config.conda_repodata_cache_directory = ""
+    channel = api.create_conda_channel(db, "https://conda.example.com/channel")
+    db.commit()
+
+    # All the subdirs are updated by the task
+    with mock.patch.object(orm.CondaChannel, "update_packages") as update_packages:
+        tasks.task_update_conda_channel(channel.name)
+    update_packages.assert_called_once_with(
+        mock.ANY,
+        subdirs=conda_store.get_settings().conda_platforms,
+        cache_dir=None,
+        max_workers=conda_store.config.conda_channel_max_concurrent_downloads,
+    )
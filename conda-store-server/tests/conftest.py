@@ -3,11 +3,15 @@
 # license that can be found in the LICENSE file.
 
 import datetime
+import email.utils
+import hashlib
+import http.server
 import json
 import pathlib
 import random
 import string
 import sys
+import threading
 import typing
 import uuid
 from collections import defaultdict
@@ -408,6 +412,78 @@ def plugin_manager():
     return pm
 
 
+class _ChannelRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the files of a conda channel directory like a CDN would: with
+    ETag and Last-Modified validators, conditional and Range requests
+    """
+
+    def do_GET(self):  # noqa: N802
+        if self.server.failures.get(self.path):
+            self.server.failures[self.path] -= 1
+            return self._respond(503)
+
+        path = pathlib.Path(self.translate_path(self.path))
+        if not path.is_file():
+            return self._respond(404)
+
+        content = path.read_bytes()
+        headers = {
+            "ETag": f'"{hashlib.sha256(content).hexdigest()}"',
+            "Last-Modified": email.utils.formatdate(path.stat().st_mtime, usegmt=True),
+        }
+        if self.headers.get("If-None-Match") == headers["ETag"]:
+            return self._respond(304, headers)
+
+        status = 200
+        if self.headers.get("Range", "").startswith("bytes="):
+            start = int(self.headers["Range"][len("bytes=") :].split("-")[0])
+            if start >= len(content):
+                return self._respond(416)
+            status, content = 206, content[start:]
+        self._respond(status, headers, content)
+
+    def _respond(self, status, headers=None, content=b""):
+        self.server.requests.append((self.path, status))
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def conda_channel_server(tmp_path):
+    """Local HTTP server standing in for a conda channel, serving the files
+    of server.directory at server.url and recording the (path, status) of
+    the requests in server.requests. The requests of the paths of
+    server.failures fail with 503 Service Unavailable the given number of
+    times.
+    """
+    directory = tmp_path / "channel"
+    directory.mkdir()
+
+    class Handler(_ChannelRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=str(directory), **kwargs)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.directory = directory
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    server.requests = []
+    server.failures = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 @pytest.fixture
 def alembic_config(conda_store):
     from conda_store_server._internal.dbutil import write_alembic_ini
@@ -375,3 +375,62 @@ def test_build_path_too_long(db, conda_store, simple_specification):
         BuildPathError, match=r"build_path too long: must be <= 255 characters"
     ):
         build.build_path(conda_store)
+
+
+def _package_record(name, version="1.0", build="0", channel="https://example.org/c1"):
+    return {
+        "name": name,
+        "build": build,
+        "build_number": 0,
+        "constrains": None,
+        "depends": [],
+        "license": None,
+        "license_family": None,
+        "size": -1,
+        "subdir": "noarch",
+        "timestamp": None,
+        "version": version,
+        "channel_id": channel,
+        "md5": f"md5-{name}-{version}-{build}",
+        "sha256": f"sha256-{name}-{version}-{build}",
+        "summary": None,
+        "description": None,
+    }
+
+
+def test_create_or_ignore_conda_packages(db):
+    records = [
+        _package_record("a"),
+        _package_record("a"),  # duplicate within the same list
+        _package_record("a", build="1"),
+        _package_record("b", version="2.0"),
+        _package_record("c", channel="https://example.org/c2"),
+        _package_record("d", channel="https://conda.anaconda.org/pypi"),
+    ]
+
+    package_builds = api.create_or_ignore_conda_packages(db, records)
+    db.commit()
+
+    assert [(_.package.name, _.build) for _ in package_builds] == [
+        ("a", "0"),
+        ("a", "1"),
+        ("b", "0"),
+        ("c", "0"),
+    ]
+    assert {_.name for _ in api.list_conda_channels(db)} == {
+        "https://example.org/c1",
+        "https://example.org/c2",
+    }
+    # Input records are not modified
+    assert records[0]["channel_id"] == "https://example.org/c1"
+
+    # Registering the same packages again does not create new rows and
+    # matches rows created by create_or_ignore_conda_package
+    single = api.create_or_ignore_conda_package(db, _package_record("b", "2.0"))
+    db.commit()
+    assert single.id == package_builds[2].id
+
+    package_builds_again = api.create_or_ignore_conda_packages(db, records)
+    db.commit()
+    assert [_.id for _ in package_builds_again] == [_.id for _ in package_builds]
+    assert api.list_conda_packages(db).count() == 3
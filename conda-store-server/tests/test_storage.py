@@ -1,8 +1,11 @@
 import os
+from unittest import mock
 
 import pytest
+from minio.deleteobjects import DeleteError
+from minio.error import S3Error
 
-from conda_store_server import api, storage
+from conda_store_server import api, exception, storage
 from conda_store_server._internal import schema
 
 
@@ -105,6 +108,49 @@ class TestLocalStorage:
         target_content = open(target_file).read()
         assert target_content == "somestuff"
 
+    def test_append(self, db, local_file_store):
+        store = storage.LocalStorage()
+        store.storage_path = local_file_store
+
+        store.append("logs/new.log", b"line 1\n")
+        store.append("logs/new.log", b"line 2\n")
+        assert store.get("logs/new.log") == b"line 1\nline 2\n"
+
+        # Appending does not register build artifacts
+        assert len(api.list_build_artifacts(db).all()) == 0
+
+    def test_open_writer(self, db, local_file_store):
+        store = storage.LocalStorage()
+        store.storage_path = local_file_store
+
+        with store.open_writer(
+            db, 123, "archive/new.tar.gz", artifact_type=schema.BuildArtifactType.YAML
+        ) as f:
+            f.write(b"part 1 ")
+            # Nothing is visible before the writer is closed
+            assert not os.path.exists(local_file_store / "archive" / "new.tar.gz")
+            f.write(b"part 2")
+
+        assert store.get("archive/new.tar.gz") == b"part 1 part 2"
+        assert len(api.list_build_artifacts(db).all()) == 1
+
+    def test_open_writer_error(self, db, local_file_store):
+        store = storage.LocalStorage()
+        store.storage_path = local_file_store
+
+        with pytest.raises(ValueError):
+            with store.open_writer(
+                db,
+                123,
+                "archive/new.tar.gz",
+                artifact_type=schema.BuildArtifactType.YAML,
+            ) as f:
+                f.write(b"part 1")
+                raise ValueError()
+
+        assert os.listdir(local_file_store / "archive") == []
+        assert len(api.list_build_artifacts(db).all()) == 0
+
     def test_get(self, local_file_store):
         store = storage.LocalStorage()
         store.storage_path = local_file_store
@@ -128,3 +174,272 @@ class TestLocalStorage:
         assert len(api.list_build_artifacts(db).all()) == len(inital_artifacts) - 1
 
         assert not os.path.exists(target_file)
+
+    def test_set_many(self, db, local_file_store):
+        store = storage.LocalStorage()
+        store.storage_path = local_file_store
+
+        items = [
+            {
+                "key": f"artifacts/{i}.yaml",
+                "value": f"artifact {i}".encode(),
+                "content_type": "text/yaml",
+                "artifact_type": schema.BuildArtifactType.YAML,
+            }
+            for i in range(3)
+        ]
+        store.set_many(db, 123, items)
+        # Setting existing keys does not duplicate their artifacts
+        store.set_many(db, 123, items[:1])
+
+        assert store.get("artifacts/2.yaml") == b"artifact 2"
+        assert len(api.list_build_artifacts(db).all()) == 3
+
+    def test_exists_many(self, local_file_store):
+        store = storage.LocalStorage()
+        store.storage_path = local_file_store
+
+        assert store.exists_many(["testfile1", "missing", "logs"]) == {
+            "testfile1": True,
+            "missing": False,
+            "logs": False,
+        }
+
+    def test_delete_many(self, seed_conda_store, local_file_store):
+        store = storage.LocalStorage()
+        store.storage_path = local_file_store
+        db = seed_conda_store
+
+        inital_artifacts = api.list_build_artifacts(db).all()
+        keys = ["testfile1", "testfile2", inital_artifacts[0].key]
+
+        store.delete_many(db, keys)
+        assert len(api.list_build_artifacts(db).all()) == len(inital_artifacts) - 1
+        assert not os.path.exists(local_file_store / "testfile1")
+        assert not os.path.exists(local_file_store / "testfile2")
+
+
+class TestS3Storage:
+    @pytest.fixture
+    def s3_store(self):
+        store = storage.S3Storage(upload_part_size=5 * 1024**2)
+        store._internal_client = mock.Mock()
+        store.objects = {}
+
+        def put_object(bucket_name, key, data, length, part_size, content_type):
+            assert length == -1
+            store.objects[key] = data.read()
+
+        store._internal_client.put_object.side_effect = put_object
+        return store
+
+    def test_open_writer(self, db, s3_store):
+        with s3_store.open_writer(
+            db,
+            123,
+            "archive/new.tar.zst",
+            content_type="application/zstd",
+            artifact_type=schema.BuildArtifactType.CONDA_PACK,
+        ) as f:
+            # More than the pipe buffer, which requires a concurrent upload
+            for _ in range(64):
+                f.write(b"x" * 4096)
+
+        assert s3_store.objects == {"archive/new.tar.zst": b"x" * 4096 * 64}
+        assert len(api.list_build_artifacts(db).all()) == 1
+
+    def test_open_writer_error(self, db, s3_store):
+        with pytest.raises(ValueError):
+            with s3_store.open_writer(db, 123, "archive/new.tar.zst") as f:
+                f.write(b"part 1")
+                raise ValueError()
+
+        # The truncated upload is removed
+        s3_store._internal_client.remove_object.assert_called_once_with(
+            s3_store.bucket_name, "archive/new.tar.zst"
+        )
+        assert len(api.list_build_artifacts(db).all()) == 0
+
+    def test_open_writer_upload_error(self, db, s3_store):
+        s3_store._internal_client.put_object.side_effect = ConnectionError()
+
+        with pytest.raises(ConnectionError):
+            with s3_store.open_writer(db, 123, "archive/new.tar.zst") as f:
+                for _ in range(64):
+                    f.write(b"x" * 4096)
+
+        s3_store._internal_client.remove_object.assert_not_called()
+        assert len(api.list_build_artifacts(db).all()) == 0
+
+    def test_delete_many(self, seed_conda_store, s3_store):
+        db = seed_conda_store
+        inital_artifacts = api.list_build_artifacts(db).all()
+        keys = [f"key-{i}" for i in range(1500)] + [
+            inital_artifacts[0].key,
+            inital_artifacts[1].key,
+        ]
+        # The logs of the artifacts have no parts
+        s3_store._internal_client.list_objects.return_value = []
+        s3_store._internal_client.remove_objects.side_effect = (
+            lambda _bucket_name, objects: [
+                DeleteError("AccessDenied", "denied", o.name, None)
+                for o in objects
+                if o.name == inital_artifacts[1].key
+            ]
+        )
+
+        with pytest.raises(exception.CondaStoreError):
+            s3_store.delete_many(db, keys)
+
+        # The keys are deleted in batches of up to 1000 objects
+        assert [
+            len(call.args[1])
+            for call in s3_store._internal_client.remove_objects.call_args_list
+        ] == [1000, 502]
+        # The artifacts of objects which could not be deleted are kept
+        assert {artifact.key for artifact in api.list_build_artifacts(db).all()} == {
+            artifact.key for artifact in inital_artifacts[1:]
+        }
+
+    def test_set_many(self, db, s3_store):
+        def put_object(bucket_name, key, data, length, content_type):
+            s3_store.objects[key] = data.read()
+
+        s3_store._internal_client.put_object.side_effect = put_object
+        items = [
+            {
+                "key": f"artifacts/{i}.yaml",
+                "value": f"artifact {i}".encode(),
+                "content_type": "text/yaml",
+                "artifact_type": schema.BuildArtifactType.YAML,
+            }
+            for i in range(20)
+        ]
+
+        s3_store.set_many(db, 123, items)
+
+        assert s3_store.objects == {item["key"]: item["value"] for item in items}
+        assert len(api.list_build_artifacts(db).all()) == 20
+
+    @pytest.fixture
+    def s3_objects(self, s3_store):
+        """In memory objects of the client of s3_store, with their metadata"""
+        client = s3_store._internal_client
+        headers = {}
+
+        def put_object(bucket_name, key, data, length, content_type, metadata=None):
+            s3_store.objects[key] = data.read()
+            headers[key] = metadata or {}
+
+        def get_object(bucket_name, key):
+            if key not in s3_store.objects:
+                raise S3Error(mock.Mock(), "NoSuchKey", "not found", key, "id", "host")
+            return mock.Mock(
+                read=mock.Mock(return_value=s3_store.objects[key]),
+                headers=headers.get(key, {}),
+            )
+
+        def list_objects(bucket_name, prefix, recursive):
+            assert recursive
+            return [
+                mock.Mock(object_name=key)
+                for key in s3_store.objects
+                if key.startswith(prefix)
+            ]
+
+        def remove_object(bucket_name, key):
+            s3_store.objects.pop(key, None)
+
+        def remove_objects(bucket_name, objects):
+            for o in objects:
+                s3_store.objects.pop(o.name, None)
+            return []
+
+        client.put_object.side_effect = put_object
+        client.get_object.side_effect = get_object
+        client.list_objects.side_effect = list_objects
+        client.remove_object.side_effect = remove_object
+        client.remove_objects.side_effect = remove_objects
+        return s3_store.objects
+
+    def test_append(self, s3_store, s3_objects):
+        client = s3_store._internal_client
+
+        s3_store.append("logs/new.log", b"line 1\n")
+        s3_store.append("logs/new.log", b"line 2\n")
+        # Appending neither reads nor rewrites the existing content
+        client.get_object.assert_not_called()
+        assert [call.kwargs["length"] for call in client.put_object.call_args_list] == [
+            7,
+            7,
+        ]
+        assert s3_store.is_appending("logs/new.log")
+        assert s3_store.get("logs/new.log") == b"line 1\nline 2\n"
+
+        s3_store.finish_append("logs/new.log", content_type="text/plain")
+        assert s3_objects == {"logs/new.log": b"line 1\nline 2\n"}
+        assert not s3_store.is_appending("logs/new.log")
+
+        s3_store.append("logs/new.log", b"line 3\n")
+        s3_store.finish_append("logs/new.log")
+        assert s3_store.get("logs/new.log") == b"line 1\nline 2\nline 3\n"
+
+        # Only build logs have parts
+        s3_objects["lockfile/new.yml"] = b"lockfile"
+        client.list_objects.reset_mock()
+        assert s3_store.get("lockfile/new.yml") == b"lockfile"
+        client.list_objects.assert_not_called()
+
+    def test_finish_append_concurrent_get(self, s3_store, s3_objects):
+        client = s3_store._internal_client
+        s3_store.append("logs/new.log", b"line 1\n")
+        s3_store.append("logs/new.log", b"line 2\n")
+
+        # Reads while the joined log is stored and its parts are not removed
+        # yet, and while the parts are listed but not read yet
+        remove_objects = client.remove_objects.side_effect
+        read_logs = []
+
+        def get_then_remove_objects(bucket_name, objects):
+            read_logs.append(s3_store.get("logs/new.log"))
+            return remove_objects(bucket_name, objects)
+
+        client.remove_objects.side_effect = get_then_remove_objects
+        s3_store.finish_append("logs/new.log")
+        assert read_logs == [b"line 1\nline 2\n"]
+
+        s3_store.append("logs/new.log", b"line 3\n")
+        list_objects = client.list_objects.side_effect
+
+        def list_then_finish(bucket_name, prefix, recursive):
+            client.list_objects.side_effect = list_objects
+            parts = list_objects(bucket_name, prefix, recursive)
+            s3_store.finish_append("logs/new.log")
+            return parts
+
+        client.remove_objects.side_effect = remove_objects
+        client.list_objects.side_effect = list_then_finish
+        assert s3_store.get("logs/new.log") == b"line 1\nline 2\nline 3\n"
+
+    def test_delete_parts(self, seed_conda_store, s3_store, s3_objects):
+        db = seed_conda_store
+        # Logs of builds which crashed before their log was finished
+        keys = [api.get_build(db, build_id).log_key for build_id in [1, 2, 3]]
+        for key in keys:
+            s3_store.append(key, b"line 1\n")
+
+        s3_store.delete(db, 1, keys[0])
+        s3_store.delete_many(db, keys[1:2])
+        assert {key.split(".parts/")[0] for key in s3_objects} == {keys[2]}
+
+    def test_exists_many(self, s3_store):
+        def stat_object(bucket_name, key):
+            if key == "missing":
+                raise S3Error(mock.Mock(), "NoSuchKey", "not found", key, "id", "host")
+
+        s3_store._internal_client.stat_object.side_effect = stat_object
+
+        assert s3_store.exists_many(["present", "missing"]) == {
+            "present": True,
+            "missing": False,
+        }